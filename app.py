@@ -8,25 +8,41 @@ if str(ROOT_DIR) not in sys.path:
 
 import gradio as gr
 from rag.rag_pipeline import RAGPipeline
+from rag.facets import load_facet_counts
+from rag.service import ServiceBusy, ServiceCore
 
-# Initialize RAG pipeline once (important for performance)
+# Initialize RAG pipeline once (important for performance). Models load on a
+# background thread so the UI can bind immediately. The UI goes through the same
+# ServiceCore as the HTTP API (rag.service), so it shares its concurrency limits.
 rag = RAGPipeline()
+rag.warm_up(background=True)
+core = ServiceCore(rag)
 
-def ask_question(question):
-    """
-    Handles user question and returns answer + sources.
-    """
-    if not question.strip():
-        return "Please enter a question.", ""
+# Filter choices come from the facet counts written at ingest time (no collection scan)
+ALL = "All"
+FACET_COUNTS = load_facet_counts(rag.chroma_dir)
+PRODUCT_CHOICES = [ALL] + list(FACET_COUNTS.get("product", {}))
+STATE_CHOICES = [ALL] + sorted(FACET_COUNTS.get("state", {}))
 
-    result = rag.query(question, k=3)
 
-    answer = result["answer"]
+def build_filter(product, state):
+    """Metadata filter for the selected dropdown values (None when nothing is selected)."""
+    where = {}
+    if product and product != ALL:
+        where["product"] = product
+    if state and state != ALL:
+        where["state"] = state
+    return where or None
 
-    # Format sources nicely
+
+def format_sources(sources):
+    """Render retrieved chunks as Markdown."""
     sources_text = ""
-    for i, src in enumerate(result["sources"], start=1):
+    for i, src in enumerate(sources, start=1):
         meta = src["metadata"]
+        if meta.get("source") == "analytics":
+            sources_text += f"\n### Complaint counts\n\n{src['text']}\n---\n"
+            continue
         sources_text += f"""
 ### Source {i}
 **Product:** {meta.get('product')}
@@ -37,8 +53,36 @@ def ask_question(question):
 > {src['text'][:500]}...
 ---
 """
+    return sources_text
+
+
+async def ask_question(question, product=ALL, state=ALL):
+    """
+    Handles user question and streams answer + sources.
+
+    Sources are shown as soon as retrieval finishes; the answer then fills in
+    token by token. If the user leaves, generation is cancelled.
+    """
+    if not question.strip():
+        yield "Please enter a question.", ""
+        return
 
-    return answer, sources_text
+    answer = ""
+    sources_text = ""
+    try:
+        async for event in core.query_stream(question, k=3, where=build_filter(product, state)):
+            if event["type"] == "sources":
+                sources_text = format_sources(event["sources"])
+            elif event["type"] == "token":
+                answer += event["text"]
+            elif event["type"] == "done":
+                answer = event["answer"]
+            yield answer, sources_text
+    except ServiceBusy as e:
+        if not rag.ready:
+            yield "The models are still warming up. Please try again in a few seconds.", ""
+        else:
+            yield f"The assistant is busy ({e}). Please try again shortly.", ""
 
 
 def clear_chat():
@@ -59,6 +103,10 @@ with gr.Blocks(title="CFPB Complaint Analysis Assistant") as demo:
         placeholder="e.g. What problems do customers report with credit cards?"
     )
 
+    with gr.Row():
+        product_filter = gr.Dropdown(choices=PRODUCT_CHOICES, value=ALL, label="Product")
+        state_filter = gr.Dropdown(choices=STATE_CHOICES, value=ALL, label="State")
+
     ask_btn = gr.Button("Ask")
     clear_btn = gr.Button("Clear")
 
@@ -73,7 +121,7 @@ with gr.Blocks(title="CFPB Complaint Analysis Assistant") as demo:
 
     ask_btn.click(
         fn=ask_question,
-        inputs=question_input,
+        inputs=[question_input, product_filter, state_filter],
         outputs=[answer_output, sources_output]
     )
 
@@ -84,4 +132,4 @@ with gr.Blocks(title="CFPB Complaint Analysis Assistant") as demo:
 
 # Run app
 if __name__ == "__main__":
-    demo.launch()
+    demo.queue().launch()  # queue() is required for streaming generator outputs
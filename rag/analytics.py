@@ -0,0 +1,272 @@
+# rag/analytics.py
+import logging
+import re
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from .lexical_index import tokenize
+
+CUBE_FIELDS = ["product", "issue", "company", "state"]
+TIME_FIELD = "month"  # date_received bucketed to YYYY-MM
+ANALYTICS_FILE = "analytics_cube.parquet"  # one row per (facets, month) cell with its complaint count
+TOP_N = 5
+
+# Explicit requests for counts: may be answered from the cube alone
+COUNT_PATTERN = re.compile(
+    r"\b(how many|number of|count of|most common|most frequent|most reported|most complaints|top \d+)\b",
+    re.IGNORECASE
+)
+# Looser phrasings that suggest counts would help; these only add the counts as context
+AGGREGATE_PATTERN = re.compile(
+    r"\b(counts? by|breakdown (?:by|of)|distribution (?:by|of)|trends? (?:in|of)|over time|per month|by month|"
+    r"monthly|fewest)\b",
+    re.IGNORECASE
+)
+# Words naming the dimension to group by, checked in this order
+GROUP_WORDS = {
+    TIME_FIELD: ("trend", "trends", "month", "monthly", "time"),
+    "issue": ("issue", "issues", "problem", "problems"),
+    "company": ("company", "companies", "bank", "banks", "lender", "lenders", "firm", "firms"),
+    "state": ("state", "states"),
+    "product": ("product", "products")
+}
+TOP_PATTERN = re.compile(r"\btop (\d+)\b", re.IGNORECASE)
+YEAR_PATTERN = re.compile(r"\b((?:19|20)\d{2})\b")
+STATE_PATTERN = re.compile(r"\b([A-Z]{2})\b")
+ISO_DATE = re.compile(r"^(\d{4})-(\d{1,2})")
+US_DATE = re.compile(r"^(\d{1,2})/\d{1,2}/(\d{2,4})")
+# Dropped from company names before matching ("Capital One Financial Corporation" -> "capital one")
+COMPANY_SUFFIXES = {"inc", "corp", "corporation", "co", "company", "na", "llc", "ltd", "financial", "holdings",
+                    "group", "services", "bank", "national", "association"}
+
+
+def _month(date_received: Any) -> Optional[str]:
+    """``YYYY-MM`` bucket of an ISO (2023-05-12) or US (05/12/2023) date string."""
+    text = str(date_received or "").strip()
+    match = ISO_DATE.match(text)
+    if match:
+        return f"{match.group(1)}-{int(match.group(2)):02d}"
+    match = US_DATE.match(text)
+    if match:
+        year = match.group(2)
+        year = year if len(year) == 4 else f"20{year}"
+        return f"{year}-{int(match.group(1)):02d}"
+    return None
+
+
+def _value(metadata: Dict[str, Any], field: str) -> Optional[str]:
+    value = metadata.get(field)
+    if value is None or str(value) in ("", "nan"):
+        return None
+    return str(value)
+
+
+def _terms(text: str) -> set:
+    """Singularized content tokens, so "credit cards" matches "Credit card"."""
+    return {token[:-1] if len(token) > 3 and token.endswith("s") else token for token in tokenize(text)}
+
+
+class AnalyticsCubeBuilder:
+    """
+    Accumulates complaint counts per (product, issue, company, state, month)
+    cell from chunk metadata and writes them as a small Parquet table.
+
+    Counts are of complaints, not chunks: every chunk after the first one seen
+    for a complaint id is ignored.
+    """
+
+    def __init__(self):
+        self.cells: Counter = Counter()
+        self._seen: set = set()
+
+    def add(self, metadatas: Iterable[Optional[Dict[str, Any]]]) -> None:
+        for metadata in metadatas:
+            metadata = metadata or {}
+            complaint_id = metadata.get("complaint_id")
+            if complaint_id is not None:
+                if complaint_id in self._seen:
+                    continue
+                self._seen.add(complaint_id)
+            elif int(metadata.get("chunk_index", 0) or 0) != 0:
+                continue
+            cell = tuple(_value(metadata, field) for field in CUBE_FIELDS) + (_month(metadata.get("date_received")),)
+            self.cells[cell] += 1
+
+    @property
+    def complaints(self) -> int:
+        return sum(self.cells.values())
+
+    def write(self, directory: str) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        directory = Path(directory)
+        cells = sorted(self.cells.items(), key=lambda item: tuple(v or "" for v in item[0]))
+        fields = CUBE_FIELDS + [TIME_FIELD]
+        columns = {field: [cell[i] for cell, _ in cells] for i, field in enumerate(fields)}
+        columns["complaints"] = [count for _, count in cells]
+        schema = pa.schema([(field, pa.string()) for field in fields] + [("complaints", pa.int64())])
+
+        tmp_path = directory / (ANALYTICS_FILE + ".tmp")
+        pq.write_table(pa.table(columns, schema=schema), tmp_path, compression="zstd")
+        tmp_path.replace(directory / ANALYTICS_FILE)
+
+
+class AnalyticsCube:
+    """
+    Exact complaint counts by facet and month, answered from the pre-aggregated
+    cube written at ingest time. The cube has one row per non-empty cell, so
+    any roll-up is a group-by over a few thousand rows instead of a scan of
+    the chunks.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self._table = None
+        self._value_terms: Dict[str, List[Tuple[str, set]]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["AnalyticsCube"]:
+        if not (Path(directory) / ANALYTICS_FILE).exists():
+            return None
+        return cls(directory)
+
+    @property
+    def table(self):
+        with self._lock:
+            if self._table is None:
+                import pyarrow.parquet as pq
+
+                self._table = pq.read_table(self.directory / ANALYTICS_FILE).to_pandas()
+                logging.info(f"Loaded analytics cube with {len(self._table)} cells, "
+                             f"{int(self._table['complaints'].sum())} complaints")
+            return self._table
+
+    def values(self, field: str) -> List[str]:
+        """Values of ``field``, most complaints first."""
+        return list(self.table.groupby(field)["complaints"].sum().sort_values(ascending=False).index)
+
+    def aggregate(self, group_by: Optional[str] = None, where: Optional[Dict[str, str]] = None,
+                  years: Optional[List[str]] = None, top: int = TOP_N) -> Dict[str, Any]:
+        """
+        Complaint counts matching ``where`` (facet equality) and ``years``,
+        in total and per ``group_by`` value: the ``top`` largest groups, or
+        every month in order when grouping by month.
+        """
+        table = self.table
+        mask = None
+        for field, value in (where or {}).items():
+            condition = table[field] == str(value)
+            mask = condition if mask is None else mask & condition
+        if years:
+            condition = table[TIME_FIELD].str[:4].isin(years)
+            mask = condition if mask is None else mask & condition
+        selected = table if mask is None else table[mask]
+
+        result: Dict[str, Any] = {
+            "group_by": group_by,
+            "where": dict(where or {}),
+            "years": list(years or []),
+            "total": int(selected["complaints"].sum()),
+            "groups": []
+        }
+        if group_by:
+            counts = selected.groupby(group_by)["complaints"].sum()
+            counts = counts.sort_index() if group_by == TIME_FIELD else counts.sort_values(ascending=False).head(top)
+            result["groups"] = [(str(value), int(count)) for value, count in counts.items()]
+        return result
+
+    # Question handling
+
+    def _terms_of(self, field: str) -> List[Tuple[str, set]]:
+        """(value, match terms) for every value of ``field``, computed once."""
+        if field not in self._value_terms:
+            pairs = [(value, _terms(value)) for value in self.values(field)]
+            if field == "company":
+                pairs = [(value, terms - COMPANY_SUFFIXES) for value, terms in pairs]
+            self._value_terms[field] = pairs
+        return self._value_terms[field]
+
+    def _match_values(self, question: str, field: str) -> Optional[str]:
+        """The most specific ``field`` value named in the question, if any."""
+        question_terms = _terms(question)
+        best: Optional[Tuple[int, str]] = None
+        for value, terms in self._terms_of(field):
+            matched = terms & question_terms
+            # Products are often named loosely ("credit cards" for "Credit card or prepaid card")
+            loose = field == "product" and len(matched) >= 2 and 2 * len(matched) >= len(terms)
+            if terms and (matched == terms or loose) and (best is None or len(matched) > best[0]):
+                best = (len(matched), value)
+        return best[1] if best else None
+
+    def parse(self, question: str) -> Optional[Dict[str, Any]]:
+        """
+        Read an aggregate question ("What are the most common issues with
+        credit cards?") into ``aggregate`` arguments plus ``explicit``, or
+        None for questions about what complaints say. Filters are facet values
+        named in the question (two-letter state codes must be upper case) and
+        years. The question must name a dimension or a filter; ``explicit``
+        is True when it also asks for counts outright ("how many", "most
+        common"), i.e. when the counts alone are a complete answer.
+        """
+        explicit = bool(COUNT_PATTERN.search(question))
+        if not explicit and not AGGREGATE_PATTERN.search(question):
+            return None
+
+        where: Dict[str, str] = {}
+        for field in ("product", "company"):
+            value = self._match_values(question, field)
+            if value is not None:
+                where[field] = value
+        states = {value for value, _ in self._terms_of("state")}
+        state = next((code for code in STATE_PATTERN.findall(question) if code in states), None)
+        if state and not question.isupper():
+            where["state"] = state
+
+        # Group by the first dimension the question names, unless it names a value of it ("Bank of America")
+        group_by = None
+        for word in re.findall(r"[a-z]+", question.lower()):
+            group_by = next((field for field, names in GROUP_WORDS.items() if word in names), None)
+            if group_by is not None:
+                break
+        if group_by in where:
+            group_by = None
+
+        years = sorted(set(YEAR_PATTERN.findall(question)))
+        if group_by is None and not where and not years:
+            return None
+        top = TOP_PATTERN.search(question)
+        return {
+            "explicit": explicit,
+            "group_by": group_by,
+            "where": where,
+            "years": years,
+            "top": int(top.group(1)) if top else TOP_N
+        }
+
+    @staticmethod
+    def describe(result: Dict[str, Any]) -> str:
+        """Plain-text summary of an ``aggregate`` result, usable as an answer or as prompt context."""
+        scope = [f"{field} {value}" for field, value in result["where"].items()]
+        if result["years"]:
+            scope.append("received in " + ", ".join(result["years"]))
+        scope_text = f" ({'; '.join(scope)})" if scope else ""
+        total = result["total"]
+        if not total:
+            return f"No complaints in the indexed data match{scope_text or ' this question'}."
+
+        lines = [f"{total:,} complaints in the indexed data{scope_text}."]
+        if result["group_by"] == TIME_FIELD:
+            lines.append("Complaints per month:")
+            lines.extend(f"{month}: {count:,}" for month, count in result["groups"])
+        elif result["group_by"]:
+            plural = {"company": "companies"}.get(result["group_by"], result["group_by"] + "s")
+            lines.append(f"Most common {plural}:")
+            lines.extend(
+                f"{rank}. {value}: {count:,} ({100 * count / total:.1f}%)"
+                for rank, (value, count) in enumerate(result["groups"], start=1)
+            )
+        return "\n".join(lines)
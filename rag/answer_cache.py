@@ -0,0 +1,89 @@
+# rag/answer_cache.py
+from typing import List, Dict, Any, Optional
+from collections import OrderedDict
+import threading
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """
+    Bounded cache of generated answers keyed by question embedding.
+
+    A lookup hits when a cached question is within ``threshold`` cosine
+    similarity of the new one *and* retrieval returned the same source ids,
+    so paraphrases reuse an answer only when it would be grounded in the
+    same context. Least recently used entries are evicted first.
+    """
+
+    def __init__(self, max_entries: int = 256, threshold: float = 0.95):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._next_key = 0
+        self._matrix: Optional[np.ndarray] = None
+        self._matrix_keys: List[int] = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _rebuild_matrix(self) -> None:
+        self._matrix_keys = list(self._entries.keys())
+        if self._matrix_keys:
+            self._matrix = np.stack([self._entries[k]["embedding"] for k in self._matrix_keys])
+        else:
+            self._matrix = None
+
+    def get(self, embedding, source_ids: List[str]) -> Optional[Dict[str, Any]]:
+        """Return the cached response for a similar question with the same sources, if any."""
+        query = self._normalize(embedding)
+        with self._lock:
+            if self._matrix is None or len(self._matrix_keys) != len(self._entries):
+                self._rebuild_matrix()
+            if self._matrix is not None:
+                similarities = self._matrix @ query
+                for idx in np.argsort(-similarities):
+                    if similarities[idx] < self.threshold:
+                        break
+                    key = self._matrix_keys[idx]
+                    entry = self._entries.get(key)
+                    if entry is not None and entry["source_ids"] == list(source_ids):
+                        self._entries.move_to_end(key)
+                        self.hits += 1
+                        return entry["response"]
+            self.misses += 1
+            return None
+
+    def put(self, embedding, source_ids: List[str], response: Dict[str, Any]) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[self._next_key] = {
+                "embedding": self._normalize(embedding),
+                "source_ids": list(source_ids),
+                "response": response
+            }
+            self._next_key += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
@@ -0,0 +1,89 @@
+# rag/benchmark_hybrid.py
+import argparse
+import json
+import random
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from .retriever import Retriever
+from .evaluation import TEST_QUESTIONS
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare vector-only and hybrid (BM25 + vector) retrieval latency.")
+    parser.add_argument("--chroma-dir", default="vector_store/chroma")
+    parser.add_argument("--queries", type=int, default=200, help="Number of benchmark queries")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark_hybrid.json", help="Where to write the JSON results")
+    return parser.parse_args(argv)
+
+
+def sample_queries(retriever: Retriever, n: int, seed: int = 42) -> List[str]:
+    """TEST_QUESTIONS plus short snippets taken from random chunks in the collection."""
+    rng = random.Random(seed)
+    total = retriever.collection.count()
+    queries = list(TEST_QUESTIONS)
+    while len(queries) < n and total:
+        page = retriever.collection.get(limit=50, offset=rng.randrange(max(1, total - 50)), include=["documents"])
+        for document in page["documents"]:
+            words = (document or "").split()
+            if len(words) >= 8:
+                start = rng.randrange(len(words) - 7)
+                queries.append(" ".join(words[start:start + 8]))
+    return queries[:n]
+
+
+def time_calls(fn: Callable[[str], object], queries: List[str]) -> Dict[str, float]:
+    """Latency percentiles in milliseconds for calling ``fn`` on each query."""
+    for query in queries[:5]:
+        fn(query)  # warm-up
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        fn(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+    latencies = np.asarray(latencies)
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "mean_ms": float(latencies.mean())
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Caching disabled so every call pays for a real search
+    retriever = Retriever(chroma_dir=args.chroma_dir, cache_size=0)
+    if retriever.lexical is None:
+        print("No lexical index found; rebuild the store with rag.build_chroma_store first.")
+        return 1
+
+    queries = sample_queries(retriever, args.queries, args.seed)
+    print(f"Benchmarking {len(queries)} queries over {retriever.collection.count()} chunks...")
+
+    results = {
+        "queries": len(queries),
+        "top_k": args.top_k,
+        "vector": time_calls(lambda q: retriever.retrieve(q, args.top_k, mode="vector"), queries),
+        "bm25_only": time_calls(lambda q: retriever.lexical.search(q, args.top_k), queries),
+        "hybrid": time_calls(lambda q: retriever.retrieve(q, args.top_k, mode="hybrid"), queries)
+    }
+    results["hybrid_p95_overhead_ms"] = results["hybrid"]["p95_ms"] - results["vector"]["p95_ms"]
+
+    for name in ("vector", "bm25_only", "hybrid"):
+        stats = results[name]
+        print(f"{name:>10}: p50 {stats['p50_ms']:.1f} ms  p95 {stats['p95_ms']:.1f} ms  p99 {stats['p99_ms']:.1f} ms")
+    print(f"Hybrid p95 overhead: {results['hybrid_p95_overhead_ms']:.1f} ms")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,86 @@
+# rag/benchmark_prefix_cache.py
+import argparse
+import json
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from .evaluation import TEST_QUESTIONS
+from .generator import Generator, PROMPT_PREFIX
+from .retriever import Retriever
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare time-to-first-token with and without prompt prefix caching.")
+    parser.add_argument("--chroma-dir", default="vector_store/chroma")
+    parser.add_argument("--preset", default="qwen2.5-0.5b", help="Generator preset (see rag.generator_backends.PRESETS)")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=3, help="Passes over the benchmark questions per mode")
+    parser.add_argument("--max-new-tokens", type=int, default=8)
+    parser.add_argument("--output", default="benchmark_prefix_cache.json", help="Where to write the JSON results")
+    return parser.parse_args(argv)
+
+
+def time_to_first_token(generator: Generator, prompts: List[str], rounds: int, max_new_tokens: int) -> Dict[str, float]:
+    """TTFT percentiles in milliseconds for streaming each prompt ``rounds`` times."""
+    for _ in generator.backend.stream(prompts[0], max_new_tokens=1):  # warm-up
+        pass
+    latencies = []
+    for _ in range(rounds):
+        for prompt in prompts:
+            start = time.perf_counter()
+            stream = generator.backend.stream(prompt, max_new_tokens=max_new_tokens)
+            next(stream, None)
+            latencies.append((time.perf_counter() - start) * 1000)
+            for _ in stream:  # let the worker thread finish before the next prompt
+                pass
+    latencies = np.asarray(latencies)
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "mean_ms": float(latencies.mean())
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    retriever = Retriever(chroma_dir=args.chroma_dir, cache_size=0)
+    generator = Generator(preset=args.preset, prefix_cache=False)
+
+    prompts = [
+        generator.format_prompt(question, retriever.retrieve(question, args.top_k))
+        for question in TEST_QUESTIONS
+    ]
+    prefix_tokens = generator.backend.count_tokens(PROMPT_PREFIX)
+    prompt_tokens = [generator.backend.count_tokens(p) for p in prompts]
+    print(f"Benchmarking {len(prompts)} prompts ({np.mean(prompt_tokens):.0f} tokens on average, "
+          f"{prefix_tokens}-token prefix) with {generator.model_name}...")
+
+    results = {
+        "model": generator.model_name,
+        "prompts": len(prompts),
+        "avg_prompt_tokens": float(np.mean(prompt_tokens)),
+        "prefix_tokens": prefix_tokens,
+        "without_prefix_cache": time_to_first_token(generator, prompts, args.rounds, args.max_new_tokens)
+    }
+    if not generator.backend.enable_prefix_cache(PROMPT_PREFIX):
+        print(f"The {generator.backend.name} backend does not support prefix caching.")
+        return 1
+    results["with_prefix_cache"] = time_to_first_token(generator, prompts, args.rounds, args.max_new_tokens)
+    results["backend"] = generator.backend.report()
+    results["p50_saving_ms"] = results["without_prefix_cache"]["p50_ms"] - results["with_prefix_cache"]["p50_ms"]
+
+    for name in ("without_prefix_cache", "with_prefix_cache"):
+        stats = results[name]
+        print(f"{name:>21}: TTFT p50 {stats['p50_ms']:.1f} ms  p95 {stats['p95_ms']:.1f} ms")
+    print(f"Median TTFT saving: {results['p50_saving_ms']:.1f} ms")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
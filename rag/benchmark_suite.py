@@ -0,0 +1,231 @@
+# rag/benchmark_suite.py
+import argparse
+import json
+import math
+import os
+import random
+import time
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+LABEL_FIELDS = ("product", "issue")  # A source is relevant when both match the query's labels
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Retrieval quality (recall@k, MRR, nDCG) and per-stage latency benchmark."
+    )
+    parser.add_argument("--chroma-dir", default="vector_store/chroma")
+    parser.add_argument("--model-name", default="all-MiniLM-L6-v2", help="Embedding model")
+    parser.add_argument("--search-mode", default="vector", choices=["vector", "hybrid"])
+    parser.add_argument("--vector-backend", default="chroma",
+                        help="chroma, matrix, matrix-float16, matrix-int8, faiss-ivf or faiss-hnsw")
+    parser.add_argument("--queries", type=int, default=200, help="Number of labelled queries")
+    parser.add_argument("--query-style", default="both", choices=["template", "snippet", "both"],
+                        help="Queries written from the labels, sampled from chunk text, or half of each")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--rerank", action="store_true", help="Also benchmark the cross-encoder stage")
+    parser.add_argument("--rerank-candidates", type=int, default=50)
+    parser.add_argument("--generator", default="stub", help="Generator preset; 'stub' keeps the run offline")
+    parser.add_argument("--generate-queries", type=int, default=50, help="Queries sent through generation")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark_suite.json", help="Where to write the JSON results")
+    parser.add_argument("--baseline", help="Earlier results JSON to print deltas against")
+    parser.add_argument("--online", action="store_true", help="Allow Hugging Face Hub downloads")
+    return parser.parse_args(argv)
+
+
+def build_query_set(collection, n: int, style: str = "both", seed: int = 42) -> List[Dict[str, Any]]:
+    """
+    Labelled queries sampled from the collection: each carries the ``product``
+    and ``issue`` of the chunk it was made from, and the number of chunks in
+    the store sharing those labels (the recall denominator).
+    """
+    from .facets import to_chroma_where
+
+    rng = random.Random(seed)
+    total = collection.count()
+    queries: List[Dict[str, Any]] = []
+    attempts = 0
+    while len(queries) < n and total and attempts < n * 10:
+        attempts += 1
+        page = collection.get(limit=20, offset=rng.randrange(max(1, total - 20)), include=["documents", "metadatas"])
+        for document, metadata in zip(page["documents"], page["metadatas"]):
+            labels = {field: (metadata or {}).get(field) for field in LABEL_FIELDS}
+            if not all(labels.values()):
+                continue
+            words = (document or "").split()
+            use_snippet = style == "snippet" or (style == "both" and len(queries) % 2 == 1)
+            if use_snippet:
+                if len(words) < 12:
+                    continue
+                start = rng.randrange(len(words) - 11)
+                text = " ".join(words[start:start + 12])
+            else:
+                text = f"{labels['issue']} with {labels['product']}"
+            queries.append({"query": text, "style": "snippet" if use_snippet else "template", "labels": labels})
+            if len(queries) >= n:
+                break
+
+    # Relevant-set sizes, one metadata lookup per distinct label pair
+    sizes: Dict[tuple, int] = {}
+    for item in queries:
+        key = tuple(item["labels"][field] for field in LABEL_FIELDS)
+        if key not in sizes:
+            sizes[key] = len(collection.get(where=to_chroma_where(item["labels"]), include=[])["ids"])
+        item["num_relevant"] = max(1, sizes[key])
+    return queries
+
+
+def is_relevant(source: Dict[str, Any], labels: Dict[str, str]) -> bool:
+    metadata = source.get("metadata") or {}
+    return all(str(metadata.get(field)) == str(value) for field, value in labels.items())
+
+
+def ranking_metrics(relevance: List[bool], k: int, num_relevant: int) -> Dict[str, float]:
+    """recall@k, reciprocal rank and nDCG@k for one ranked list of binary relevance flags."""
+    relevance = relevance[:k]
+    hits = sum(relevance)
+    first = next((rank for rank, rel in enumerate(relevance, start=1) if rel), None)
+    dcg = sum(1.0 / math.log2(rank + 1) for rank, rel in enumerate(relevance, start=1) if rel)
+    ideal = sum(1.0 / math.log2(rank + 1) for rank in range(1, min(k, num_relevant) + 1))
+    return {
+        "recall": hits / min(k, num_relevant),
+        "rr": 1.0 / first if first else 0.0,
+        "ndcg": dcg / ideal if ideal else 0.0
+    }
+
+
+def quality(rankings: List[List[Dict[str, Any]]], queries: List[Dict[str, Any]], k: int) -> Dict[str, Any]:
+    """Mean recall@k, MRR and nDCG@k over the query set, overall and per query style."""
+    per_query = [
+        ranking_metrics([is_relevant(s, q["labels"]) for s in ranking], k, q["num_relevant"])
+        for ranking, q in zip(rankings, queries)
+    ]
+
+    def mean(rows):
+        return {
+            f"recall@{k}": float(np.mean([r["recall"] for r in rows])) if rows else 0.0,
+            "mrr": float(np.mean([r["rr"] for r in rows])) if rows else 0.0,
+            f"ndcg@{k}": float(np.mean([r["ndcg"] for r in rows])) if rows else 0.0
+        }
+
+    result = mean(per_query)
+    for style in sorted({q["style"] for q in queries}):
+        result[style] = mean([r for r, q in zip(per_query, queries) if q["style"] == style])
+    return result
+
+
+def latency(latencies_ms: List[float], wall_seconds: float) -> Dict[str, float]:
+    values = np.asarray(latencies_ms)
+    return {
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "mean_ms": float(values.mean()),
+        "throughput_qps": len(values) / wall_seconds if wall_seconds else 0.0
+    }
+
+
+def run_stage(fn: Callable[[Any], Any], inputs: List[Any], warm_up: int = 3) -> Dict[str, Any]:
+    """Call ``fn`` on every input sequentially; return outputs and latency stats."""
+    for item in inputs[:warm_up]:
+        fn(item)
+    outputs, latencies = [], []
+    wall = time.perf_counter()
+    for item in inputs:
+        start = time.perf_counter()
+        outputs.append(fn(item))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {"outputs": outputs, "latency": latency(latencies, time.perf_counter() - wall)}
+
+
+def print_deltas(results: Dict[str, Any], baseline_path: str) -> None:
+    """Print quality and p95 changes against an earlier results file."""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\nChanges vs {baseline_path}:")
+    for stage in ("retrieval", "rerank"):
+        new, old = results.get(stage, {}).get("quality", {}), baseline.get(stage, {}).get("quality", {})
+        for metric, value in new.items():
+            if isinstance(value, float) and isinstance(old.get(metric), float):
+                print(f"  {stage} {metric}: {old[metric]:.4f} -> {value:.4f} ({value - old[metric]:+.4f})")
+    for stage in ("retrieval", "retrieval_batched", "rerank", "generation"):
+        new, old = results.get(stage, {}).get("latency", {}), baseline.get(stage, {}).get("latency", {})
+        if "p95_ms" in new and "p95_ms" in old:
+            print(f"  {stage} p95: {old['p95_ms']:.1f} -> {new['p95_ms']:.1f} ms ({new['p95_ms'] - old['p95_ms']:+.1f})")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.online:
+        # Embedding (and cross-encoder) models must already be in the local cache
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+        os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+    from .generator import Generator
+    from .reranker import Reranker
+    from .retriever import Retriever
+
+    # Caching disabled so every query pays for a real search
+    retriever = Retriever(chroma_dir=args.chroma_dir, model_name=args.model_name, cache_size=0,
+                          search_mode=args.search_mode, vector_backend=args.vector_backend)
+    queries = build_query_set(retriever.collection, args.queries, args.query_style, args.seed)
+    if not queries:
+        print("No labelled chunks found; build the store with rag.build_chroma_store first.")
+        return 1
+    texts = [q["query"] for q in queries]
+    fetch_k = max(args.k, args.rerank_candidates) if args.rerank else args.k
+    print(f"Benchmarking {len(queries)} queries over {retriever.collection.count()} chunks "
+          f"({args.search_mode}, {args.vector_backend}, k={args.k})...")
+
+    results: Dict[str, Any] = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "chunks": retriever.collection.count(),
+        "queries": len(queries)
+    }
+
+    retrieval = run_stage(lambda q: retriever.retrieve(q, fetch_k), texts)
+    results["retrieval"] = {"latency": retrieval["latency"], "quality": quality(retrieval["outputs"], queries, args.k)}
+
+    wall = time.perf_counter()
+    retriever.retrieve_many(texts, fetch_k)
+    seconds = time.perf_counter() - wall
+    results["retrieval_batched"] = {"latency": {"seconds": seconds, "throughput_qps": len(texts) / seconds}}
+
+    sources = retrieval["outputs"]
+    if args.rerank:
+        reranker = Reranker()
+        rerank = run_stage(lambda i: reranker.rerank(texts[i], list(retrieval["outputs"][i]), args.k)[0],
+                           list(range(len(texts))))
+        results["rerank"] = {"latency": rerank["latency"], "quality": quality(rerank["outputs"], queries, args.k)}
+        sources = rerank["outputs"]
+
+    generator = Generator(preset=args.generator)
+    n = min(args.generate_queries, len(texts))
+    generation = run_stage(lambda i: generator.generate_response(texts[i], sources[i][:3]), list(range(n)), warm_up=1)
+    results["generation"] = {"latency": generation["latency"], "backend": generator.report()}
+
+    for stage in ("retrieval", "rerank"):
+        if stage in results:
+            q = results[stage]["quality"]
+            print(f"{stage:>10}: recall@{args.k} {q[f'recall@{args.k}']:.3f}  MRR {q['mrr']:.3f}  "
+                  f"nDCG@{args.k} {q[f'ndcg@{args.k}']:.3f}")
+    for stage in ("retrieval", "rerank", "generation"):
+        if stage in results:
+            stats = results[stage]["latency"]
+            print(f"{stage:>10}: p50 {stats['p50_ms']:.1f} ms  p95 {stats['p95_ms']:.1f} ms  "
+                  f"p99 {stats['p99_ms']:.1f} ms  {stats['throughput_qps']:.1f} q/s")
+    print(f"   batched: {results['retrieval_batched']['latency']['throughput_qps']:.1f} q/s")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}")
+    if args.baseline:
+        print_deltas(results, args.baseline)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
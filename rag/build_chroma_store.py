@@ -1,5 +1,12 @@
 # rag/build_chroma_store.py
 import os
+import json
+import hashlib
+import argparse
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
 import pyarrow.parquet as pq
 import chromadb
 from chromadb.config import Settings
@@ -7,84 +14,447 @@ from pathlib import Path
 from tqdm import tqdm
 import numpy as np
 import time
+from .analytics import ANALYTICS_FILE, AnalyticsCubeBuilder
+from .cache import bump_store_version, read_store_version
+from .facets import write_facets
+from .lexical_index import LEXICAL_DIR, LexicalIndexBuilder
+from .vector_backends import COMPACT_FILES, FAISS_FILES, INDEX_DIR, MATRIX_FILE, build_index
 
 # Configuration
 PARQUET_PATH = "data/raw/complaint_embeddings.parquet"
 CHROMA_DIR = "vector_store/chroma"
+COLLECTION_NAME = "cfpb_complaints"
 BATCH_SIZE = 1000  # Process in batches to manage memory
+DECODE_WORKERS = 2  # Threads preparing Arrow batches for insertion
+QUEUE_DEPTH = 4  # Prepared batches allowed to wait for the writer
+CHECKPOINT_FILE = "ingest_checkpoint.json"
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"  # Only used by --sync when the export has no embeddings
 
-def main():
-    print("Building Chroma vector store...")
-    
-    # Create output directory if it doesn't exist
-    Path(CHROMA_DIR).mkdir(parents=True, exist_ok=True)
-    
-    # Initialize Chroma client
-    print("Initializing Chroma client...")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build the Chroma vector store from complaint embeddings.")
+    parser.add_argument("--parquet", default=PARQUET_PATH, help="Path to complaint_embeddings.parquet")
+    parser.add_argument("--chroma-dir", default=CHROMA_DIR, help="Chroma persistence directory")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Rows per Parquet batch")
+    parser.add_argument("--workers", type=int, default=DECODE_WORKERS, help="Decode worker threads")
+    parser.add_argument("--queue-depth", type=int, default=QUEUE_DEPTH,
+                        help="Maximum prepared batches waiting for the writer")
+    parser.add_argument("--compact-vectors", nargs="*", choices=list(COMPACT_FILES), default=[],
+                        help="Also write float16 and/or int8 vector copies for the matrix-<precision> retriever backends")
+    parser.add_argument("--index-dir", default=INDEX_DIR, help="Where --compact-vectors writes the matrix index")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--reset", action="store_true",
+                      help="Drop the existing collection and checkpoint, then rebuild from scratch")
+    mode.add_argument("--append", action="store_true",
+                      help="Keep the existing collection and resume from the last checkpoint")
+    mode.add_argument("--sync", action="store_true",
+                      help="Incrementally upsert new/changed chunks and delete withdrawn ones")
+    return parser.parse_args(argv)
+
+
+def open_collection(chroma_dir: str, reset: bool = False):
+    """Open (or create) the complaints collection, optionally resetting it first."""
     client = chromadb.PersistentClient(
-        path=CHROMA_DIR,
+        path=chroma_dir,
         settings=Settings(
             anonymized_telemetry=False,
             allow_reset=True
         )
     )
-    
-    # Create or get collection
-    print("Setting up collection...")
+    if reset:
+        client.reset()
     collection = client.get_or_create_collection(
-        name="cfpb_complaints",
+        name=COLLECTION_NAME,
         metadata={"hnsw:space": "cosine"}  # Using cosine similarity
     )
-    
+    return client, collection
+
+
+def load_checkpoint(path: Path, parquet_path: str, num_rows: int) -> int:
+    """Return the number of rows already committed for this Parquet file."""
+    if not path.exists():
+        return 0
+    with open(path, "r", encoding="utf-8") as f:
+        state = json.load(f)
+    if state.get("parquet_path") != os.path.abspath(parquet_path) or state.get("num_rows") != num_rows:
+        print("Checkpoint belongs to a different Parquet file, ignoring it.")
+        return 0
+    return int(state.get("rows_committed", 0))
+
+
+def save_checkpoint(path: Path, parquet_path: str, num_rows: int, rows_committed: int) -> None:
+    """Atomically record how many rows have been committed to the collection."""
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "parquet_path": os.path.abspath(parquet_path),
+            "num_rows": num_rows,
+            "rows_committed": rows_committed,
+            "updated_at": time.time()
+        }, f)
+    os.replace(tmp_path, path)
+
+
+def iter_parquet_batches(parquet_file: pq.ParquetFile, batch_size: int, start_row: int = 0, columns=None):
+    """
+    Yield (row_offset, RecordBatch) pairs starting at ``start_row``, optionally
+    reading only ``columns``.
+
+    Row groups that end before ``start_row`` are skipped without being read.
+    """
+    metadata = parquet_file.metadata
+    first_group = 0
+    group_start = 0
+    while first_group < metadata.num_row_groups:
+        group_rows = metadata.row_group(first_group).num_rows
+        if group_start + group_rows > start_row:
+            break
+        group_start += group_rows
+        first_group += 1
+
+    row_groups = list(range(first_group, metadata.num_row_groups))
+    if not row_groups:
+        return
+
+    offset = group_start
+    for batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups, columns=columns):
+        if offset + batch.num_rows <= start_row:
+            offset += batch.num_rows
+            continue
+        if offset < start_row:
+            batch = batch.slice(start_row - offset)
+            offset = start_row
+        yield offset, batch
+        offset += batch.num_rows
+
+
+def embeddings_to_numpy(column: pa.Array) -> np.ndarray:
+    """Convert a list<float> Arrow column into a contiguous (rows, dim) float32 array."""
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    values = column.flatten().to_numpy(zero_copy_only=False)
+    values = np.ascontiguousarray(values, dtype=np.float32)
+    return values.reshape(len(column), -1)
+
+
+def chunk_id(document: str, metadata: dict, row: int) -> str:
+    """
+    Stable, content-addressed id: ``<complaint_id>-<chunk_index>-<hash>``.
+
+    The hash covers the chunk text and its metadata, so an edited chunk gets a
+    new id and the old one shows up as stale during ``--sync``. Rows without a
+    complaint_id fall back to their row position.
+    """
+    complaint_id = metadata.get("complaint_id") if metadata else None
+    if complaint_id is None:
+        return str(row)
+    digest = hashlib.sha1()
+    digest.update((document or "").encode("utf-8"))
+    digest.update(json.dumps(metadata, sort_keys=True, default=str).encode("utf-8"))
+    return f"{complaint_id}-{metadata.get('chunk_index', 0)}-{digest.hexdigest()[:16]}"
+
+
+def prepare_batch(offset: int, batch: pa.RecordBatch, keep=None) -> dict:
+    """
+    Turn one Arrow record batch into the arguments for ``collection.add``.
+
+    ``keep`` optionally filters rows by id; it receives the id and returns a bool.
+    Duplicate ids within the batch are dropped, since Chroma rejects them.
+    """
+    documents = batch.column("document").to_pylist()
+    metadatas = batch.column("metadata").to_pylist()
+    ids = [chunk_id(doc, meta, offset + i) for i, (doc, meta) in enumerate(zip(documents, metadatas))]
+
+    seen = set()
+    rows = []
+    for i, id_ in enumerate(ids):
+        if id_ in seen or (keep is not None and not keep(id_)):
+            continue
+        seen.add(id_)
+        rows.append(i)
+
+    prepared = {
+        "ids": [ids[i] for i in rows],
+        "documents": [documents[i] for i in rows],
+        "metadatas": [metadatas[i] for i in rows]
+    }
+    if "embedding" in batch.schema.names:
+        embeddings = embeddings_to_numpy(batch.column("embedding"))
+        prepared["embeddings"] = embeddings if len(rows) == batch.num_rows else embeddings[rows]
+    return prepared
+
+
+class StageStats:
+    """Row and busy-time counters for one stage of the ingest pipeline."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.rows = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, rows: int, seconds: float) -> None:
+        with self._lock:
+            self.rows += rows
+            self.seconds += seconds
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return f"{self.name}: {self.rows} rows in {self.seconds:.1f}s busy ({self.rows_per_second:,.0f} rows/s)"
+
+
+def _timed_prepare(offset: int, batch: pa.RecordBatch, stats: StageStats):
+    start = time.perf_counter()
+    prepared = prepare_batch(offset, batch)
+    stats.record(batch.num_rows, time.perf_counter() - start)
+    return batch.num_rows, prepared
+
+
+def _writer_loop(collection, work_queue: queue.Queue, stats: StageStats, on_commit, errors: list) -> None:
+    """Commit prepared batches to the collection in the order they were read."""
+    while True:
+        item = work_queue.get()
+        if item is None:
+            return
+        offset, future = item
+        try:
+            rows, prepared = future.result()
+            start = time.perf_counter()
+            if prepared["ids"]:
+                collection.add(**prepared)
+            stats.record(rows, time.perf_counter() - start)
+            on_commit(offset + rows, rows)
+        except Exception as e:
+            errors.append(e)
+            return
+
+
+def run_pipeline(collection, batches, on_commit, workers: int = DECODE_WORKERS, queue_depth: int = QUEUE_DEPTH):
+    """
+    Decode batches on worker threads while a single writer thread inserts them.
+
+    ``batches`` yields (row_offset, RecordBatch) pairs. ``on_commit(rows_committed, rows)``
+    is called from the writer thread after each successful insert. Returns the
+    decode and insert StageStats.
+    """
+    decode_stats = StageStats("decode")
+    insert_stats = StageStats("insert")
+    work_queue = queue.Queue(maxsize=max(1, queue_depth))
+    errors = []
+
+    writer = threading.Thread(
+        target=_writer_loop,
+        args=(collection, work_queue, insert_stats, on_commit, errors),
+        name="chroma-writer",
+        daemon=True
+    )
+    writer.start()
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="decode") as pool:
+        for offset, batch in batches:
+            future = pool.submit(_timed_prepare, offset, batch, decode_stats)
+            # Block while the queue is full, but stop feeding if the writer has died
+            while not errors:
+                try:
+                    work_queue.put((offset, future), timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+            if errors:
+                break
+        while writer.is_alive():
+            try:
+                work_queue.put(None, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+        writer.join()
+
+    if errors:
+        raise errors[0]
+    return decode_stats, insert_stats
+
+
+def build_side_indexes(parquet_file: pq.ParquetFile, chroma_dir: str, batch_size: int = BATCH_SIZE) -> None:
+    """
+    Write the facet index, the BM25 lexical index and the analytics cube for
+    the export in one pass (the embedding column is not read).
+    """
+    lexical = LexicalIndexBuilder()
+    cube = AnalyticsCubeBuilder()
+
+    def batches():
+        seen = set()
+        for offset, batch in iter_parquet_batches(parquet_file, batch_size, columns=["document", "metadata"]):
+            prepared = prepare_batch(offset, batch, keep=lambda id_: id_ not in seen)
+            seen.update(prepared["ids"])
+            lexical.add(prepared["ids"], prepared["documents"])
+            cube.add(prepared["metadatas"])
+            yield prepared["ids"], prepared["metadatas"]
+
+    print("Building facet, lexical and analytics indexes...")
+    counts = write_facets(batches(), chroma_dir)
+    print("Facet values: " + ", ".join(f"{field}={len(values)}" for field, values in counts.items()))
+    lexical.write(Path(chroma_dir) / LEXICAL_DIR)
+    print(f"Lexical index: {len(lexical.doc_ids)} chunks, {len(lexical.vocab)} terms")
+    cube.write(chroma_dir)
+    print(f"Analytics cube ({ANALYTICS_FILE}): {cube.complaints} complaints in {len(cube.cells)} cells")
+
+
+def existing_ids(collection, page_size: int = 10000) -> set:
+    """Fetch every id currently stored in the collection, without embeddings or documents."""
+    ids = set()
+    offset = 0
+    while True:
+        page = collection.get(include=[], limit=page_size, offset=offset)
+        if not page["ids"]:
+            return ids
+        ids.update(page["ids"])
+        offset += len(page["ids"])
+
+
+def sync_collection(collection, parquet_file: pq.ParquetFile, batch_size: int = BATCH_SIZE, on_change=None) -> dict:
+    """
+    Bring the collection in line with a fresh export.
+
+    Chunks whose content-addressed id is already stored are skipped; new or
+    changed chunks are upserted (embedded on the fly if the export has no
+    ``embedding`` column); ids no longer present in the export - withdrawn
+    complaints and the old versions of changed chunks - are deleted.
+    ``on_change`` is called after every write.
+    """
+    print("Listing ids already in the collection...")
+    stored = existing_ids(collection)
+    seen = set()
+    embedder = None
+    counts = {"unchanged": 0, "upserted": 0, "deleted": 0}
+
+    with tqdm(total=parquet_file.metadata.num_rows, desc="Syncing rows") as progress:
+        for offset, batch in iter_parquet_batches(parquet_file, batch_size):
+            prepared = prepare_batch(offset, batch, keep=lambda id_: id_ not in seen)
+            seen.update(prepared["ids"])
+            fresh = [i for i, id_ in enumerate(prepared["ids"]) if id_ not in stored]
+            counts["unchanged"] += len(prepared["ids"]) - len(fresh)
+            progress.update(batch.num_rows)
+            if not fresh:
+                continue
+
+            changed = {key: [values[i] for i in fresh] for key, values in prepared.items() if key != "embeddings"}
+            if "embeddings" in prepared:
+                changed["embeddings"] = prepared["embeddings"][fresh]
+            else:
+                if embedder is None:
+                    from sentence_transformers import SentenceTransformer
+                    embedder = SentenceTransformer(EMBEDDING_MODEL)
+                changed["embeddings"] = embedder.encode(changed["documents"], convert_to_numpy=True)
+            collection.upsert(**changed)
+            counts["upserted"] += len(fresh)
+            if on_change is not None:
+                on_change()
+
+    stale = list(stored - seen)
+    for i in range(0, len(stale), batch_size):
+        collection.delete(ids=stale[i:i + batch_size])
+    counts["deleted"] = len(stale)
+    if stale and on_change is not None:
+        on_change()
+    return counts
+
+
+def build_compact_vectors(args) -> None:
+    """
+    Write the mmap'd matrix plus its float16/int8 copies for the compact retriever
+    backends. Chroma keeps its own float32 HNSW copy either way; retrieval nodes
+    that use ``vector_backend="matrix-int8"`` only need the compact one in RAM.
+
+    An index already in ``args.index_dir`` is rebuilt after every ingest or
+    sync (with the compact copies and FAISS indexes it had), so it doesn't
+    fall behind the store.
+    """
+    index_dir = Path(args.index_dir)
+    if not args.compact_vectors and not (index_dir / MATRIX_FILE).exists():
+        return
+    compact = sorted(set(args.compact_vectors) | {p for p, name in COMPACT_FILES.items() if (index_dir / name).exists()})
+    faiss_kinds = [kind for kind, name in FAISS_FILES.items() if (index_dir / name).exists()]
+    dtype = str(np.load(index_dir / MATRIX_FILE, mmap_mode="r").dtype) if (index_dir / MATRIX_FILE).exists() else "float32"
+    print(f"Writing the matrix index ({', '.join(compact + faiss_kinds) or dtype}) to {args.index_dir}...")
+    build_index(args.parquet, args.index_dir, dtype, faiss_kinds, batch_size=args.batch_size * 10, compact=compact,
+                store_version=read_store_version(args.chroma_dir))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print("Building Chroma vector store...")
+
+    # Create output directory if it doesn't exist
+    Path(args.chroma_dir).mkdir(parents=True, exist_ok=True)
+    checkpoint_path = Path(args.chroma_dir) / CHECKPOINT_FILE
+
+    # Initialize Chroma client and collection
+    print("Initializing Chroma client...")
+    client, collection = open_collection(args.chroma_dir, reset=args.reset)
+    if args.reset:
+        checkpoint_path.unlink(missing_ok=True)
+        bump_store_version(args.chroma_dir)
+        print("Collection has been reset.")
+
+    if args.sync:
+        print(f"Syncing collection with {args.parquet}...")
+        # Every write bumps the store version, which running retrievers use to drop cached results
+        counts = sync_collection(collection, pq.ParquetFile(args.parquet), args.batch_size,
+                                 on_change=lambda: bump_store_version(args.chroma_dir))
+        print(f"\nSync complete: {counts['upserted']} upserted, {counts['deleted']} deleted, "
+              f"{counts['unchanged']} unchanged")
+        print(f"Collection now contains {collection.count()} documents")
+        build_side_indexes(pq.ParquetFile(args.parquet), args.chroma_dir, args.batch_size)
+        build_compact_vectors(args)
+        return
+
     # Check if collection is empty
-    if collection.count() > 0:
+    if collection.count() > 0 and not args.append:
         print(f"Collection already contains {collection.count()} documents.")
-        response = input("Do you want to reset the collection? (y/n): ")
-        if response.lower() == 'y':
-            client.reset()
-            collection = client.get_or_create_collection(
-                name="cfpb_complaints",
-                metadata={"hnsw:space": "cosine"}
-            )
-            print("Collection has been reset.")
-        else:
-            print("Using existing collection.")
-            return
-    
-    # Read parquet file
-    print(f"Reading data from {PARQUET_PATH}...")
-    table = pq.read_table(PARQUET_PATH)
-    df = table.to_pandas()
-    
-    # Convert embeddings to list of lists if they're not already
-    if isinstance(df['embedding'].iloc[0], np.ndarray):
-        df['embedding'] = df['embedding'].apply(lambda x: x.tolist())
-    
-    total_docs = len(df)
+        print("Using existing collection. Pass --reset to rebuild or --append to resume.")
+        return
+
+    # Open parquet file lazily; only the footer is read here
+    print(f"Reading data from {args.parquet}...")
+    parquet_file = pq.ParquetFile(args.parquet)
+    total_docs = parquet_file.metadata.num_rows
+    start_row = load_checkpoint(checkpoint_path, args.parquet, total_docs) if args.append else 0
     print(f"Found {total_docs} documents to process")
-    
-    # Process in batches
-    for i in tqdm(range(0, len(df), BATCH_SIZE), desc="Processing batches"):
-        batch = df.iloc[i:i+BATCH_SIZE]
-        
-        # Prepare batch data
-        ids = [str(idx) for idx in batch.index]
-        embeddings = batch['embedding'].tolist()
-        documents = batch['document'].tolist()
-        metadatas = batch['metadata'].tolist()
-        
-        # Add to collection
-        collection.add(
-            ids=ids,
-            embeddings=embeddings,
-            documents=documents,
-            metadatas=metadatas
+    if start_row:
+        print(f"Resuming from row {start_row} ({total_docs - start_row} remaining)")
+
+    # Process in batches: decode on worker threads, insert on a single writer thread
+    with tqdm(total=total_docs, initial=start_row, desc="Processing rows") as progress:
+        def on_commit(rows_committed, rows):
+            save_checkpoint(checkpoint_path, args.parquet, total_docs, rows_committed)
+            bump_store_version(args.chroma_dir)
+            progress.update(rows)
+
+        decode_stats, insert_stats = run_pipeline(
+            collection,
+            iter_parquet_batches(parquet_file, args.batch_size, start_row),
+            on_commit,
+            workers=args.workers,
+            queue_depth=args.queue_depth
         )
-    
+
+    print(f"\nThroughput (batch size {args.batch_size}, {args.workers} decode workers):")
+    print(f"  {decode_stats}")
+    print(f"  {insert_stats}")
+
+    build_side_indexes(parquet_file, args.chroma_dir, args.batch_size)
+    build_compact_vectors(args)
+
     print(f"\nSuccessfully built Chroma vector store with {collection.count()} documents")
-    print(f"Vector store location: {os.path.abspath(CHROMA_DIR)}")
+    print(f"Vector store location: {os.path.abspath(args.chroma_dir)}")
+
 
 if __name__ == "__main__":
     start_time = time.time()
     main()
-    print(f"\nTotal time: {(time.time() - start_time)/60:.2f} minutes")
\ No newline at end of file
+    print(f"\nTotal time: {(time.time() - start_time)/60:.2f} minutes")
@@ -0,0 +1,106 @@
+# rag/cache.py
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Hashable, Optional
+
+STORE_VERSION_FILE = "store_version.json"  # Rewritten on every change to the store, for cache invalidation
+
+
+def bump_store_version(directory: str) -> str:
+    """Record that the store in ``directory`` changed; returns the new version."""
+    version = uuid.uuid4().hex
+    write_store_version(directory, version)
+    return version
+
+
+def write_store_version(directory: str, version: Optional[str]) -> None:
+    """Stamp ``directory`` with ``version``, e.g. a derived index with the store version it was built from."""
+    path = Path(directory) / STORE_VERSION_FILE
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"version": version, "updated_at": time.time()}, f)
+    os.replace(tmp_path, path)
+
+
+def read_store_version(directory: str) -> Optional[str]:
+    """The store's current version, or None if it was built before versions were recorded."""
+    try:
+        with open(Path(directory) / STORE_VERSION_FILE, "r", encoding="utf-8") as f:
+            return json.load(f).get("version")
+    except (OSError, ValueError):
+        return None
+
+
+class LRUCache:
+    """Thread-safe, size-bounded LRU cache with optional TTL and hit/miss counters."""
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+    def dump(self) -> list:
+        with self._lock:
+            return list(self._data.items())
+
+    def restore(self, items: list) -> None:
+        """Reload entries from ``dump()``, dropping any that have already expired."""
+        now = time.time()
+        with self._lock:
+            for key, (stored_at, value) in items:
+                if self.ttl is None or now - stored_at <= self.ttl:
+                    self._data[key] = (stored_at, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
+def normalize_query(query: str) -> str:
+    """Case- and whitespace-insensitive form of a query, used as the cache key."""
+    return " ".join(query.lower().split())
@@ -0,0 +1,309 @@
+# rag/chunk_embed.py
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Configuration
+CSV_PATH = "data/processed/filtered_complaints.csv"
+SHARD_DIR = "data/processed/embedding_shards"
+OUTPUT_PATH = "data/raw/complaint_embeddings.parquet"  # What rag.build_chroma_store reads
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+TEXT_COLUMN = "cleaned_narrative"
+METADATA_COLUMNS = ["complaint_id", "product", "issue", "sub_issue", "company", "state",
+                    "date_received", "product_category"]
+ROWS_PER_SHARD = 20000  # Complaints per CSV chunk / output shard
+CHUNK_TOKENS = 128  # all-MiniLM-L6-v2 truncates at 256 word pieces
+CHUNK_OVERLAP_TOKENS = 16
+CHUNK_CHARS = 500  # Character mode, as in notebooks/chunking_embeddings.ipynb
+CHUNK_OVERLAP_CHARS = 50
+ENCODE_BATCH_SIZE = 128
+MANIFEST_FILE = "manifest.json"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Chunk complaint narratives and embed them into sharded Parquet.")
+    parser.add_argument("--csv", default=CSV_PATH, help="Path to filtered_complaints.csv")
+    parser.add_argument("--shard-dir", default=SHARD_DIR, help="Where per-chunk Parquet shards are written")
+    parser.add_argument("--output", default=OUTPUT_PATH,
+                        help="Merged Parquet file for rag.build_chroma_store (empty string to skip merging)")
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parser.add_argument("--chunking", default="tokens", choices=["tokens", "chars"],
+                        help="Token windows of the embedding tokenizer, or the notebook's character windows")
+    parser.add_argument("--chunk-size", type=int, help=f"Tokens (default {CHUNK_TOKENS}) or characters ({CHUNK_CHARS})")
+    parser.add_argument("--overlap", type=int,
+                        help=f"Tokens (default {CHUNK_OVERLAP_TOKENS}) or characters ({CHUNK_OVERLAP_CHARS})")
+    parser.add_argument("--rows-per-shard", type=int, default=ROWS_PER_SHARD)
+    parser.add_argument("--processes", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="CPU encoding processes")
+    parser.add_argument("--batch-size", type=int, default=ENCODE_BATCH_SIZE, help="Sentences per encode batch")
+    parser.add_argument("--dtype", default="float16", choices=["float16", "float32"],
+                        help="Stored embedding precision")
+    parser.add_argument("--limit", type=int,
+                        help="Stop after this many CSV rows (for trial runs; a longer run needs --reset)")
+    parser.add_argument("--reset", action="store_true", help="Delete existing shards and start over")
+    return parser.parse_args(argv)
+
+
+def char_chunks(texts: List[str], size: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP_CHARS) -> List[List[str]]:
+    """
+    Fixed character windows, identical to the notebook's ``chunk_text``, with the
+    window starts computed for the whole batch at once.
+    """
+    step = size - overlap
+    lengths = np.fromiter((len(t) for t in texts), dtype=np.int64, count=len(texts))
+    counts = -(-lengths // step)  # ceil
+    owners = np.repeat(np.arange(len(texts)), counts)
+    starts = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)) * step
+
+    chunks: List[List[str]] = [[] for _ in texts]
+    for owner, start in zip(owners.tolist(), starts.tolist()):
+        chunks[owner].append(texts[owner][start:start + size])
+    return chunks
+
+
+def token_chunks(texts: List[str], tokenizer, size: int = CHUNK_TOKENS,
+                 overlap: int = CHUNK_OVERLAP_TOKENS) -> List[List[str]]:
+    """
+    Windows of ``size`` embedding-model tokens with ``overlap`` tokens shared
+    between neighbours, cut back to character spans of the original text so
+    no chunk is silently truncated by the encoder.
+    """
+    step = size - overlap
+    encoded = tokenizer(texts, add_special_tokens=False, return_offsets_mapping=True, verbose=False)
+    chunks: List[List[str]] = []
+    for text, offsets in zip(texts, encoded["offset_mapping"]):
+        if not offsets:
+            chunks.append([text] if text.strip() else [])
+            continue
+        offsets = np.asarray(offsets)
+        n = len(offsets)
+        first = np.arange(0, max(1, n - overlap), step)
+        last = np.minimum(first + size, n) - 1
+        chunks.append([text[s:e] for s, e in zip(offsets[first, 0].tolist(), offsets[last, 1].tolist())])
+    return chunks
+
+
+def build_rows(frame: pd.DataFrame, chunks: List[List[str]]) -> Dict[str, list]:
+    """Flatten per-complaint chunks into documents + metadata dicts."""
+    documents, metadatas = [], []
+    records = frame[[c for c in METADATA_COLUMNS if c in frame.columns]].to_dict("records")
+    for record, pieces in zip(records, chunks):
+        for i, piece in enumerate(pieces):
+            metadata = {column: str(record.get(column, "") or "") for column in METADATA_COLUMNS}
+            metadata["chunk_index"] = i
+            metadata["total_chunks"] = len(pieces)
+            documents.append(piece)
+            metadatas.append(metadata)
+    return {"documents": documents, "metadatas": metadatas}
+
+
+class Encoder:
+    """
+    Sentence-transformers encoding across CPU processes.
+
+    Inputs are sorted by length before batching so each batch pads to similar
+    lengths; outputs come back in the original order.
+    """
+
+    def __init__(self, model_name: str, processes: int = 1, batch_size: int = ENCODE_BATCH_SIZE):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.batch_size = batch_size
+        self.pool = self.model.start_multi_process_pool(["cpu"] * processes) if processes > 1 else None
+
+    @property
+    def tokenizer(self):
+        return self.model.tokenizer
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.empty((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+        order = np.argsort([len(t) for t in texts], kind="stable")
+        ordered = [texts[i] for i in order]
+        if self.pool is not None:
+            vectors = self.model.encode_multi_process(
+                ordered, self.pool, batch_size=self.batch_size,
+                chunk_size=max(self.batch_size, len(ordered) // (4 * len(self.pool["processes"])) or 1)
+            )
+        else:
+            vectors = self.model.encode(ordered, batch_size=self.batch_size, convert_to_numpy=True)
+        output = np.empty_like(vectors)
+        output[order] = vectors
+        return output
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.model.stop_multi_process_pool(self.pool)
+            self.pool = None
+
+
+def shard_schema(dtype: str) -> pa.Schema:
+    value_type = pa.float16() if dtype == "float16" else pa.float32()
+    metadata_type = pa.struct(
+        [(column, pa.string()) for column in METADATA_COLUMNS]
+        + [("chunk_index", pa.int32()), ("total_chunks", pa.int32())]
+    )
+    return pa.schema([
+        ("document", pa.string()),
+        ("embedding", pa.list_(value_type)),
+        ("metadata", metadata_type)
+    ])
+
+
+def write_shard(path: Path, rows: Dict[str, list], embeddings: np.ndarray, dtype: str) -> None:
+    """
+    Write one shard atomically (tmp file + rename), so a crash never leaves a
+    partial shard. A CSV chunk without narratives gives an empty shard, which
+    still marks the chunk as done.
+    """
+    schema = shard_schema(dtype)
+    values = pa.array(embeddings.astype(dtype).reshape(-1), type=schema.field("embedding").type.value_type)
+    offsets = pa.array(np.arange(0, embeddings.size + 1, embeddings.shape[1], dtype=np.int32))
+    table = pa.table({
+        "document": pa.array(rows["documents"], type=pa.string()),
+        "embedding": pa.ListArray.from_arrays(offsets, values),
+        "metadata": pa.array(rows["metadatas"], type=schema.field("metadata").type)
+    }, schema=schema)
+    tmp_path = path.with_suffix(".tmp")
+    pq.write_table(table, tmp_path, compression="zstd", row_group_size=10000)
+    os.replace(tmp_path, path)
+
+
+def check_manifest(shard_dir: Path, config: Dict[str, object], reset: bool) -> None:
+    """Refuse to mix shards written with different settings."""
+    path = shard_dir / MANIFEST_FILE
+    if reset:
+        for shard in shard_dir.glob("shard-*.parquet"):
+            shard.unlink()
+    elif path.exists():
+        with open(path, "r", encoding="utf-8") as f:
+            previous = {"limit": None, **json.load(f)}  # Manifests written before limit was recorded
+        if previous != config:
+            raise SystemExit(f"Shards in {shard_dir} were written with {previous}; pass --reset to start over.")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+
+
+def merge_shards(shard_dir: Path, output: str) -> int:
+    """Concatenate shards into one Parquet file, one row group at a time."""
+    shards = sorted(shard_dir.glob("shard-*.parquet"))
+    if not shards:
+        return 0
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(output + ".tmp")
+    rows = 0
+    schema = pq.ParquetFile(shards[0]).schema_arrow
+    with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+        for shard in shards:
+            parquet_file = pq.ParquetFile(shard)
+            for group in range(parquet_file.num_row_groups):
+                table = parquet_file.read_row_group(group)
+                writer.write_table(table)
+                rows += table.num_rows
+    os.replace(tmp_path, output)
+    return rows
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    size = args.chunk_size or (CHUNK_TOKENS if args.chunking == "tokens" else CHUNK_CHARS)
+    overlap = args.overlap if args.overlap is not None else (
+        CHUNK_OVERLAP_TOKENS if args.chunking == "tokens" else CHUNK_OVERLAP_CHARS)
+    if overlap >= size:
+        raise SystemExit("--overlap must be smaller than --chunk-size")
+
+    shard_dir = Path(args.shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    check_manifest(shard_dir, {
+        "csv": os.path.abspath(args.csv),
+        "model": args.model,
+        "chunking": args.chunking,
+        "chunk_size": size,
+        "overlap": overlap,
+        "rows_per_shard": args.rows_per_shard,
+        "dtype": args.dtype,
+        # A --limit run truncates its last shard, so its shards must not be reused by a longer run
+        "limit": args.limit
+    }, args.reset)
+
+    print(f"Loading {args.model} with {args.processes} encoding process(es)...")
+    encoder = Encoder(args.model, args.processes, args.batch_size)
+    reader = pd.read_csv(
+        args.csv,
+        usecols=lambda column: column == TEXT_COLUMN or column in METADATA_COLUMNS,
+        dtype=str,
+        keep_default_na=False,
+        chunksize=args.rows_per_shard
+    )
+
+    totals = {"rows": 0, "complaints": 0, "chunks": 0, "chunk_seconds": 0.0, "embed_seconds": 0.0, "skipped_shards": 0}
+    start_time = time.time()
+    try:
+        for shard_index, frame in enumerate(reader):
+            # --limit counts CSV rows, blank narratives included, so a resumed run stops at the same row
+            if args.limit is not None and totals["rows"] >= args.limit:
+                break
+            if args.limit is not None:
+                frame = frame.iloc[:args.limit - totals["rows"]]
+            totals["rows"] += len(frame)
+            frame = frame[frame[TEXT_COLUMN].str.strip() != ""]
+            shard_path = shard_dir / f"shard-{shard_index:05d}.parquet"
+            if shard_path.exists():
+                # Written by an earlier run; the CSV chunk is only parsed, not re-embedded
+                totals["skipped_shards"] += 1
+                totals["complaints"] += len(frame)
+                continue
+            texts = frame[TEXT_COLUMN].tolist()
+
+            chunk_start = time.perf_counter()
+            if args.chunking == "tokens":
+                chunks = token_chunks(texts, encoder.tokenizer, size, overlap)
+            else:
+                chunks = char_chunks(texts, size, overlap)
+            rows = build_rows(frame, chunks)
+            chunk_seconds = time.perf_counter() - chunk_start
+
+            embed_start = time.perf_counter()
+            embeddings = encoder.encode(rows["documents"])
+            embed_seconds = time.perf_counter() - embed_start
+            write_shard(shard_path, rows, embeddings, args.dtype)
+
+            n = len(rows["documents"])
+            totals["complaints"] += len(texts)
+            totals["chunks"] += n
+            totals["chunk_seconds"] += chunk_seconds
+            totals["embed_seconds"] += embed_seconds
+            elapsed = time.time() - start_time
+            print(f"Shard {shard_index}: {len(texts)} complaints -> {n} chunks "
+                  f"(chunking {n / max(chunk_seconds, 1e-9):,.0f} chunks/s, "
+                  f"embedding {n / max(embed_seconds, 1e-9):,.0f} chunks/s); "
+                  f"overall {totals['chunks'] / max(elapsed, 1e-9):,.0f} chunks/s")
+    finally:
+        encoder.close()
+
+    elapsed = time.time() - start_time
+    print(f"\nEmbedded {totals['chunks']} chunks from {totals['complaints']} complaints in {elapsed / 60:.1f} minutes "
+          f"({totals['skipped_shards']} shards reused)")
+    if totals["chunks"]:
+        print(f"  chunking: {totals['chunks'] / max(totals['chunk_seconds'], 1e-9):,.0f} chunks/s")
+        print(f"  embedding: {totals['chunks'] / max(totals['embed_seconds'], 1e-9):,.0f} chunks/s")
+
+    if args.output:
+        print(f"Merging shards into {args.output}...")
+        rows = merge_shards(shard_dir, args.output)
+        print(f"Wrote {rows} chunks to {args.output}; build the store with "
+              f"python -m rag.build_chroma_store --parquet {args.output} --reset")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
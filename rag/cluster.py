@@ -0,0 +1,449 @@
+# rag/cluster.py
+import argparse
+import asyncio
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from .rag_pipeline import RAGPipeline
+from .service import AdmissionControl, ServiceBusy, ServiceCore, create_app
+from .telemetry import get_telemetry
+
+logger = logging.getLogger(__name__)
+
+ROLES = ("retrieve", "generate")
+MONITOR_SECONDS = 1.0  # How often the dispatcher checks for dead workers, busy or idle
+
+
+def worker_main(role: str, index: int, inbox, outbox, pipeline_config: Dict[str, Any], threads: int,
+                torch_threads: Optional[int]) -> None:
+    """
+    Body of one worker process: builds its own RAGPipeline, loads only the
+    models its role needs and serves requests from ``inbox`` on ``threads``
+    threads (so the generation scheduler can still batch concurrent requests).
+
+    Messages in are ``(request_id, op, payload)``; messages out are
+    ``(worker, request_id, kind, data)`` with kind ``ready``, ``failed``,
+    ``event``, ``result`` or ``error``.
+    """
+    logging.basicConfig(level=logging.INFO, format=f"%(asctime)s - {role}-{index} - %(levelname)s - %(message)s")
+    worker = (role, index)
+    if torch_threads:
+        # N processes each using every core would oversubscribe the CPU
+        try:
+            import torch
+            torch.set_num_threads(torch_threads)
+        except ImportError:
+            pass
+
+    try:
+        rag = RAGPipeline(**pipeline_config)
+        if role == "retrieve":
+            # Matrix backends mmap the shared index read-only; pages are shared through the OS cache
+            _ = rag.retriever
+            _ = rag.analytics_cube
+        else:
+            _ = rag.generator
+    except Exception as e:
+        logger.exception("Worker failed to load")
+        outbox.put((worker, None, "failed", str(e)[:200]))
+        return
+    outbox.put((worker, None, "ready", os.getpid()))
+
+    # Requests submitted and not finished; cancels for anything else (already done) are dropped
+    active = set()
+    cancelled = set()
+    guard = threading.Lock()
+
+    def run(request_id: int, op: str, payload: Dict[str, Any]) -> None:
+        try:
+            if op == "retrieve":
+                result = rag.retrieve(**payload)
+            elif op == "prepare":
+                use_cache = payload.pop("use_cache", False)
+                direct, retrieved, timings = rag.prepare(**payload)
+                result = {"direct": direct, "sources": retrieved, "timings": timings, "embedding": None}
+                if use_cache and direct is None and retrieved:
+                    # Answer-cache key, from the embedding cache filled by retrieval; generation
+                    # workers then never need to load the embedder
+                    result["embedding"] = rag.retriever.embed(payload["question"])
+            elif op == "answer":
+                result = rag.answer(**payload)
+            elif op == "answer_stream":
+                result = None
+                events = rag.answer_stream(**payload)
+                try:
+                    for event in events:
+                        if request_id in cancelled:
+                            break
+                        outbox.put((worker, request_id, "event", event))
+                finally:
+                    events.close()
+            else:
+                raise ValueError(f"Unknown operation '{op}'")
+            outbox.put((worker, request_id, "result", result))
+        except Exception as e:
+            logger.error(f"{op} failed: {str(e)}")
+            outbox.put((worker, request_id, "error", str(e)[:200]))
+        finally:
+            with guard:
+                active.discard(request_id)
+                cancelled.discard(request_id)
+
+    executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=role)
+    while True:
+        request_id, op, payload = inbox.get()
+        if op == "stop":
+            break
+        with guard:
+            if op == "cancel":
+                if request_id in active:
+                    cancelled.add(request_id)
+                continue
+            active.add(request_id)
+        executor.submit(run, request_id, op, payload)
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+class WorkerHandle:
+    """Dispatcher-side view of one worker process."""
+
+    def __init__(self, role: str, index: int, process, inbox):
+        self.role = role
+        self.index = index
+        self.process = process
+        self.inbox = inbox
+        self.outstanding = 0  # Requests sent and not yet finished: the queue length balanced on
+        self.handled = 0
+        self.state = "loading"
+        self.error: Optional[str] = None
+
+    @property
+    def alive(self) -> bool:
+        return self.state == "ready" and self.process.is_alive()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pid": self.process.pid,
+            "state": self.state if self.process.is_alive() or self.state == "failed" else "dead",
+            "outstanding": self.outstanding,
+            "handled": self.handled,
+            **({"error": self.error} if self.error else {})
+        }
+
+
+class ClusterCore(ServiceCore):
+    """
+    Multi-process counterpart of ServiceCore, with the same async interface
+    (so ``create_app`` and the Gradio UI work unchanged).
+
+    Retrieval and generation run in separate pools of worker processes, each
+    with its own models and GIL. Retrieval-only requests go straight to a
+    retrieval worker and never queue behind a long generation; a query is
+    prepared (retrieved) on a retrieval worker, then answered by a generation
+    worker: through its batching scheduler for ``query``, or streamed
+    (unbatched) for ``query_stream``. Every request is routed to the ready worker of its
+    role with the fewest outstanding requests.
+
+    With a matrix vector backend (``--vector-backend matrix`` once the index
+    is built) each retrieval worker memory-maps the same read-only index
+    files, so N workers share one copy of the vectors in the OS page cache.
+    """
+
+    def __init__(self, retrieve_workers: int = 2, generate_workers: int = 1,
+                 pipeline_config: Optional[Dict[str, Any]] = None, retrieve_threads: int = 2,
+                 generate_threads: int = 4, torch_threads: Optional[int] = None,
+                 max_in_flight: int = 16, max_waiting: int = 64, queue_timeout: float = 10.0):
+        # Admission control and readiness checks are shared with ServiceCore; there is no in-process pipeline
+        self.admission = AdmissionControl(max_in_flight, max_waiting, queue_timeout)
+        self.cancelled = 0
+        self.pipeline_config = dict(pipeline_config or {})
+        if torch_threads is None:
+            torch_threads = max(1, (os.cpu_count() or 1) // max(1, retrieve_workers + generate_workers))
+
+        context = mp.get_context("spawn")  # Forking a process that holds torch/Chroma state is unsafe
+        self._outbox = context.Queue()
+        self.workers: Dict[str, List[WorkerHandle]] = {role: [] for role in ROLES}
+        for role, count, threads in (("retrieve", retrieve_workers, retrieve_threads),
+                                     ("generate", generate_workers, generate_threads)):
+            for index in range(count):
+                inbox = context.Queue()
+                process = context.Process(
+                    target=worker_main, name=f"rag-{role}-{index}", daemon=True,
+                    args=(role, index, inbox, self._outbox, self.pipeline_config, threads, torch_threads)
+                )
+                process.start()
+                self.workers[role].append(WorkerHandle(role, index, process, inbox))
+
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # request id -> (event loop, asyncio queue of (kind, data), worker handle)
+        self._pending: Dict[int, Any] = {}
+        self._closed = False
+        self._reader = threading.Thread(target=self._read_results, name="cluster-dispatcher", daemon=True)
+        self._reader.start()
+
+    # Dispatching
+
+    def _read_results(self) -> None:
+        """Route worker messages to the waiting requests; fail requests of workers that died."""
+        next_check = time.monotonic() + MONITOR_SECONDS
+        while not self._closed:
+            # Checked on a timer rather than only when idle, so a crash under load is noticed too
+            if time.monotonic() >= next_check:
+                self._reap_dead_workers()
+                next_check = time.monotonic() + MONITOR_SECONDS
+            try:
+                (role, index), request_id, kind, data = self._outbox.get(timeout=MONITOR_SECONDS)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+
+            handle = self.workers[role][index]
+            if kind in ("ready", "failed"):
+                handle.state = "ready" if kind == "ready" else "failed"
+                handle.error = data if kind == "failed" else None
+                logger.info(f"Worker {role}-{index} {handle.state}" + (f": {data}" if kind == "failed" else ""))
+                continue
+
+            with self._lock:
+                if kind in ("result", "error"):
+                    handle.outstanding -= 1
+                    handle.handled += 1
+                    pending = self._pending.pop(request_id, None)
+                else:
+                    pending = self._pending.get(request_id)
+            if pending is not None:
+                loop, results, _ = pending
+                loop.call_soon_threadsafe(results.put_nowait, (kind, data))
+
+    def _reap_dead_workers(self) -> None:
+        with self._lock:
+            lost = [(request_id, pending) for request_id, pending in self._pending.items()
+                    if not pending[2].process.is_alive()]
+            for request_id, (_, _, handle) in lost:
+                del self._pending[request_id]
+                handle.outstanding -= 1
+        for request_id, (loop, results, handle) in lost:
+            loop.call_soon_threadsafe(results.put_nowait, ("error", f"Worker {handle.role}-{handle.index} died"))
+
+    def _pick(self, role: str) -> WorkerHandle:
+        """The live worker of ``role`` with the shortest queue."""
+        candidates = [handle for handle in self.workers[role] if handle.alive]
+        if not candidates:
+            raise ServiceBusy(f"No {role} worker is available", 503, retry_after=5.0)
+        return min(candidates, key=lambda handle: (handle.outstanding, handle.handled))
+
+    async def _call(self, role: str, op: str, payload: Dict[str, Any]) -> AsyncIterator[Any]:
+        """Send one request to a ``role`` worker; yield its events, then its result."""
+        request_id = next(self._ids)
+        results: asyncio.Queue = asyncio.Queue()
+        with self._lock:
+            handle = self._pick(role)
+            handle.outstanding += 1
+            self._pending[request_id] = (asyncio.get_running_loop(), results, handle)
+        get_telemetry().gauge("rag_worker_outstanding", handle.outstanding, worker=f"{role}-{handle.index}")
+        handle.inbox.put((request_id, op, payload))
+
+        finished = False
+        try:
+            while True:
+                kind, data = await results.get()
+                if kind == "error":
+                    finished = True
+                    raise RuntimeError(data)
+                if kind == "result":
+                    finished = True
+                    yield data
+                    return
+                yield data
+        finally:
+            if not finished:
+                # The caller went away: stop the worker's generation at its next token
+                handle.inbox.put((request_id, "cancel", None))
+
+    async def _request(self, role: str, op: str, payload: Dict[str, Any]) -> Any:
+        result = None
+        async for result in self._call(role, op, payload):
+            pass
+        return result
+
+    # ServiceCore interface
+
+    @property
+    def ready(self) -> bool:
+        return all(any(handle.alive for handle in self.workers[role]) for role in ROLES)
+
+    def warm_up(self) -> None:
+        """Workers load their models as soon as they start."""
+
+    def status(self) -> Dict[str, Any]:
+        return {"ready": self.ready, "service": self.stats()}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.admission.stats(),
+            "cancelled": self.cancelled,
+            "ready": self.ready,
+            "workers": {
+                role: {f"{role}-{handle.index}": handle.stats() for handle in handles}
+                for role, handles in self.workers.items()
+            }
+        }
+
+    async def retrieve(self, question: str, k: int = 3, where: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        # Needs only a retrieval worker (_pick answers 503 if none is up), not the whole cluster
+        async with self.admission.slot():
+            return await self._request("retrieve", "retrieve", {"question": question, "k": k, "where": where})
+
+    async def query(self, question: str, k: int = 3, use_cache: bool = True,
+                    where: Optional[Dict[str, Any]] = None, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Complete answer: prepared on a retrieval worker, generated by a
+        generation worker's batching scheduler. Traced as "query" here, with
+        the workers' stage timings attached; the workers' own telemetry only
+        sees their stages.
+        """
+        self._check_ready()
+        telemetry = get_telemetry()
+        with telemetry.trace("query"):
+            start = time.perf_counter()
+            async with self.admission.slot():
+                prepared = await self._request("retrieve", "prepare", {"question": question, "k": k, "where": where,
+                                                                       "use_cache": use_cache})
+                response = prepared["direct"]
+                if response is None:
+                    response = await self._request("generate", "answer", {
+                        "question": question, "retrieved": prepared["sources"], "use_cache": use_cache,
+                        "timeout": timeout, "question_embedding": prepared["embedding"]
+                    })
+                    response["timings"] = {**prepared["timings"], **response["timings"]}
+            response["timings"]["service_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            telemetry.annotate(cached=response["cached"], sources=len(response["sources"]), **response["timings"])
+            return response
+
+    async def query_stream(self, question: str, k: int = 3, use_cache: bool = True,
+                           where: Optional[Dict[str, Any]] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Same events as ``RAGPipeline.query_stream``: retrieval and generation run on different workers."""
+        self._check_ready()
+        async with self.admission.slot():
+            start = time.perf_counter()
+            prepared = await self._request("retrieve", "prepare", {"question": question, "k": k, "where": where,
+                                                                   "use_cache": use_cache})
+            direct = prepared["direct"]
+            if direct is not None:
+                yield {"type": "sources", "sources": []}
+                yield {"type": "token", "text": direct["answer"]}
+                yield {"type": "done", "answer": direct["answer"], "cached": False, "timings": direct["timings"]}
+                return
+
+            yield {"type": "sources", "sources": prepared["sources"]}
+            payload = {"question": question, "retrieved": prepared["sources"], "use_cache": use_cache,
+                       "timings": prepared["timings"], "question_embedding": prepared["embedding"]}
+            try:
+                async for event in self._call("generate", "answer_stream", payload):
+                    if event is None:
+                        break
+                    if event["type"] == "done":
+                        # Worker clocks only see generation; report the time seen by the dispatcher
+                        event["timings"]["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                    yield event
+            except (asyncio.CancelledError, GeneratorExit):
+                self.cancelled += 1
+                get_telemetry().count("rag_cancelled_requests_total")
+                logger.info(f"Request cancelled: {question[:80]}")
+                raise
+
+    def shutdown(self, timeout: float = 5.0) -> None:
+        for handles in self.workers.values():
+            for handle in handles:
+                if handle.process.is_alive():
+                    handle.inbox.put((None, "stop", None))
+        deadline = time.monotonic() + timeout
+        for handles in self.workers.values():
+            for handle in handles:
+                handle.process.join(max(0.0, deadline - time.monotonic()))
+                if handle.process.is_alive():
+                    handle.process.terminate()
+        self._closed = True
+
+    def wait_ready(self, timeout: float = 300.0) -> bool:
+        """Block until every worker has loaded (or failed); True if all are ready."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            handles = [handle for role in ROLES for handle in self.workers[role]]
+            if all(handle.state != "loading" or not handle.process.is_alive() for handle in handles):
+                return all(handle.alive for handle in handles)
+            time.sleep(0.2)
+        return False
+
+
+def pipeline_config_from_args(args) -> Dict[str, Any]:
+    config = {
+        "chroma_dir": args.chroma_dir,
+        "vector_backend": args.vector_backend,
+        "search_mode": args.search_mode
+    }
+    if args.generator:
+        config["generator_config"] = {"preset": args.generator}
+    return config
+
+
+def add_cluster_args(parser: argparse.ArgumentParser) -> None:
+    """Options shared by the cluster server and the load test."""
+    parser.add_argument("--chroma-dir", default="vector_store/chroma")
+    parser.add_argument("--vector-backend", default="chroma",
+                        help="chroma, or matrix (matrix-int8...) to share one mmap'd index between workers; "
+                             "see rag.vector_backends")
+    parser.add_argument("--search-mode", default="vector", choices=["vector", "hybrid"])
+    parser.add_argument("--generator", help="Generator preset for the generation workers")
+    parser.add_argument("--retrieve-threads", type=int, default=2, help="Concurrent requests per retrieval worker")
+    parser.add_argument("--generate-threads", type=int, default=4,
+                        help="Concurrent requests per generation worker (batched by its scheduler)")
+    parser.add_argument("--torch-threads", type=int, help="Torch threads per worker (default: cores / workers)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the RAG pipeline from separate retrieval and generation processes.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--retrieve-workers", type=int, default=2)
+    parser.add_argument("--generate-workers", type=int, default=1)
+    add_cluster_args(parser)
+    parser.add_argument("--max-in-flight", type=int, default=16, help="Requests processed concurrently")
+    parser.add_argument("--max-waiting", type=int, default=64, help="Requests queued before answering 429")
+    parser.add_argument("--queue-timeout", type=float, default=10.0, help="Seconds a request may wait before 503")
+    parser.add_argument("--telemetry", action="store_true", help="Record metrics for /metrics (or RAG_TELEMETRY=1)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    import uvicorn
+
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.telemetry:
+        get_telemetry().enable()
+    core = ClusterCore(
+        retrieve_workers=args.retrieve_workers,
+        generate_workers=args.generate_workers,
+        pipeline_config=pipeline_config_from_args(args),
+        retrieve_threads=args.retrieve_threads,
+        generate_threads=args.generate_threads,
+        torch_threads=args.torch_threads,
+        max_in_flight=args.max_in_flight,
+        max_waiting=args.max_waiting,
+        queue_timeout=args.queue_timeout
+    )
+    uvicorn.run(create_app(core), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
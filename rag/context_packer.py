@@ -0,0 +1,109 @@
+# rag/context_packer.py
+from typing import Any, Callable, Dict, List, Union
+
+from .cache import LRUCache
+
+MAX_OVERLAP_CHARS = 100  # Chunks were cut with a 50-character overlap
+
+
+def _relevance(source: Dict[str, Any], position: int) -> float:
+    """Higher is better: pinned sources first, then re-rank score, fusion score, negated cosine distance."""
+    if source.get("pinned"):
+        return float("inf")
+    if source.get("rerank_score") is not None:
+        return float(source["rerank_score"])
+    if source.get("fusion_score") is not None:
+        return float(source["fusion_score"])
+    if source.get("score") is not None:
+        return -float(source["score"])
+    return -float(position)
+
+
+def _merge_overlap(first: str, second: str) -> str:
+    """Join two consecutive chunks, dropping the text they share at the seam."""
+    for size in range(min(MAX_OVERLAP_CHARS, len(first), len(second)), 0, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return first + " " + second
+
+
+class ContextPacker:
+    """
+    Token-aware selection of retrieved chunks for the prompt.
+
+    Consecutive chunks of the same complaint are merged (their overlap
+    removed) and exact duplicates dropped; the result is added in relevance
+    order until ``budget`` tokens are used. Token counts are cached per chunk
+    text so sources that come back often are tokenized once.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int], budget: int = 1536, cache_size: int = 4096):
+        self.count_tokens = count_tokens
+        self.budget = budget
+        self.token_cache = LRUCache(cache_size)
+
+    def tokens(self, text: str) -> int:
+        count = self.token_cache.get(text)
+        if count is None:
+            count = self.count_tokens(text)
+            self.token_cache.put(text, count)
+        return count
+
+    def _dedupe(self, sources: List[Union[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        items = []
+        for position, source in enumerate(sources):
+            if isinstance(source, str):
+                source = {"text": source}
+            items.append({
+                "text": source.get("text") or "",
+                "metadata": source.get("metadata") or {},
+                "relevance": _relevance(source, position)
+            })
+
+        by_complaint: Dict[Any, List[Dict[str, Any]]] = {}
+        merged = []
+        for item in items:
+            complaint_id = item["metadata"].get("complaint_id")
+            if complaint_id is None:
+                merged.append(item)
+            else:
+                by_complaint.setdefault(complaint_id, []).append(item)
+
+        for chunks in by_complaint.values():
+            chunks.sort(key=lambda c: int(c["metadata"].get("chunk_index", 0) or 0))
+            current = dict(chunks[0])
+            for chunk in chunks[1:]:
+                gap = int(chunk["metadata"].get("chunk_index", 0) or 0) - int(current["metadata"].get("chunk_index", 0) or 0)
+                if gap <= 1:
+                    if chunk["text"] != current["text"]:
+                        current["text"] = _merge_overlap(current["text"], chunk["text"])
+                    current["relevance"] = max(current["relevance"], chunk["relevance"])
+                    current["metadata"] = chunk["metadata"]
+                else:
+                    merged.append(current)
+                    current = dict(chunk)
+            merged.append(current)
+
+        seen = set()
+        unique = []
+        for item in merged:
+            if item["text"] and item["text"] not in seen:
+                seen.add(item["text"])
+                unique.append(item)
+        return unique
+
+    def pack(self, sources: List[Union[str, Dict[str, Any]]], reserved_tokens: int = 0) -> List[str]:
+        """Return chunk texts, most relevant first, fitting in ``budget - reserved_tokens`` tokens."""
+        remaining = self.budget - reserved_tokens
+        packed = []
+        for item in sorted(self._dedupe(sources), key=lambda i: i["relevance"], reverse=True):
+            cost = self.tokens(item["text"]) + 2  # "- " bullet and newline
+            if cost <= remaining:
+                packed.append(item["text"])
+                remaining -= cost
+            elif not packed and remaining > 0:
+                # Always keep some of the best chunk, trimmed proportionally
+                keep = int(len(item["text"]) * remaining / cost)
+                packed.append(item["text"][:keep])
+                remaining = 0
+        return packed
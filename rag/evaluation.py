@@ -1,4 +1,4 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 import pandas as pd
 import logging
 
@@ -19,19 +19,19 @@ class RAGEvaluator:
             f.write("# RAG Pipeline Evaluation Results\n\n")
             f.write(df.to_markdown(index=False))
 
-    def evaluate_single(self, question: str) -> Dict[str, Any]:
-        try:
-            response = self.rag.query(question)
-            sources = response.get("sources", [])[:2]
-            quality_score = self._calculate_initial_quality(response)
+    def evaluate_response(self, question: str, response: Dict[str, Any]) -> Dict[str, Any]:
+        """Score a pipeline response and keep the fields shown in the report."""
+        return {
+            "question": question,
+            "answer": response.get("answer", "No answer generated"),
+            "sources": response.get("sources", [])[:2],
+            "score": self._calculate_initial_quality(response),
+            "analysis": "Auto-evaluated"
+        }
 
-            return {
-                "question": question,
-                "answer": response.get("answer", "No answer generated"),
-                "sources": sources,
-                "score": quality_score,
-                "analysis": "Auto-evaluated"
-            }
+    def evaluate_single(self, question: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+        try:
+            return self.evaluate_response(question, self.rag.query(question, timeout=timeout))
 
         except Exception as e:
             self.logger.error(f"Error processing question: {str(e)}")
@@ -66,7 +66,3 @@ TEST_QUESTIONS = [
     "How do customers describe their experiences with customer service?",
     "What issues do customers face with credit score reporting?"
 ]
-<<<<<<< HEAD
-
-=======
->>>>>>> 61fb8cdfec1366a2ad828f15b943c0c369e4e145
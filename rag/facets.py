@@ -0,0 +1,130 @@
+# rag/facets.py
+import json
+import logging
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+FACET_FIELDS = ["product", "company", "state"]
+FACETS_FILE = "facets.parquet"  # one row per chunk: id + facet values
+FACET_COUNTS_FILE = "facet_counts.json"  # per-facet value counts, small enough for the UI
+
+
+def write_facets(batches: Iterable[Tuple[List[str], List[Dict[str, Any]]]], directory: str) -> Dict[str, Dict[str, int]]:
+    """
+    Write the facet index next to the vector store.
+
+    ``batches`` yields (ids, metadatas) pairs, in the same id scheme used for
+    the collection. Returns the per-facet counts that were written.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    directory = Path(directory)
+    schema = pa.schema([("id", pa.string())] + [(field, pa.string()) for field in FACET_FIELDS])
+    counts = {field: Counter() for field in FACET_FIELDS}
+    tmp_path = directory / (FACETS_FILE + ".tmp")
+
+    with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+        for ids, metadatas in batches:
+            columns = {"id": ids}
+            for field in FACET_FIELDS:
+                values = [_facet_value(meta, field) for meta in metadatas]
+                counts[field].update(v for v in values if v is not None)
+                columns[field] = values
+            writer.write_table(pa.table(columns, schema=schema))
+    tmp_path.replace(directory / FACETS_FILE)
+
+    counts = {field: dict(counter.most_common()) for field, counter in counts.items()}
+    with open(directory / FACET_COUNTS_FILE, "w", encoding="utf-8") as f:
+        json.dump(counts, f)
+    return counts
+
+
+def _facet_value(metadata: Optional[Dict[str, Any]], field: str) -> Optional[str]:
+    value = (metadata or {}).get(field)
+    if value is None or str(value) in ("", "nan"):
+        return None
+    return str(value)
+
+
+def load_facet_counts(directory: str) -> Dict[str, Dict[str, int]]:
+    """Per-facet value counts written at ingest time (empty if the store has none)."""
+    path = Path(directory) / FACET_COUNTS_FILE
+    if not path.exists():
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def to_chroma_where(where: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """Turn ``{"product": "Credit card", "state": "CA"}`` into Chroma's ``$and`` form."""
+    if not where:
+        return None
+    if len(where) == 1 or any(key.startswith("$") for key in where):
+        return where
+    return {"$and": [{key: value} for key, value in where.items()]}
+
+
+class FacetIndex:
+    """
+    Facet value -> chunk id sets, loaded from ``facets.parquet``.
+
+    Counts come from the small JSON file and are available immediately; the
+    id sets are materialized on the first call that needs them.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.facet_counts = load_facet_counts(directory)
+        self._ids: Optional[Dict[str, Dict[str, Set[str]]]] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, directory: str) -> Optional["FacetIndex"]:
+        if not (Path(directory) / FACETS_FILE).exists():
+            return None
+        return cls(directory)
+
+    def _id_sets(self) -> Dict[str, Dict[str, Set[str]]]:
+        with self._lock:
+            if self._ids is None:
+                import pyarrow.parquet as pq
+
+                table = pq.read_table(self.directory / FACETS_FILE).to_pandas()
+                self._ids = {
+                    field: {value: set(group) for value, group in table.groupby(field)["id"]}
+                    for field in FACET_FIELDS
+                }
+                logging.info(f"Loaded facet index with {len(table)} chunks")
+            return self._ids
+
+    def values(self, field: str) -> List[str]:
+        """Facet values ordered by how many chunks carry them."""
+        return list(self.facet_counts.get(field, {}))
+
+    def counts(self, field: str) -> Dict[str, int]:
+        return dict(self.facet_counts.get(field, {}))
+
+    def supports(self, where: Optional[Dict[str, Any]]) -> bool:
+        """True for plain equality filters over facet fields."""
+        return bool(where) and all(
+            key in FACET_FIELDS and not isinstance(value, dict) for key, value in where.items()
+        )
+
+    def match(self, where: Dict[str, Any]) -> Set[str]:
+        """Ids of chunks matching every equality condition in ``where``."""
+        id_sets = self._id_sets()
+        # Intersect smallest-first so the working set shrinks as fast as possible
+        sets = sorted((id_sets[key].get(str(value), set()) for key, value in where.items()), key=len)
+        matched = set(sets[0])
+        for other in sets[1:]:
+            matched &= other
+        return matched
+
+    def count(self, where: Dict[str, Any]) -> int:
+        if len(where) == 1:
+            key, value = next(iter(where.items()))
+            return self.facet_counts.get(key, {}).get(str(value), 0)
+        return len(self.match(where))
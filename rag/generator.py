@@ -1,38 +1,187 @@
 # generator.py
-import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
 import logging
-from typing import List, Dict, Any
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import List, Dict, Any, Iterator, Optional, Tuple, Union
+from .context_packer import ContextPacker
+from .generator_backends import DEFAULT_PRESET, GeneratorBackend, create_backend, resolve_config
+from .telemetry import get_telemetry
+
+# Fixed preamble of every prompt; with prefix caching its key/values are computed once
+PROMPT_PREFIX = """You are a helpful AI assistant. Answer the question based on the following context:
+
+Context:
+"""
+
+
+class _Request:
+    __slots__ = ("prompt", "max_new_tokens", "deadline", "future", "enqueued_at", "trace")
+
+    def __init__(self, prompt: str, max_new_tokens: int, deadline: Optional[float]):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.deadline = deadline
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        # The caller's trace, so queue wait measured on the worker thread lands in it
+        self.trace = get_telemetry().current_trace()
+
+
+class GenerationScheduler:
+    """
+    Dynamic batching in front of a backend.
+
+    Prompts are queued and a single worker thread groups them into padded
+    batches of up to ``max_batch_size`` (waiting at most ``max_wait_ms`` for
+    the batch to fill), runs one batched ``generate`` and resolves each
+    caller's future. Requests whose deadline passes while queued are failed
+    with ``TimeoutError`` without being generated.
+    """
+
+    def __init__(self, backend: GeneratorBackend, max_batch_size: int = 4, max_wait_ms: float = 20.0):
+        self.backend = backend
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._timeouts = 0
+        self._queue_wait = 0.0
+        self._served = 0
+        self._thread = threading.Thread(target=self._run, name="generation-scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt: str, max_new_tokens: int = 100, timeout: Optional[float] = None) -> Future:
+        deadline = time.monotonic() + timeout if timeout else None
+        request = _Request(prompt, max_new_tokens, deadline)
+        self._queue.put(request)
+        return request.future
+
+    def generate(self, prompt: str, max_new_tokens: int = 100, timeout: Optional[float] = None) -> str:
+        """Block until the prompt's batch is generated; raises TimeoutError after ``timeout`` seconds."""
+        future = self.submit(prompt, max_new_tokens, timeout)
+        if not self.wait(future, timeout):
+            raise TimeoutError(f"Generation timed out after {timeout} seconds")
+        return future.result()
+
+    def wait(self, future: Future, timeout: Optional[float] = None) -> bool:
+        """Wait for a submitted prompt; after ``timeout`` seconds cancel it and return False."""
+        try:
+            future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            with self._lock:
+                self._timeouts += 1
+            return False
+        except Exception:
+            pass  # Raised again by the caller's future.result()
+        return True
+
+    def _collect(self, first: _Request) -> List[_Request]:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect(self._queue.get())
+            now = time.monotonic()
+            live = []
+            for request in batch:
+                if request.future.cancelled():
+                    continue
+                if request.deadline is not None and now > request.deadline:
+                    request.future.set_exception(TimeoutError("Generation timed out while queued"))
+                    continue
+                if request.future.set_running_or_notify_cancel():
+                    live.append(request)
+            if not live:
+                continue
+
+            with self._lock:
+                self._batch_sizes[len(live)] += 1
+                self._queue_wait += sum(now - r.enqueued_at for r in live)
+                self._served += len(live)
+            telemetry = get_telemetry()
+            if telemetry.enabled:
+                for request in live:
+                    wait = now - request.enqueued_at
+                    telemetry.observe("rag_queue_wait_seconds", wait, queue="generation")
+                    telemetry.annotate(request.trace, queue_wait_ms=round(wait * 1000, 2), batch_size=len(live))
+            try:
+                outputs = self.backend.generate_batch(
+                    [r.prompt for r in live],
+                    max_new_tokens=max(r.max_new_tokens for r in live)
+                )
+            except Exception as e:
+                for request in live:
+                    request.future.set_exception(e)
+                continue
+            for request, output in zip(live, outputs):
+                request.future.set_result(output)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            batches = sum(self._batch_sizes.values())
+            return {
+                "queue_depth": self._queue.qsize(),
+                "batches": batches,
+                "requests": self._served,
+                "avg_batch_size": self._served / batches if batches else 0.0,
+                "batch_size_histogram": dict(sorted(self._batch_sizes.items())),
+                "avg_queue_wait_s": self._queue_wait / self._served if self._served else 0.0,
+                "timeouts": self._timeouts
+            }
+
 
 class Generator:
-    def __init__(self, model_name: str = "mistralai/Mistral-7B-Instruct-v0.1"):
+    def __init__(self, model_name: Optional[str] = None, preset: Optional[str] = None,
+                 backend: Optional[str] = None, quantization: Optional[str] = None,
+                 max_batch_size: int = 4, batch_wait_ms: float = 20.0, prompt_token_budget: int = 1536,
+                 prefix_cache: Optional[bool] = None):
+        """
+        Build the generator from a named preset (``RAG_GENERATOR`` env var, default
+        Mistral-7B) with optional overrides, e.g. ``Generator(preset="qwen2.5-0.5b-int8")``
+        or ``Generator(preset="stub")`` for tests. Non-streaming requests go through a
+        GenerationScheduler that batches concurrent prompts. Prompts are kept within
+        ``prompt_token_budget`` tokens by a ContextPacker.
+
+        ``prefix_cache=True`` (or ``RAG_PREFIX_CACHE=1``) keeps the key/values of
+        PROMPT_PREFIX so each request only prefills its context and question.
+        """
         self.logger = self._setup_logging()
-        self.model_name = model_name
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.logger.info(f"Using device: {self.device}")
-        
+        self.telemetry = get_telemetry()
+        config = resolve_config(
+            preset or os.environ.get("RAG_GENERATOR", DEFAULT_PRESET),
+            backend=backend,
+            model_name=model_name,
+            quantization=quantization
+        )
+        self.model_name = config["model_name"]
+
         try:
-            self.logger.info(f"Loading {model_name}...")
-            self.tokenizer = AutoTokenizer.from_pretrained(
-                model_name,
-                trust_remote_code=True
-            )
-            
-            self.model = AutoModelForCausalLM.from_pretrained(
-                model_name,
-                device_map="auto",
-                torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-                trust_remote_code=True
-            )
-            
-            self.pipeline = pipeline(
-                "text-generation",
-                model=self.model,
-                tokenizer=self.tokenizer,
-                device_map="auto"
-            )
-            self.logger.info(f"Successfully loaded {model_name}")
-            
+            self.logger.info(f"Loading {self.model_name} ({config['backend']} backend)...")
+            self.backend: GeneratorBackend = create_backend(**config)
+            self.logger.info(f"Successfully loaded {self.model_name}: {self.backend.report()}")
+            self.scheduler = GenerationScheduler(self.backend, max_batch_size, batch_wait_ms)
+            self.packer = ContextPacker(self.backend.count_tokens, prompt_token_budget)
+            if prefix_cache is None:
+                prefix_cache = os.environ.get("RAG_PREFIX_CACHE", "0") == "1"
+            if prefix_cache and not self.backend.enable_prefix_cache(PROMPT_PREFIX):
+                self.logger.warning(f"{config['backend']} backend does not support prefix caching")
+
         except Exception as e:
             self.logger.error(f"Error loading model: {str(e)}")
             raise
@@ -55,45 +204,95 @@ class Generator:
         
         return logger
 
-    def format_prompt(self, query: str, context: List[str]) -> str:
-        """Format the prompt for the model."""
-        context_str = "\n".join([f"- {c}" for c in context])
-        return f"""You are a helpful AI assistant. Answer the question based on the following context:
-
-Context:
-{context_str}
+    @staticmethod
+    def _render_prompt(query: str, context_str: str) -> str:
+        return PROMPT_PREFIX + f"""{context_str}
 
 Question: {query}
 
 Answer:"""
 
-    def generate_response(self, query: str, context: List[str], max_new_tokens: int = 100) -> str:
+    def format_prompt(self, query: str, context: List[Union[str, Dict[str, Any]]]) -> str:
+        """
+        Format the prompt for the model.
+
+        ``context`` is either chunk texts or retrieved source dicts (with metadata
+        and scores); either way it is deduplicated and packed into the prompt
+        token budget, most relevant first, so the question is never truncated.
+        """
+        reserved = self.packer.tokens(self._render_prompt("", "")) + self.backend.count_tokens(query)
+        context_str = "\n".join([f"- {c}" for c in self.packer.pack(context, reserved)])
+        return self._render_prompt(query, context_str)
+
+    def generate_response(self, query: str, context: List[Union[str, Dict[str, Any]]], max_new_tokens: int = 100,
+                          timeout: Optional[float] = None) -> str:
         """Generate a response using the model."""
+        prompt, future = self.submit_response(query, context, max_new_tokens, timeout)
+        with self.telemetry.span("generate"):
+            self.scheduler.wait(future, timeout)
+        return self.finish_response(prompt, future, timeout)
+
+    def submit_response(self, query: str, context: List[Union[str, Dict[str, Any]]], max_new_tokens: int = 100,
+                        timeout: Optional[float] = None) -> Tuple[str, Future]:
+        """
+        Queue the prompt on the batching scheduler without waiting: (prompt,
+        future of the raw output). Cancelling the future drops the prompt if
+        no batch has taken it yet; a prompt that can't be built fails the future.
+        """
+        try:
+            with self.telemetry.span("prompt"):
+                prompt = self.format_prompt(query, context)
+        except Exception as e:
+            future: Future = Future()
+            future.set_exception(e)
+            return "", future
+        return prompt, self.scheduler.submit(prompt, max_new_tokens=min(max_new_tokens, 150), timeout=timeout)
+
+    def finish_response(self, prompt: str, future: Future, timeout: Optional[float] = None) -> str:
+        """The answer for a ``submit_response`` future that has finished, failed or been cancelled."""
+        if future.cancelled():
+            return self._error_answer(TimeoutError(), timeout)
+        try:
+            response = future.result(timeout=0)
+        except Exception as e:
+            return self._error_answer(e, timeout)
+        if self.telemetry.enabled and isinstance(response, str):
+            self._record_tokens(prompt, response)
+
+        # Clean up the response
+        if not isinstance(response, str):
+            return "Error: Invalid response format from model"
+
+        answer = response.split("Answer:")[-1].strip()
+        eos_token = self.backend.eos_token
+        return answer.split(eos_token)[0].strip() if eos_token else answer
+
+    def _error_answer(self, error: Exception, timeout: Optional[float]) -> str:
+        if isinstance(error, TimeoutError):
+            self.logger.warning(f"Generation timed out after {timeout} seconds")
+            return f"Error: Generation timed out after {timeout} seconds"
+        self.logger.error(f"Generation error: {str(error)}")
+        return f"Error generating response: {str(error)[:150]}"
+
+    def _record_tokens(self, prompt: str, completion: str) -> None:
+        prompt_tokens = self.backend.count_tokens(prompt)
+        completion_tokens = self.backend.count_tokens(completion)
+        self.telemetry.count("rag_tokens_total", prompt_tokens, kind="prompt")
+        self.telemetry.count("rag_tokens_total", completion_tokens, kind="completion")
+        self.telemetry.annotate(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    def generate_stream(self, query: str, context: List[Union[str, Dict[str, Any]]],
+                        max_new_tokens: int = 100) -> Iterator[str]:
+        """Generate a response, yielding text pieces as soon as the model produces them."""
         try:
-            prompt = self.format_prompt(query, context)
-            
-            # Generate response with explicit parameters
-            response = self.pipeline(
-                prompt,
-                max_new_tokens=min(max_new_tokens, 150),
-                max_length=4096,
-                temperature=0.7,
-                top_p=0.9,
-                do_sample=True,
-                return_full_text=False,
-                pad_token_id=self.tokenizer.eos_token_id,
-                truncation=True,
-                max_time=20
-            )
-            
-            # Clean up the response
-            if not response or not isinstance(response, list) or not response[0].get('generated_text'):
-                return "Error: Invalid response format from model"
-                
-            full_response = response[0]['generated_text']
-            answer = full_response.split("Answer:")[-1].strip()
-            return answer.split(self.tokenizer.eos_token or '')[0].strip()
-            
+            with self.telemetry.span("prompt"):
+                prompt = self.format_prompt(query, context)
+            yield from self.backend.stream(prompt, max_new_tokens=min(max_new_tokens, 150))
+
         except Exception as e:
             self.logger.error(f"Generation error: {str(e)}")
-            return f"Error generating response: {str(e)[:150]}"
\ No newline at end of file
+            yield f"Error generating response: {str(e)[:150]}"
+
+    def report(self) -> Dict[str, Any]:
+        """Load time, resident memory and tokens/s of the active backend, plus scheduler metrics."""
+        return {**self.backend.report(), "scheduler": self.scheduler.metrics()}
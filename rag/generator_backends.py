@@ -0,0 +1,353 @@
+# rag/generator_backends.py
+import copy
+import logging
+import re
+import threading
+import time
+from typing import List, Dict, Any, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PRESET = "mistral-7b"
+
+# Named generator configurations, selectable with Generator(preset=...) or RAG_GENERATOR
+PRESETS: Dict[str, Dict[str, Any]] = {
+    "mistral-7b": {"backend": "hf", "model_name": "mistralai/Mistral-7B-Instruct-v0.1"},
+    "mistral-7b-int8": {"backend": "hf", "model_name": "mistralai/Mistral-7B-Instruct-v0.1", "quantization": "int8"},
+    "mistral-7b-int4": {"backend": "hf", "model_name": "mistralai/Mistral-7B-Instruct-v0.1", "quantization": "int4"},
+    "qwen2.5-1.5b": {"backend": "hf", "model_name": "Qwen/Qwen2.5-1.5B-Instruct"},
+    "qwen2.5-0.5b": {"backend": "hf", "model_name": "Qwen/Qwen2.5-0.5B-Instruct"},
+    "qwen2.5-0.5b-int8": {"backend": "hf", "model_name": "Qwen/Qwen2.5-0.5B-Instruct", "quantization": "int8"},
+    "tinyllama": {"backend": "hf", "model_name": "TinyLlama/TinyLlama-1.1B-Chat-v1.0"},
+    "stub": {"backend": "stub", "model_name": "stub"},
+}
+
+
+def resident_memory_mb() -> float:
+    """Current resident set size of this process in MB (peak RSS if psutil is unavailable)."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except ImportError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class BackendStats:
+    """Load time, memory and token throughput counters for a backend."""
+
+    def __init__(self):
+        self.load_seconds = 0.0
+        self.rss_mb = 0.0
+        self.tokens = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, tokens: int, seconds: float) -> None:
+        with self._lock:
+            self.tokens += tokens
+            self.seconds += seconds
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.tokens / self.seconds if self.seconds else 0.0
+
+
+class GeneratorBackend:
+    """Interface implemented by every generation backend."""
+
+    name = "base"
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.stats = BackendStats()
+
+    def generate(self, prompt: str, max_new_tokens: int = 100) -> str:
+        raise NotImplementedError
+
+    def stream(self, prompt: str, max_new_tokens: int = 100) -> Iterator[str]:
+        yield self.generate(prompt, max_new_tokens)
+
+    def generate_batch(self, prompts: List[str], max_new_tokens: int = 100) -> List[str]:
+        return [self.generate(p, max_new_tokens) for p in prompts]
+
+    def count_tokens(self, text: str) -> int:
+        raise NotImplementedError
+
+    def enable_prefix_cache(self, prefix: str) -> bool:
+        """Precompute state for a prompt prefix shared by every request; False if unsupported."""
+        return False
+
+    def disable_prefix_cache(self) -> None:
+        pass
+
+    @property
+    def eos_token(self) -> str:
+        return ""
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "model": self.model_name,
+            "load_seconds": round(self.stats.load_seconds, 2),
+            "rss_mb": round(self.stats.rss_mb, 1),
+            "tokens_generated": self.stats.tokens,
+            "tokens_per_second": round(self.stats.tokens_per_second, 2)
+        }
+
+
+class HFBackend(GeneratorBackend):
+    """
+    Hugging Face causal LM.
+
+    On CPU the model is loaded fully in memory (no ``device_map="auto"`` disk
+    offload) and can be dynamically quantized: ``int8`` uses
+    ``torch.ao.quantization.quantize_dynamic`` on Linear layers; ``int4``
+    needs bitsandbytes on CUDA and falls back to ``int8`` on CPU.
+
+    With ``enable_prefix_cache`` the past key/values of the fixed prompt
+    preamble are computed once; prompts that start with it only prefill
+    their own suffix. Prompts are then generated one at a time, since left
+    padding would shift the cached prefix out of place.
+    """
+
+    name = "hf"
+
+    def __init__(self, model_name: str, quantization: Optional[str] = None, max_input_tokens: int = 4096):
+        super().__init__(model_name)
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        self.torch = torch
+        self.max_input_tokens = max_input_tokens
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        if quantization == "int4" and self.device == "cpu":
+            logger.warning("int4 quantization needs CUDA + bitsandbytes; using dynamic int8 on CPU")
+            quantization = "int8"
+        self.quantization = quantization
+
+        start = time.perf_counter()
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+
+        load_kwargs = {"trust_remote_code": True}
+        if self.device == "cuda":
+            load_kwargs.update(device_map="auto", torch_dtype=torch.float16)
+            if quantization == "int4":
+                from transformers import BitsAndBytesConfig
+                load_kwargs["quantization_config"] = BitsAndBytesConfig(load_in_4bit=True)
+        else:
+            load_kwargs.update(torch_dtype=torch.float32, low_cpu_mem_usage=True)
+
+        self.model = AutoModelForCausalLM.from_pretrained(model_name, **load_kwargs)
+        if self.device == "cpu" and quantization == "int8":
+            self.model = torch.ao.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        self.model.eval()
+
+        self.stats.load_seconds = time.perf_counter() - start
+        self.stats.rss_mb = resident_memory_mb()
+
+        self._prefix_ids = None
+        self._prefix_cache = None
+        self.prefix_hits = 0
+        self.prefix_misses = 0
+
+    @property
+    def eos_token(self) -> str:
+        return self.tokenizer.eos_token or ""
+
+    def enable_prefix_cache(self, prefix: str) -> bool:
+        ids = self.tokenizer(prefix, return_tensors="pt")["input_ids"].to(self.model.device)
+        with self.torch.no_grad():
+            output = self.model(input_ids=ids, use_cache=True)
+        self._prefix_ids = ids[0].tolist()
+        self._prefix_cache = output.past_key_values
+        logger.info(f"Cached past key/values for a {len(self._prefix_ids)}-token prompt prefix")
+        return True
+
+    def disable_prefix_cache(self) -> None:
+        self._prefix_ids = None
+        self._prefix_cache = None
+
+    def _prefixed_inputs(self, prompt: str) -> Optional[Dict[str, Any]]:
+        """
+        Inputs reusing the cached prefix, or None if ``prompt`` doesn't tokenize
+        to the cached prefix ids followed by a non-empty suffix.
+        """
+        if self._prefix_cache is None:
+            return None
+        input_ids = self.tokenizer(
+            prompt, return_tensors="pt", truncation=True, max_length=self.max_input_tokens
+        )["input_ids"].to(self.model.device)
+        n = len(self._prefix_ids)
+        if input_ids.shape[1] <= n or input_ids[0, :n].tolist() != self._prefix_ids:
+            self.prefix_misses += 1
+            return None
+        self.prefix_hits += 1
+        # generate() appends to the cache in place, so each request gets its own copy
+        return {
+            "input_ids": input_ids,
+            "attention_mask": self.torch.ones_like(input_ids),
+            "past_key_values": copy.deepcopy(self._prefix_cache)
+        }
+
+    def report(self) -> Dict[str, Any]:
+        report = super().report()
+        if self._prefix_cache is not None:
+            report.update(
+                prefix_tokens=len(self._prefix_ids),
+                prefix_hits=self.prefix_hits,
+                prefix_misses=self.prefix_misses
+            )
+        return report
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def _generation_kwargs(self, max_new_tokens: int) -> Dict[str, Any]:
+        return dict(
+            max_new_tokens=max_new_tokens,
+            temperature=0.7,
+            top_p=0.9,
+            do_sample=True,
+            pad_token_id=self.tokenizer.pad_token_id,
+            max_time=20
+        )
+
+    def _encode(self, prompts: List[str]):
+        return self.tokenizer(
+            prompts,
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            max_length=self.max_input_tokens
+        ).to(self.model.device)
+
+    def generate(self, prompt: str, max_new_tokens: int = 100) -> str:
+        return self.generate_batch([prompt], max_new_tokens)[0]
+
+    def generate_batch(self, prompts: List[str], max_new_tokens: int = 100) -> List[str]:
+        if self._prefix_cache is not None:
+            return [self._generate_one(prompt, max_new_tokens) for prompt in prompts]
+        # Left padding keeps every prompt flush against its generated tokens
+        self.tokenizer.padding_side = "left"
+        return self._generate(self._encode(prompts), max_new_tokens)
+
+    def _generate_one(self, prompt: str, max_new_tokens: int) -> str:
+        inputs = self._prefixed_inputs(prompt) or self._encode([prompt])
+        return self._generate(inputs, max_new_tokens)[0]
+
+    def _generate(self, inputs, max_new_tokens: int) -> List[str]:
+        start = time.perf_counter()
+        with self.torch.no_grad():
+            output = self.model.generate(**inputs, **self._generation_kwargs(max_new_tokens))
+        new_tokens = output[:, inputs["input_ids"].shape[1]:]
+        generated = int((new_tokens != self.tokenizer.pad_token_id).sum())
+        self.stats.record(generated, time.perf_counter() - start)
+        return self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+
+    def stream(self, prompt: str, max_new_tokens: int = 100) -> Iterator[str]:
+        from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+
+        inputs = self._prefixed_inputs(prompt) or self._encode([prompt])
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=60)
+        stop = threading.Event()
+        errors = []
+
+        class Cancelled(StoppingCriteria):
+            def __call__(self, input_ids, scores, **kwargs):
+                return stop.is_set()
+
+        def run():
+            try:
+                with self.torch.no_grad():
+                    self.model.generate(**inputs, streamer=streamer,
+                                        stopping_criteria=StoppingCriteriaList([Cancelled()]),
+                                        **self._generation_kwargs(max_new_tokens))
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        # generate() blocks, so it runs on a worker thread while we drain the streamer
+        start = time.perf_counter()
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        pieces = []
+        try:
+            for text in streamer:
+                if text:
+                    pieces.append(text)
+                    yield text
+        finally:
+            # If the caller closes the stream early, generation stops at the next token
+            stop.set()
+            thread.join()
+            self.stats.record(self.count_tokens("".join(pieces)), time.perf_counter() - start)
+        if errors:
+            raise errors[0]
+
+
+class StubBackend(GeneratorBackend):
+    """
+    Deterministic, dependency-free backend for tests and offline benchmarks.
+
+    It "answers" by echoing the opening words of the prompt's context, one
+    whitespace token at a time. ``quantization`` is accepted and ignored, so
+    a quantization override (e.g. in ``RAG_GENERATOR``-driven configs) works
+    with the stub too.
+    """
+
+    name = "stub"
+
+    def __init__(self, model_name: str = "stub", answer_words: int = 40, quantization: Optional[str] = None):
+        super().__init__(model_name)
+        self.answer_words = answer_words
+        start = time.perf_counter()
+        self.stats.load_seconds = time.perf_counter() - start
+        self.stats.rss_mb = resident_memory_mb()
+
+    def count_tokens(self, text: str) -> int:
+        return len(text.split())
+
+    def _answer_words(self, prompt: str, max_new_tokens: int) -> List[str]:
+        match = re.search(r"Context:\s*(.*?)\s*Question:", prompt, re.S)
+        context = match.group(1) if match else prompt
+        words = context.replace("- ", " ").split()
+        return (["Based", "on", "the", "complaints:"] + words)[:min(self.answer_words, max_new_tokens)]
+
+    def generate(self, prompt: str, max_new_tokens: int = 100) -> str:
+        start = time.perf_counter()
+        words = self._answer_words(prompt, max_new_tokens)
+        self.stats.record(len(words), time.perf_counter() - start)
+        return " ".join(words)
+
+    def stream(self, prompt: str, max_new_tokens: int = 100) -> Iterator[str]:
+        start = time.perf_counter()
+        words = self._answer_words(prompt, max_new_tokens)
+        for i, word in enumerate(words):
+            yield word if i == 0 else " " + word
+        self.stats.record(len(words), time.perf_counter() - start)
+
+
+BACKENDS = {
+    "hf": HFBackend,
+    "stub": StubBackend,
+}
+
+
+def resolve_config(preset: Optional[str] = None, **overrides) -> Dict[str, Any]:
+    """Merge a named preset with explicit (non-None) overrides."""
+    if preset not in PRESETS:
+        raise ValueError(f"Unknown generator preset '{preset}'. Available: {', '.join(PRESETS)}")
+    config = dict(PRESETS[preset])
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    return config
+
+
+def create_backend(backend: str = "hf", **kwargs) -> GeneratorBackend:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown generator backend '{backend}'. Available: {', '.join(BACKENDS)}")
+    return BACKENDS[backend](**kwargs)
@@ -0,0 +1,157 @@
+# rag/lexical_index.py
+import json
+import logging
+import math
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+LEXICAL_DIR = "lexical"  # Sub-directory of the Chroma store
+K1 = 1.2
+B = 0.75
+MAX_POSTINGS_PER_TERM = 20000  # Impact-ordered cut-off that bounds query latency
+RRF_K = 60
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "but", "by", "for", "from", "had", "has", "have",
+    "i", "in", "is", "it", "me", "my", "of", "on", "or", "so", "that", "the", "their", "they",
+    "this", "to", "was", "we", "were", "with", "you", "your"
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercase alphanumeric tokens, without stopwords or CFPB ``XXXX`` redactions.
+    Single letters and digits are kept: they carry identifiers such as
+    "Regulation E" or "Chapter 7".
+    """
+    return [
+        token for token in TOKEN_PATTERN.findall((text or "").lower())
+        if token not in STOPWORDS and not token.startswith("xx")
+    ]
+
+
+class LexicalIndexBuilder:
+    """
+    Accumulates documents and writes a compact BM25 index.
+
+    Postings are stored per term as two flat arrays (document number and
+    precomputed BM25 term weight), sorted by weight so a query can read just
+    the strongest ``MAX_POSTINGS_PER_TERM`` entries of very common terms.
+    """
+
+    def __init__(self):
+        self.vocab: Dict[str, int] = {}
+        self.doc_ids: List[str] = []
+        self.doc_lengths: List[int] = []
+        self._terms: List[np.ndarray] = []
+        self._docs: List[np.ndarray] = []
+        self._tfs: List[np.ndarray] = []
+
+    def add(self, ids: Iterable[str], documents: Iterable[str]) -> None:
+        terms, docs, tfs = [], [], []
+        for id_, document in zip(ids, documents):
+            doc_num = len(self.doc_ids)
+            tokens = tokenize(document)
+            self.doc_ids.append(id_)
+            self.doc_lengths.append(len(tokens))
+            for token, tf in Counter(tokens).items():
+                terms.append(self.vocab.setdefault(token, len(self.vocab)))
+                docs.append(doc_num)
+                tfs.append(tf)
+        self._terms.append(np.asarray(terms, dtype=np.uint32))
+        self._docs.append(np.asarray(docs, dtype=np.uint32))
+        self._tfs.append(np.asarray(tfs, dtype=np.float32))
+
+    def write(self, directory: str) -> None:
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+
+        terms = np.concatenate(self._terms) if self._terms else np.zeros(0, dtype=np.uint32)
+        docs = np.concatenate(self._docs) if self._docs else np.zeros(0, dtype=np.uint32)
+        tfs = np.concatenate(self._tfs) if self._tfs else np.zeros(0, dtype=np.float32)
+        lengths = np.asarray(self.doc_lengths, dtype=np.float32)
+        avgdl = float(lengths.mean()) if len(lengths) else 0.0
+
+        # BM25 term weight without idf; idf is applied per query term
+        norm = K1 * (1 - B + B * lengths[docs] / (avgdl or 1.0))
+        weights = tfs * (K1 + 1) / (tfs + norm)
+
+        # Group by term, strongest postings first within each term
+        order = np.lexsort((-weights, terms))
+        terms, docs, weights = terms[order], docs[order], weights[order]
+        starts = np.searchsorted(terms, np.arange(len(self.vocab)), side="left")
+        ends = np.searchsorted(terms, np.arange(len(self.vocab)), side="right")
+
+        np.save(directory / "postings_docs.npy", docs)
+        np.save(directory / "postings_weights.npy", weights.astype(np.float16))
+        width = max((len(i) for i in self.doc_ids), default=1)
+        np.save(directory / "doc_ids.npy", np.asarray(self.doc_ids, dtype=f"S{width}"))
+        with open(directory / "vocab.json", "w", encoding="utf-8") as f:
+            json.dump({term: [int(starts[t]), int(ends[t] - starts[t])] for term, t in self.vocab.items()}, f)
+        with open(directory / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({"num_docs": len(self.doc_ids), "avgdl": avgdl, "k1": K1, "b": B}, f)
+
+
+class LexicalIndex:
+    """Memory-mapped BM25 index written by LexicalIndexBuilder."""
+
+    def __init__(self, directory: str):
+        directory = Path(directory)
+        with open(directory / "meta.json", "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        with open(directory / "vocab.json", "r", encoding="utf-8") as f:
+            self.vocab: Dict[str, List[int]] = json.load(f)
+        self.num_docs = self.meta["num_docs"]
+        self.postings_docs = np.load(directory / "postings_docs.npy", mmap_mode="r")
+        self.postings_weights = np.load(directory / "postings_weights.npy", mmap_mode="r")
+        self.doc_ids = np.load(directory / "doc_ids.npy", mmap_mode="r")
+
+    @classmethod
+    def load(cls, chroma_dir: str):
+        directory = Path(chroma_dir) / LEXICAL_DIR
+        if not (directory / "meta.json").exists():
+            return None
+        try:
+            return cls(directory)
+        except Exception as e:
+            logging.error(f"Error loading lexical index: {str(e)}")
+            return None
+
+    def idf(self, df: int) -> float:
+        return math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, top_k: int = 10) -> List[Tuple[str, float]]:
+        """Return (chunk id, BM25 score) pairs, best first."""
+        doc_parts, score_parts = [], []
+        for token in set(tokenize(query)):
+            entry = self.vocab.get(token)
+            if entry is None:
+                continue
+            start, df = entry
+            stop = start + min(df, MAX_POSTINGS_PER_TERM)
+            doc_parts.append(np.asarray(self.postings_docs[start:stop]))
+            score_parts.append(np.asarray(self.postings_weights[start:stop], dtype=np.float32) * self.idf(df))
+        if not doc_parts:
+            return []
+
+        docs = np.concatenate(doc_parts)
+        unique_docs, inverse = np.unique(docs, return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+        k = min(top_k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.doc_ids[unique_docs[i]].decode("utf-8"), float(scores[i])) for i in top]
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = RRF_K) -> List[Tuple[str, float]]:
+    """Fuse several ranked id lists: score(id) = sum of 1 / (k + rank)."""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, id_ in enumerate(ranking, start=1):
+            scores[id_] = scores.get(id_, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
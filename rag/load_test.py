@@ -0,0 +1,160 @@
+# rag/load_test.py
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Any, Dict, List
+
+from .cluster import ClusterCore, add_cluster_args, pipeline_config_from_args
+from .evaluation import TEST_QUESTIONS
+from .service import ServiceBusy
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Throughput of the multi-process service as the number of workers grows from 1 to N."
+    )
+    parser.add_argument("--max-workers", type=int, default=4, help="Largest worker count (N)")
+    parser.add_argument("--scale", default="retrieve", choices=["retrieve", "generate", "both"],
+                        help="Which pool grows; the other keeps --fixed-workers")
+    parser.add_argument("--fixed-workers", type=int, default=1)
+    parser.add_argument("--mode", default="retrieve", choices=["retrieve", "query", "mixed"],
+                        help="Retrieval-only calls, full queries, or a mix (see --query-share)")
+    parser.add_argument("--query-share", type=float, default=0.2, help="Fraction of full queries in mixed mode")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per worker count")
+    parser.add_argument("--questions", help="JSONL question file (default: TEST_QUESTIONS)")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-query generation timeout (s)")
+    parser.add_argument("--output", default="load_test.json")
+    parser.add_argument("--seed", type=int, default=42)
+    add_cluster_args(parser)
+    args = parser.parse_args(argv)
+    if not args.generator:
+        args.generator = "stub"  # Keeps generation cheap and offline unless a real preset is given
+    return args
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run_load(core: ClusterCore, questions: List[str], args) -> Dict[str, Any]:
+    """Send ``args.requests`` requests from ``args.concurrency`` clients; latencies are per request kind."""
+    rng = random.Random(args.seed)
+    plan = []
+    for i in range(args.requests):
+        kind = args.mode
+        if kind == "mixed":
+            kind = "query" if rng.random() < args.query_share else "retrieve"
+        plan.append((kind, questions[i % len(questions)]))
+
+    latencies: Dict[str, List[float]] = {"retrieve": [], "query": []}
+    errors = {"busy": 0, "failed": 0}
+    next_item = iter(plan)
+
+    async def client():
+        for kind, question in next_item:
+            start = time.perf_counter()
+            try:
+                if kind == "retrieve":
+                    await core.retrieve(question, args.k)
+                else:
+                    response = await core.query(question, args.k, use_cache=False, timeout=args.timeout)
+                    if response["answer"].startswith("Error"):
+                        errors["failed"] += 1
+                        continue
+            except ServiceBusy:
+                errors["busy"] += 1
+                continue
+            except Exception:
+                errors["failed"] += 1
+                continue
+            latencies[kind].append((time.perf_counter() - start) * 1000)
+
+    wall = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(args.concurrency)])
+    seconds = time.perf_counter() - wall
+
+    completed = sum(len(values) for values in latencies.values())
+    result: Dict[str, Any] = {"seconds": round(seconds, 2), "completed": completed,
+                              "throughput_rps": completed / seconds if seconds else 0.0, **errors}
+    for kind, values in latencies.items():
+        if values:
+            result[kind] = {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.5), 1),
+                "p95_ms": round(percentile(values, 0.95), 1),
+                "p99_ms": round(percentile(values, 0.99), 1)
+            }
+    return result
+
+
+async def measure(core: ClusterCore, questions: List[str], args) -> Dict[str, Any]:
+    # One warm-up pass so first-call costs (tokenizers, page faults) aren't measured
+    await run_load(core, questions, argparse.Namespace(**{**vars(args), "requests": args.concurrency}))
+    return await run_load(core, questions, args)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.questions:
+        from .run_evaluation import load_questions
+        questions = load_questions(args.questions)
+    else:
+        questions = list(TEST_QUESTIONS)
+
+    results: Dict[str, Any] = {"config": vars(args), "cpu_count": os.cpu_count(), "runs": []}
+    baseline = None
+    print(f"Load test: {args.requests} {args.mode} requests, {args.concurrency} clients, "
+          f"scaling {args.scale} workers 1..{args.max_workers}")
+    for workers in range(1, args.max_workers + 1):
+        retrieve_workers = workers if args.scale in ("retrieve", "both") else args.fixed_workers
+        generate_workers = workers if args.scale in ("generate", "both") else args.fixed_workers
+        core = ClusterCore(
+            retrieve_workers=retrieve_workers,
+            generate_workers=generate_workers,
+            pipeline_config=pipeline_config_from_args(args),
+            retrieve_threads=args.retrieve_threads,
+            generate_threads=args.generate_threads,
+            torch_threads=args.torch_threads,
+            max_in_flight=args.concurrency,
+            max_waiting=args.concurrency,
+            queue_timeout=args.timeout
+        )
+        try:
+            load_start = time.perf_counter()
+            if not core.wait_ready():
+                print(f"Workers failed to start: {json.dumps(core.stats()['workers'])}")
+                return 1
+            load_seconds = time.perf_counter() - load_start
+            run = asyncio.run(measure(core, questions, args))
+        finally:
+            core.shutdown()
+
+        run.update(retrieve_workers=retrieve_workers, generate_workers=generate_workers,
+                   startup_seconds=round(load_seconds, 1))
+        baseline = baseline or run["throughput_rps"]
+        run["speedup"] = run["throughput_rps"] / baseline if baseline else 0.0
+        run["efficiency"] = run["speedup"] / workers
+        results["runs"].append(run)
+
+        latency = run.get("retrieve") or run.get("query") or {}
+        print(f"{retrieve_workers} retrieve / {generate_workers} generate: {run['throughput_rps']:.1f} req/s "
+              f"(x{run['speedup']:.2f}, {run['efficiency']:.0%} efficiency)  "
+              f"p50 {latency.get('p50_ms', 0):.0f} ms  p95 {latency.get('p95_ms', 0):.0f} ms  "
+              f"busy {run['busy']}  failed {run['failed']}")
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,124 @@
+# rag/model_registry.py
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    """
+    Process-wide home for the expensive objects: embedder, Chroma client and
+    collection, generator, retriever.
+
+    Each component is built lazily on first ``get`` (or by ``warm_up`` in a
+    background thread) and then shared by every caller in the process. Load
+    times and state are kept per component for readiness/health checks.
+    """
+
+    def __init__(self):
+        self._instances: Dict[str, Any] = {}
+        self._status: Dict[str, Dict[str, Any]] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._guard = threading.Lock()
+
+    def _lock_for(self, key: str) -> threading.Lock:
+        with self._guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def get(self, key: str, loader: Callable[[], Any]) -> Any:
+        """Return the component stored under ``key``, loading it once if needed."""
+        instance = self._instances.get(key)
+        if instance is not None:
+            return instance
+
+        with self._lock_for(key):
+            if key in self._instances:
+                return self._instances[key]
+
+            self._status[key] = {"state": "loading", "started_at": time.time()}
+            start = time.perf_counter()
+            try:
+                instance = loader()
+            except Exception as e:
+                self._status[key] = {"state": "error", "error": str(e)[:200],
+                                     "seconds": time.perf_counter() - start}
+                logger.error(f"Failed to load {key}: {str(e)}")
+                raise
+
+            seconds = time.perf_counter() - start
+            self._instances[key] = instance
+            self._status[key] = {"state": "ready", "seconds": round(seconds, 2)}
+            logger.info(f"Loaded {key} in {seconds:.1f}s")
+            return instance
+
+    def embedder(self, model_name: str = "all-MiniLM-L6-v2"):
+        def load():
+            from sentence_transformers import SentenceTransformer
+            return SentenceTransformer(model_name)
+        return self.get(f"embedder:{model_name}", load)
+
+    def chroma_client(self, chroma_dir: str = "vector_store/chroma"):
+        def load():
+            import chromadb
+            return chromadb.PersistentClient(path=chroma_dir)
+        return self.get(f"chroma:{chroma_dir}", load)
+
+    def collection(self, chroma_dir: str = "vector_store/chroma", name: str = "cfpb_complaints"):
+        return self.get(f"collection:{chroma_dir}:{name}",
+                        lambda: self.chroma_client(chroma_dir).get_collection(name))
+
+    @staticmethod
+    def generator_key(**config) -> str:
+        return f"generator:{json.dumps(config, sort_keys=True)}"
+
+    def generator(self, **config):
+        def load():
+            from .generator import Generator
+            return Generator(**config)
+        return self.get(self.generator_key(**config), load)
+
+    def warm_up(self, loaders: Dict[str, Callable[[], Any]], background: bool = True) -> Optional[threading.Thread]:
+        """
+        Call each loader in turn (typically lambdas around ``get``), optionally on
+        a daemon thread so the caller can start serving immediately.
+        """
+        def run():
+            start = time.perf_counter()
+            for name, loader in loaders.items():
+                try:
+                    loader()
+                except Exception:
+                    logger.exception(f"Warm-up of {name} failed")
+            logger.info(f"Warm-up finished in {time.perf_counter() - start:.1f}s: {self.timings()}")
+
+        if not background:
+            run()
+            return None
+        thread = threading.Thread(target=run, name="model-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def is_ready(self, keys: Iterable[str]) -> bool:
+        return all(self._status.get(key, {}).get("state") == "ready" for key in keys)
+
+    def timings(self) -> Dict[str, float]:
+        """Load time in seconds of every component loaded so far."""
+        return {key: status["seconds"] for key, status in self._status.items() if "seconds" in status}
+
+    def status(self) -> Dict[str, Any]:
+        components = {key: dict(status) for key, status in self._status.items()}
+        return {
+            "ready": bool(components) and all(s["state"] == "ready" for s in components.values()),
+            "components": components
+        }
+
+
+_registry = ModelRegistry()
+
+
+def get_registry() -> ModelRegistry:
+    """The registry shared by everything in this process."""
+    return _registry
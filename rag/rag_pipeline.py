@@ -1,25 +1,354 @@
 # rag/rag_pipeline.py
 from .retriever import Retriever
+from .analytics import AnalyticsCube, CUBE_FIELDS
 from .generator import Generator
-from typing import Dict, Any
+from .answer_cache import SemanticAnswerCache
+from .model_registry import get_registry
+from .reranker import Reranker
+from .telemetry import get_telemetry
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+import hashlib
+import time
 
 class RAGPipeline:
-    def __init__(self, chroma_dir: str = "vector_store/chroma", model_name: str = "all-MiniLM-L6-v2"):
-        self.retriever = Retriever(chroma_dir=chroma_dir, model_name=model_name)
-        self.generator = Generator()
+    def __init__(self, chroma_dir: str = "vector_store/chroma", model_name: str = "all-MiniLM-L6-v2",
+                 answer_cache_size: int = 256, answer_cache_threshold: float = 0.95,
+                 generator_config: Optional[Dict[str, Any]] = None, search_mode: str = "vector",
+                 rerank: bool = False, rerank_candidates: int = 50, rerank_budget_ms: float = 500.0,
+                 vector_backend: str = "chroma", analytics: str = "context"):
+        # Models are loaded lazily (or by warm_up) and shared through the registry,
+        # so constructing a pipeline is cheap
+        self.chroma_dir = chroma_dir
+        self.model_name = model_name
+        self.search_mode = search_mode
+        self.vector_backend = vector_backend  # e.g. "matrix-int8" for compact vectors with exact rescoring
+        self.generator_config = generator_config or {}
+        self.registry = get_registry()
+        self.telemetry = get_telemetry()
+        self.answer_cache = SemanticAnswerCache(answer_cache_size, answer_cache_threshold)
 
-    def query(self, question: str, k: int = 3) -> Dict[str, Any]:
-        # Retrieve documents
-        retrieved = self.retriever.retrieve(question, k)
+        # Optional cross-encoder stage: over-fetch rerank_candidates, keep the best k
+        self.rerank_candidates = rerank_candidates
+        self.reranker = Reranker(budget_ms=rerank_budget_ms) if rerank else None
 
-        # ✅ Extract only text for the generator
-        context_texts = [r["text"] for r in retrieved]
+        # Aggregate questions ("most common issues with credit cards") get exact counts from the
+        # analytics cube: "context" pins them to the top of the prompt, "direct" also answers
+        # explicit count questions with the counts alone (no retrieval or generation), "off"
+        # disables it
+        self.analytics = analytics
 
-        # Generate answer
-        answer = self.generator.generate_response(question, context_texts)
+    @property
+    def _retriever_key(self) -> str:
+        return f"retriever:{self.chroma_dir}:{self.model_name}:{self.search_mode}:{self.vector_backend}"
 
+    @property
+    def retriever(self) -> Retriever:
+        return self.registry.get(
+            self._retriever_key,
+            lambda: Retriever(chroma_dir=self.chroma_dir, model_name=self.model_name, search_mode=self.search_mode,
+                              vector_backend=self.vector_backend)
+        )
+
+    @property
+    def analytics_cube(self) -> Optional[AnalyticsCube]:
+        """The store's analytics cube, or None if it was built without one."""
+        return self.registry.get(f"analytics:{self.chroma_dir}", lambda: AnalyticsCube.load(self.chroma_dir))
+
+    @property
+    def generator(self) -> Generator:
+        return self.registry.generator(**self.generator_config)
+
+    def warm_up(self, background: bool = True):
+        """Load the retriever and generator, by default on a background thread."""
+        return self.registry.warm_up({
+            "retriever": lambda: self.retriever,
+            "generator": lambda: self.generator
+        }, background=background)
+
+    @property
+    def ready(self) -> bool:
+        return self.registry.is_ready([
+            self._retriever_key,
+            self.registry.generator_key(**self.generator_config)
+        ])
+
+    @property
+    def retriever_ready(self) -> bool:
+        """Ready for retrieval-only requests, which never load the generator."""
+        return self.registry.is_ready([self._retriever_key])
+
+    def status(self) -> Dict[str, Any]:
+        """Readiness plus per-component load state and timings."""
+        return {**self.registry.status(), "ready": self.ready}
+
+    def _retrieve(self, question: str, k: int,
+                  where: Optional[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """Retrieve (and optionally re-rank) sources, returning them with per-stage timings."""
+        start = time.perf_counter()
+        fetch_k = max(k, self.rerank_candidates) if self.reranker is not None else k
+        retrieved = self.retriever.retrieve(question, fetch_k, where=where)
+        timings: Dict[str, Any] = {"retrieve_ms": round((time.perf_counter() - start) * 1000, 1)}
+
+        if self.reranker is not None:
+            with self.telemetry.span("rerank"):
+                retrieved, info = self.reranker.rerank(question, retrieved, k)
+            timings.update(info)
+        return retrieved, timings
+
+    def aggregate(self, question: str, where: Optional[Dict[str, Any]] = None) -> Optional[Dict[str, Any]]:
+        """
+        Exact complaint counts if ``question`` is an aggregate question the
+        cube can answer, with a ``summary`` text; None otherwise.
+        """
+        if self.analytics == "off":
+            return None
+        # Filters outside the cube's dimensions would make the counts answer a different question
+        if where and any(key not in CUBE_FIELDS or isinstance(value, dict) for key, value in where.items()):
+            return None
+        cube = self.analytics_cube
+        if cube is None:
+            return None
+
+        start = time.perf_counter()
+        with self.telemetry.span("analytics"):
+            parsed = cube.parse(question)
+            if parsed is None:
+                return None
+            explicit = parsed.pop("explicit")
+            parsed["where"].update({key: str(value) for key, value in (where or {}).items()})
+            result = cube.aggregate(**parsed)
+            result["explicit"] = explicit
+            result["summary"] = cube.describe(result)
+        result["analytics_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        self.telemetry.annotate(analytics=True)
+        return result
+
+    @staticmethod
+    def _analytics_source(aggregate: Dict[str, Any]) -> Dict[str, Any]:
+        """The counts as a source pinned to the top of the prompt context."""
+        summary = aggregate["summary"]
+        return {
+            "id": "analytics:" + hashlib.sha1(summary.encode("utf-8")).hexdigest()[:16],
+            "text": summary,
+            "metadata": {"source": "analytics"},
+            "pinned": True
+        }
+
+    def _aggregate_response(self, question: str, aggregate: Dict[str, Any]) -> Dict[str, Any]:
         return {
             "question": question,
+            "answer": aggregate["summary"],
+            "sources": [],
+            "cached": False,
+            "analytics": aggregate,
+            "timings": {"analytics_ms": aggregate["analytics_ms"], "total_ms": aggregate["analytics_ms"]}
+        }
+
+    def retrieve(self, question: str, k: int = 3,
+                 where: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Sources for ``question`` without generating an answer."""
+        retrieved, timings = self._retrieve(question, k, where)
+        return {"question": question, "sources": retrieved, "timings": timings}
+
+    def _cached_answer(self, question: str, retrieved: List[Dict[str, Any]], use_cache: bool,
+                       question_embedding: Any = None) -> Tuple[Optional[str], Any]:
+        """
+        Return (cached answer or None, question embedding to store the new answer under).
+        A ``question_embedding`` computed elsewhere (e.g. by a retrieval worker) saves loading the embedder.
+        """
+        if not use_cache or not retrieved:
+            return None, None
+        if question_embedding is None:
+            question_embedding = self.retriever.embed(question)
+        cached = self.answer_cache.get(question_embedding, [r.get("id") for r in retrieved])
+        return (cached["answer"] if cached else None), question_embedding
+
+    def _store_answer(self, question_embedding, retrieved: List[Dict[str, Any]], answer: str) -> None:
+        if question_embedding is not None and not answer.startswith("Error"):
+            self.answer_cache.put(question_embedding, [r.get("id") for r in retrieved], {"answer": answer})
+
+    def retrieve_many(self, questions: List[str], k: int = 3,
+                      where: Optional[Dict[str, Any]] = None) -> List[Tuple[List[Dict[str, Any]], Dict[str, Any]]]:
+        """Batched ``_retrieve``: one encode and vector query for all questions, then per-question re-ranking."""
+        start = time.perf_counter()
+        fetch_k = max(k, self.rerank_candidates) if self.reranker is not None else k
+        batches = self.retriever.retrieve_many(questions, fetch_k, where=where)
+        per_question_ms = round((time.perf_counter() - start) * 1000 / max(1, len(questions)), 1)
+
+        results = []
+        for question, retrieved in zip(questions, batches):
+            timings: Dict[str, Any] = {"retrieve_ms": per_question_ms}
+            if self.reranker is not None:
+                retrieved, info = self.reranker.rerank(question, retrieved, k)
+                timings.update(info)
+            results.append((retrieved, timings))
+        return results
+
+    def answer(self, question: str, retrieved: List[Dict[str, Any]], use_cache: bool = True,
+               timeout: Optional[float] = None, question_embedding: Any = None) -> Dict[str, Any]:
+        """
+        Generate (or reuse a cached) answer grounded in already retrieved
+        sources. Generation goes through the batching scheduler.
+        """
+        pending = self.submit_answer(question, retrieved, use_cache, timeout, question_embedding)
+        if pending["future"] is not None:
+            with self.telemetry.span("generate"):
+                self.generator.scheduler.wait(pending["future"], timeout)
+        return self.finish_answer(pending)
+
+    def submit_answer(self, question: str, retrieved: List[Dict[str, Any]], use_cache: bool = True,
+                      timeout: Optional[float] = None, question_embedding: Any = None) -> Dict[str, Any]:
+        """
+        Non-blocking first half of ``answer``: on an answer cache hit the
+        pending answer holds the finished ``response``, otherwise the
+        ``future`` of its prompt on the batching scheduler (cancel it to drop
+        a prompt no batch has taken yet). ``finish_answer`` completes it once
+        the future is done.
+        """
+        # Reuse the answer of a near-identical question grounded in the same sources
+        cached_answer, question_embedding = self._cached_answer(question, retrieved, use_cache, question_embedding)
+        if use_cache and retrieved:
+            self.telemetry.count("rag_cache_events_total", cache="answer",
+                                 result="miss" if cached_answer is None else "hit")
+        self.telemetry.annotate(answer_cached=cached_answer is not None, sources=len(retrieved))
+        pending: Dict[str, Any] = {"question": question, "retrieved": retrieved, "future": None}
+        if cached_answer is not None:
+            pending["response"] = {
+                "question": question,
+                "answer": cached_answer,
+                "sources": retrieved,
+                "cached": True,
+                "timings": {}
+            }
+            return pending
+
+        # Sources are passed whole so the packer can use scores and complaint ids
+        pending["started"] = time.perf_counter()
+        pending["prompt"], pending["future"] = self.generator.submit_response(question, retrieved, timeout=timeout)
+        pending.update(timeout=timeout, question_embedding=question_embedding)
+        return pending
+
+    def finish_answer(self, pending: Dict[str, Any]) -> Dict[str, Any]:
+        """The response for a ``submit_answer`` result whose future is done (or abandoned after a timeout)."""
+        if pending["future"] is None:
+            return pending["response"]
+        answer = self.generator.finish_response(pending["prompt"], pending["future"], pending["timeout"])
+        timings = {"generate_ms": round((time.perf_counter() - pending["started"]) * 1000, 1)}
+        self._store_answer(pending["question_embedding"], pending["retrieved"], answer)
+        return {
+            "question": pending["question"],
             "answer": answer,
-            "sources": retrieved
+            "sources": pending["retrieved"],
+            "cached": False,
+            "timings": timings
         }
+
+    def prepare(self, question: str, k: int = 3, where: Optional[Dict[str, Any]] = None
+                ) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        Everything before generation: (finished response, [], {}) when the
+        analytics cube answers an explicit count question directly, otherwise
+        (None, the sources to generate from, timings).
+        """
+        aggregate = self.aggregate(question, where)
+        if aggregate is not None and aggregate["explicit"] and self.analytics == "direct":
+            return self._aggregate_response(question, aggregate), [], {}
+
+        retrieved, timings = self._retrieve(question, k, where)
+        if aggregate is not None:
+            retrieved = [self._analytics_source(aggregate)] + retrieved
+            timings["analytics_ms"] = aggregate["analytics_ms"]
+        return None, retrieved, timings
+
+    def prepare_many(self, questions: List[str], k: int = 3, where: Optional[Dict[str, Any]] = None
+                     ) -> List[Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]], Dict[str, Any]]]:
+        """Batched ``prepare``: questions not answered by the analytics cube share one ``retrieve_many``."""
+        aggregates = [self.aggregate(question, where) for question in questions]
+        results: List[Any] = [None] * len(questions)
+        pending = []
+        for i, (question, aggregate) in enumerate(zip(questions, aggregates)):
+            if aggregate is not None and aggregate["explicit"] and self.analytics == "direct":
+                results[i] = (self._aggregate_response(question, aggregate), [], {})
+            else:
+                pending.append(i)
+
+        retrieved = self.retrieve_many([questions[i] for i in pending], k, where) if pending else []
+        for i, (sources, timings) in zip(pending, retrieved):
+            if aggregates[i] is not None:
+                sources = [self._analytics_source(aggregates[i])] + sources
+                timings["analytics_ms"] = aggregates[i]["analytics_ms"]
+            results[i] = (None, sources, timings)
+        return results
+
+    def query(self, question: str, k: int = 3, use_cache: bool = True,
+              timeout: Optional[float] = None, where: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        with self.telemetry.trace("query"):
+            # Retrieve documents (or answer from the analytics cube)
+            start = time.perf_counter()
+            direct, retrieved, timings = self.prepare(question, k, where)
+            if direct is not None:
+                return direct
+
+            response = self.answer(question, retrieved, use_cache=use_cache, timeout=timeout)
+            timings.update(response["timings"])
+            timings["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            response["timings"] = timings
+            return response
+
+    def query_stream(self, question: str, k: int = 3, use_cache: bool = True,
+                     where: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Stream a response as events: ``sources`` first, then ``token`` pieces,
+        then ``done`` with the full answer.
+        """
+        start = time.perf_counter()
+        direct, retrieved, timings = self.prepare(question, k, where)
+        if direct is not None:
+            yield {"type": "sources", "sources": []}
+            yield {"type": "token", "text": direct["answer"]}
+            yield {"type": "done", "answer": direct["answer"], "cached": False, "timings": direct["timings"]}
+            return
+
+        yield {"type": "sources", "sources": retrieved}
+        yield from self.answer_stream(question, retrieved, use_cache, timings, start)
+
+    def answer_stream(self, question: str, retrieved: List[Dict[str, Any]], use_cache: bool = True,
+                      timings: Optional[Dict[str, Any]] = None, start: Optional[float] = None,
+                      question_embedding: Any = None) -> Iterator[Dict[str, Any]]:
+        """
+        Streaming ``answer``: ``token`` events, then ``done``. ``timings`` and
+        ``start`` carry over from retrieval when it ran in the same call;
+        ``question_embedding`` keys the answer cache without loading the embedder.
+        """
+        timings = dict(timings or {})
+        start = time.perf_counter() if start is None else start
+        cached_answer, question_embedding = self._cached_answer(question, retrieved, use_cache, question_embedding)
+        if cached_answer is not None:
+            timings["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            yield {"type": "token", "text": cached_answer}
+            yield {"type": "done", "answer": cached_answer, "cached": True, "timings": timings}
+            return
+
+        pieces = []
+        generate_start = time.perf_counter()
+        stream = self.generator.generate_stream(question, retrieved)
+        try:
+            for text in stream:
+                if not pieces:
+                    timings["first_token_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                    self.telemetry.observe("rag_time_to_first_token_seconds", time.perf_counter() - start)
+                pieces.append(text)
+                yield {"type": "token", "text": text}
+        finally:
+            # Closing this generator (e.g. the client disconnected) stops the backend's generation
+            stream.close()
+        timings["generate_ms"] = round((time.perf_counter() - generate_start) * 1000, 1)
+
+        answer = "".join(pieces).strip()
+        self._store_answer(question_embedding, retrieved, answer)
+        timings["total_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        # Streams hop between worker threads, so they are measured here rather than with a trace
+        self.telemetry.observe("rag_stage_seconds", timings["generate_ms"] / 1000, stage="generate_stream")
+        self.telemetry.observe("rag_request_seconds", timings["total_ms"] / 1000, request="query_stream")
+        self.telemetry.count("rag_requests_total", request="query_stream")
+        yield {"type": "done", "answer": answer, "cached": False, "timings": timings}
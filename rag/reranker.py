@@ -0,0 +1,137 @@
+# rag/reranker.py
+import logging
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from .lexical_index import tokenize
+from .model_registry import get_registry
+
+RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+
+def _similarity(a: Dict[str, Any], b: Dict[str, Any], tokens: Dict[int, set]) -> float:
+    """
+    Redundancy between two chunks: 1.0 for neighbouring chunks of the same
+    complaint (they share the 50-character overlap), else token Jaccard.
+    """
+    meta_a, meta_b = a.get("metadata") or {}, b.get("metadata") or {}
+    if meta_a.get("complaint_id") is not None and meta_a.get("complaint_id") == meta_b.get("complaint_id"):
+        try:
+            if abs(int(meta_a.get("chunk_index", 0)) - int(meta_b.get("chunk_index", 0))) <= 1:
+                return 1.0
+        except (TypeError, ValueError):
+            pass
+    ta, tb = tokens[id(a)], tokens[id(b)]
+    if not ta or not tb:
+        return 0.0
+    return len(ta & tb) / len(ta | tb)
+
+
+def mmr(candidates: List[Dict[str, Any]], relevance: List[float], top_k: int,
+        diversity: float = 0.3) -> List[int]:
+    """
+    Maximal marginal relevance: pick indices maximizing
+    ``(1 - diversity) * relevance - diversity * max_similarity_to_selected``.
+    """
+    if not candidates:
+        return []
+    low, high = min(relevance), max(relevance)
+    scale = (high - low) or 1.0
+    norm = [(r - low) / scale for r in relevance]
+    tokens = {id(c): set(tokenize(c.get("text", ""))) for c in candidates}
+
+    selected: List[int] = []
+    remaining = list(range(len(candidates)))
+    while remaining and len(selected) < top_k:
+        best, best_score = remaining[0], float("-inf")
+        for i in remaining:
+            redundancy = max((_similarity(candidates[i], candidates[j], tokens) for j in selected), default=0.0)
+            score = (1 - diversity) * norm[i] - diversity * redundancy
+            if score > best_score:
+                best, best_score = i, score
+        selected.append(best)
+        remaining.remove(best)
+    return selected
+
+
+class Reranker:
+    """
+    Cross-encoder re-ranking of over-fetched candidates under a latency budget.
+
+    Pairs are scored in batches sized from the measured per-pair cost, so a
+    batch is only started if it is expected to finish within ``budget_ms``;
+    if the rest of the candidates (or, from previous queries, all of them)
+    wouldn't fit, the vector order is used instead. The budget holds up to
+    the error of that estimate: before anything is measured a single pair is
+    scored to measure it. MMR is applied either way so near-duplicate chunks
+    of the same complaint don't crowd out the context.
+    """
+
+    def __init__(self, model_name: str = RERANK_MODEL, batch_size: int = 16, budget_ms: float = 500.0,
+                 diversity: float = 0.3):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.budget = budget_ms / 1000.0
+        self.diversity = diversity
+        self._seconds_per_pair: Optional[float] = None
+
+    @property
+    def model(self):
+        def load():
+            from sentence_transformers import CrossEncoder
+            return CrossEncoder(self.model_name)
+        return get_registry().get(f"cross_encoder:{self.model_name}", load)
+
+    def _score(self, query: str, candidates: List[Dict[str, Any]]) -> Optional[List[float]]:
+        """Cross-encoder scores, or None if the budget ran out."""
+        if self._seconds_per_pair is not None and self._seconds_per_pair * len(candidates) > self.budget:
+            # Decay the estimate so a transient slowdown doesn't disable re-ranking for good
+            self._seconds_per_pair *= 0.9
+            return None
+        model = self.model
+        start = time.perf_counter()
+        estimate = self._seconds_per_pair
+        scores: List[float] = []
+        while len(scores) < len(candidates):
+            size = min(self.batch_size, len(candidates) - len(scores))
+            if estimate is None:
+                size = 1
+            else:
+                # Only as many pairs as are expected to finish within the budget
+                size = min(size, int((self.budget - (time.perf_counter() - start)) / max(estimate, 1e-9)))
+                if size < 1:
+                    return None
+            pairs = [(query, c.get("text", "")) for c in candidates[len(scores):len(scores) + size]]
+            batch_start = time.perf_counter()
+            scores.extend(float(s) for s in model.predict(pairs, batch_size=self.batch_size))
+            estimate = (time.perf_counter() - batch_start) / len(pairs)
+        per_pair = (time.perf_counter() - start) / max(1, len(candidates))
+        self._seconds_per_pair = per_pair if self._seconds_per_pair is None else 0.8 * self._seconds_per_pair + 0.2 * per_pair
+        return scores
+
+    def rerank(self, query: str, candidates: List[Dict[str, Any]],
+               top_k: int = 3) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """Return the best ``top_k`` candidates and stage info (timing, whether the cross-encoder ran)."""
+        start = time.perf_counter()
+        info: Dict[str, Any] = {"candidates": len(candidates), "reranked": False}
+        if not candidates:
+            info["rerank_ms"] = 0.0
+            return [], info
+
+        try:
+            scores = self._score(query, candidates)
+        except Exception as e:
+            logging.error(f"Error in rerank: {str(e)}")
+            scores = None
+
+        if scores is not None:
+            info["reranked"] = True
+            for candidate, score in zip(candidates, scores):
+                candidate["rerank_score"] = score
+        else:
+            # Fall back to the retriever's order
+            scores = [-float(i) for i in range(len(candidates))]
+
+        selected = mmr(candidates, scores, top_k, self.diversity)
+        info["rerank_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        return [candidates[i] for i in selected], info
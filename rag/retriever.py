@@ -1,41 +1,364 @@
 # retriever.py
-from typing import List, Dict, Any
-from sentence_transformers import SentenceTransformer
-import chromadb
+from typing import List, Dict, Any, Optional, Callable
+from concurrent.futures import Future
+from pathlib import Path
+from .cache import LRUCache, normalize_query, read_store_version
+from .model_registry import get_registry
+from .telemetry import get_telemetry
+from .facets import FacetIndex
+from .lexical_index import LexicalIndex, reciprocal_rank_fusion
+from .vector_backends import INDEX_DIR, VectorBackend, create_vector_backend, index_is_current
+import atexit
+import json
 import logging
+import pickle
+import queue
+import threading
+import time
+
+CACHE_CHECK_INTERVAL = 30.0  # Seconds between collection change checks
+HYBRID_CANDIDATES = 20  # Per-retriever candidates fed into reciprocal-rank fusion
+
+
+class MicroBatcher:
+    """Gather concurrent single-query calls for a few milliseconds and run them as one batch."""
+
+    def __init__(self, batch_fn: Callable[[List[str], int], List[List[Dict[str, Any]]]],
+                 max_wait_ms: float = 5.0, max_batch_size: int = 32):
+        self.batch_fn = batch_fn
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="retriever-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, query: str, top_k: int) -> Future:
+        future = Future()
+        self._queue.put((query, top_k, future))
+        return future
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _collect(self, first) -> list:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Re-queue the sentinel so the loop exits after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            queries = [query for query, _, _ in batch]
+            # One n_results per Chroma call: fetch the largest k and trim per caller
+            top_k = max(k for _, k, _ in batch)
+            try:
+                results = self.batch_fn(queries, top_k)
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, k, future), result in zip(batch, results):
+                future.set_result(result[:k])
+
 
 class Retriever:
-    def __init__(self, chroma_dir: str = "vector_store/chroma", model_name: str = "all-MiniLM-L6-v2"):
-        # Initialize the sentence transformer model
-        self.model = SentenceTransformer(model_name)
-        
-        # Initialize Chroma client
-        self.chroma_client = chromadb.PersistentClient(path=chroma_dir)
-        self.collection = self.chroma_client.get_collection("cfpb_complaints")
-        
-    def retrieve(self, query: str, top_k: int = 3) -> List[Dict[str, Any]]:
-        """Retrieve top-k most relevant documents for the query."""
+    def __init__(self, chroma_dir: str = "vector_store/chroma", model_name: str = "all-MiniLM-L6-v2",
+                 batch_window_ms: float = 0.0, max_batch_size: int = 32,
+                 cache_size: int = 1024, cache_ttl: Optional[float] = None, cache_path: Optional[str] = None,
+                 search_mode: str = "vector", vector_backend: str = "chroma", index_dir: str = INDEX_DIR,
+                 backend_options: Optional[Dict[str, Any]] = None):
+        # Sentence transformer and Chroma client are shared process-wide via the registry
+        registry = get_registry()
+        self.telemetry = get_telemetry()
+        self.chroma_dir = chroma_dir
+        self.model_name = model_name
+        self.model = registry.embedder(model_name)
+        self.chroma_client = registry.chroma_client(chroma_dir)
+        self.collection = registry.collection(chroma_dir, "cfpb_complaints")
+
+        # Facet index written at ingest time (None for stores built without one)
+        self.facets = FacetIndex.load(chroma_dir)
+
+        # Nearest-neighbour search: Chroma's HNSW, an mmap'd matrix (optionally scanned as
+        # float16/int8 and rescored exactly) or a FAISS index (see rag.vector_backends);
+        # documents and metadata always come from Chroma
+        self.vector_backend = vector_backend
+        self.index_dir = index_dir
+        self.backend_options = backend_options or {}
+        self.backend = self._open_backend()
+
+        # BM25 index for hybrid search; postings stay memory-mapped on disk
+        self.search_mode = search_mode
+        self.lexical = LexicalIndex.load(chroma_dir)
+        if search_mode == "hybrid" and self.lexical is None:
+            logging.warning("No lexical index found, hybrid search falls back to vector search")
+
+        # Two-level cache: normalized query -> embedding, (query, top_k, filters) -> results
+        self.embedding_cache = LRUCache(cache_size, cache_ttl)
+        self.result_cache = LRUCache(cache_size, cache_ttl)
+        self._fingerprint = self._collection_fingerprint()
+        self._fingerprint_checked = time.monotonic()
+        self.cache_path = Path(cache_path) if cache_path else None
+        if self.cache_path is not None:
+            self.load_cache()
+            atexit.register(self.save_cache)
+
+        # Optionally coalesce concurrent retrieve() calls into batched searches
+        self._batcher: Optional[MicroBatcher] = None
+        if batch_window_ms > 0:
+            self._batcher = MicroBatcher(self._search, batch_window_ms, max_batch_size)
+
+    def retrieve(self, query: str, top_k: int = 3, where: Optional[Dict[str, Any]] = None,
+                 mode: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Retrieve top-k most relevant documents for the query, optionally restricted
+        by a metadata filter such as ``{"product": "Credit card", "state": "CA"}``.
+        ``mode`` ("vector" or "hybrid") overrides the retriever's search_mode.
+        """
         try:
-            # Encode the query
-            query_embedding = self.model.encode(query).tolist()
-            
-            # Search the collection
-            results = self.collection.query(
-                query_embeddings=[query_embedding],
-                n_results=top_k
-            )
-            
-            # Format results
-            formatted_results = []
-            for i in range(len(results['ids'][0])):
-                formatted_results.append({
-                    'text': results['documents'][0][i],
-                    'metadata': results['metadatas'][0][i],
-                    'score': results['distances'][0][i] if 'distances' in results else None
-                })
-                
-            return formatted_results
-            
+            with self.telemetry.span("retrieve"):
+                if (mode or self.search_mode) == "hybrid" and self.lexical is not None:
+                    return self._hybrid_search(query, top_k, where)
+                if self._batcher is not None and not where:
+                    return self._batcher.submit(query, top_k).result()
+                return self._search([query], top_k, where)[0]
+
         except Exception as e:
             logging.error(f"Error in retrieve: {str(e)}")
-            return []
\ No newline at end of file
+            return []
+
+    def retrieve_many(self, queries: List[str], top_k: int = 3,
+                      where: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+        """Retrieve top-k documents for several queries with one encode and one collection query."""
+        try:
+            if self.search_mode == "hybrid" and self.lexical is not None:
+                return [self._hybrid_search(query, top_k, where) for query in queries]
+            return self._search(queries, top_k, where)
+
+        except Exception as e:
+            logging.error(f"Error in retrieve_many: {str(e)}")
+            return [[] for _ in queries]
+
+    def embed(self, query: str):
+        """Return the (cached) embedding for a query."""
+        key = normalize_query(query)
+        embedding = self.embedding_cache.get(key)
+        self.telemetry.count("rag_cache_events_total", cache="embedding", result="miss" if embedding is None else "hit")
+        if embedding is None:
+            with self.telemetry.span("embed"):
+                embedding = self.model.encode(query, convert_to_numpy=True)
+            self.embedding_cache.put(key, embedding)
+        return embedding
+
+    def facet_count(self, where: Dict[str, Any]) -> Optional[int]:
+        """Number of chunks matching a facet filter, or None if the facet index can't answer it."""
+        if self.facets is None or not self.facets.supports(where):
+            return None
+        return self.facets.count(where)
+
+    def _search(self, queries: List[str], top_k: int,
+                where: Optional[Dict[str, Any]] = None) -> List[List[Dict[str, Any]]]:
+        if not queries:
+            return []
+        self._check_collection()
+
+        n_results = top_k
+        if where:
+            # The facet index short-circuits empty filters and caps n_results at the subset size
+            matching = self.facet_count(where)
+            if matching == 0:
+                return [[] for _ in queries]
+            if matching is not None:
+                n_results = min(top_k, matching)
+
+        keys = [normalize_query(q) for q in queries]
+        output: List[Optional[List[Dict[str, Any]]]] = [None] * len(queries)
+        pending = []
+        for i, key in enumerate(keys):
+            cached = self.result_cache.get(self._result_key(key, top_k, where))
+            if cached is not None:
+                output[i] = [dict(r) for r in cached]
+            else:
+                pending.append(i)
+        if self.telemetry.enabled:
+            hits = len(queries) - len(pending)
+            self.telemetry.count("rag_cache_events_total", hits, cache="retrieval", result="hit")
+            self.telemetry.count("rag_cache_events_total", len(pending), cache="retrieval", result="miss")
+            self.telemetry.annotate(retrieval_cache_hits=hits)
+        if not pending:
+            return output
+
+        embeddings = {}
+        to_encode = []
+        for i in pending:
+            cached = self.embedding_cache.get(keys[i])
+            if cached is not None:
+                embeddings[keys[i]] = cached
+            elif keys[i] not in to_encode:
+                to_encode.append(keys[i])
+
+        if to_encode:
+            # Encode all uncached queries as a single padded batch
+            with self.telemetry.span("embed"):
+                encoded = self.model.encode(
+                    [queries[keys.index(k)] for k in to_encode],
+                    batch_size=len(to_encode),
+                    convert_to_numpy=True
+                )
+            for key, embedding in zip(to_encode, encoded):
+                self.embedding_cache.put(key, embedding)
+                embeddings[key] = embedding
+
+        # Search the collection
+        with self.telemetry.span("vector_query"):
+            results = self.backend.query(
+                [embeddings[keys[i]] for i in pending],
+                n_results=n_results,
+                where=where
+            )
+
+        for q, i in enumerate(pending):
+            formatted = self._format_results(results, q)
+            self.result_cache.put(self._result_key(keys[i], top_k, where), formatted)
+            output[i] = [dict(r) for r in formatted]
+        return output
+
+    def _hybrid_search(self, query: str, top_k: int,
+                       where: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Fuse vector and BM25 candidates with reciprocal-rank fusion."""
+        candidates = max(HYBRID_CANDIDATES, top_k)
+        vector_results = self._search([query], candidates, where)[0]
+
+        lexical_ids = []
+        with self.telemetry.span("bm25"):
+            if not where:
+                lexical_ids = [id_ for id_, _ in self.lexical.search(query, candidates)]
+            elif self.facets is not None and self.facets.supports(where):
+                # Over-fetch, then keep only lexical hits inside the filtered subset
+                allowed = self.facets.match(where)
+                lexical_ids = [id_ for id_, _ in self.lexical.search(query, candidates * 5) if id_ in allowed]
+                lexical_ids = lexical_ids[:candidates]
+
+        fused = reciprocal_rank_fusion([[r["id"] for r in vector_results], lexical_ids])[:top_k]
+
+        by_id = {r["id"]: r for r in vector_results}
+        missing = [id_ for id_, _ in fused if id_ not in by_id]
+        if missing:
+            fetched = self.collection.get(ids=missing, include=["documents", "metadatas"])
+            for id_, document, metadata in zip(fetched["ids"], fetched["documents"], fetched["metadatas"]):
+                by_id[id_] = {"id": id_, "text": document, "metadata": metadata, "score": None}
+
+        return [dict(by_id[id_], fusion_score=score) for id_, score in fused if id_ in by_id]
+
+    @staticmethod
+    def _result_key(query_key: str, top_k: int, where: Optional[Dict[str, Any]] = None) -> tuple:
+        return (query_key, top_k, json.dumps(where, sort_keys=True) if where else None)
+
+    def _open_backend(self) -> VectorBackend:
+        """The configured vector backend, or Chroma search if its index is missing or older than the store."""
+        if self.vector_backend != "chroma":
+            if not index_is_current(self.index_dir, self.chroma_dir):
+                logging.warning(f"The {self.vector_backend} index in {self.index_dir} is missing or older than "
+                                f"the store, falling back to Chroma search until it is rebuilt")
+                return create_vector_backend("chroma", self.collection)
+            try:
+                return create_vector_backend(self.vector_backend, self.collection, self.index_dir, self.facets,
+                                             **self.backend_options)
+            except FileNotFoundError as e:
+                logging.warning(f"No {self.vector_backend} index in {self.index_dir} ({e}), "
+                                f"falling back to Chroma search")
+        return create_vector_backend("chroma", self.collection)
+
+    def _collection_fingerprint(self) -> tuple:
+        # The count alone misses a sync that upserts and deletes the same number of chunks;
+        # ingest and sync rewrite the store version on every change, index builds restamp the index
+        fingerprint = (str(self.collection.id), self.collection.count(), read_store_version(self.chroma_dir))
+        if self.vector_backend != "chroma":
+            fingerprint += (read_store_version(self.index_dir),)
+        return fingerprint
+
+    def _check_collection(self) -> None:
+        """Drop cached results if the collection changed since the last check."""
+        now = time.monotonic()
+        if now - self._fingerprint_checked < CACHE_CHECK_INTERVAL:
+            return
+        self._fingerprint_checked = now
+        fingerprint = self._collection_fingerprint()
+        if fingerprint != self._fingerprint:
+            logging.info("Collection changed, invalidating retrieval result cache")
+            self._fingerprint = fingerprint
+            self.result_cache.clear()
+            if self.vector_backend != "chroma":
+                # Picks up a rebuilt index, or leaves one the store has moved past
+                self.backend = self._open_backend()
+
+    def invalidate_cache(self) -> None:
+        """Clear cached results (embeddings stay valid as long as the model is unchanged)."""
+        self.result_cache.clear()
+        self._fingerprint = self._collection_fingerprint()
+
+    def cache_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {"embedding": self.embedding_cache.stats(), "results": self.result_cache.stats()}
+
+    def save_cache(self) -> None:
+        """Persist both cache levels to ``cache_path``."""
+        if self.cache_path is None:
+            return
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.cache_path.with_suffix(".tmp")
+            with open(tmp_path, "wb") as f:
+                pickle.dump({
+                    "model_name": self.model_name,
+                    "fingerprint": self._fingerprint,
+                    "embeddings": self.embedding_cache.dump(),
+                    "results": self.result_cache.dump()
+                }, f)
+            tmp_path.replace(self.cache_path)
+        except Exception as e:
+            logging.error(f"Error saving retriever cache: {str(e)}")
+
+    def load_cache(self) -> None:
+        """Load persisted cache entries that are still valid for this model and collection."""
+        if self.cache_path is None or not self.cache_path.exists():
+            return
+        try:
+            with open(self.cache_path, "rb") as f:
+                state = pickle.load(f)
+            if state.get("model_name") != self.model_name:
+                return
+            self.embedding_cache.restore(state.get("embeddings", []))
+            if state.get("fingerprint") == self._fingerprint:
+                self.result_cache.restore(state.get("results", []))
+        except Exception as e:
+            logging.error(f"Error loading retriever cache: {str(e)}")
+
+    @staticmethod
+    def _format_results(results: Dict[str, Any], q: int) -> List[Dict[str, Any]]:
+        """Format the results of the q-th query."""
+        formatted_results = []
+        for i in range(len(results['ids'][q])):
+            formatted_results.append({
+                'id': results['ids'][q][i],
+                'text': results['documents'][q][i],
+                'metadata': results['metadatas'][q][i],
+                'score': results['distances'][q][i] if 'distances' in results else None
+            })
+        return formatted_results
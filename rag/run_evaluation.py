@@ -1,12 +1,15 @@
 # run_evaluation.py
+import argparse
+import hashlib
+import json
 import logging
+import os
 import time
 import pandas as pd
-from typing import Dict, Any
-from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, List, Optional, Tuple
 from .rag_pipeline import RAGPipeline
 from .evaluation import RAGEvaluator, TEST_QUESTIONS
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
 # Configure logging
 logging.basicConfig(
@@ -37,30 +40,89 @@ def retry_on_error(max_retries=3, delay=5):
         return wrapper
     return decorator
 
-def evaluate_with_timeout(evaluator, question, timeout=60):  # Increased to 60 seconds
-    """Evaluate a single question with timeout using ThreadPoolExecutor."""
-    with ThreadPoolExecutor(max_workers=1) as executor:
-        future = executor.submit(evaluator.evaluate_single, question)
-        try:
-            return future.result(timeout=timeout)
-        except FutureTimeoutError:
-            logger.warning(f"Question timed out after {timeout} seconds: {question[:50]}...")
-            return {
-                'question': question,
-                'answer': f"Error: Generation timed out after {timeout} seconds",
-                'sources': [],
-                'score': 0,
-                'analysis': "Generation took too long"
-            }
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate the RAG pipeline on a question set.")
+    parser.add_argument("--questions", help="JSONL file with one {\"question\": ...} per line (default: TEST_QUESTIONS)")
+    parser.add_argument("--checkpoint", default="evaluation_checkpoint.jsonl",
+                        help="Append-only results file; finished questions are skipped on rerun")
+    parser.add_argument("--output", default="evaluation_results.md")
+    parser.add_argument("--concurrency", type=int, default=2, help="Questions generated concurrently")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Generation timeout per question (s)")
+    parser.add_argument("--k", type=int, default=3, help="Sources retrieved per question")
+    return parser.parse_args(argv)
+
+def load_questions(path: Optional[str]) -> List[str]:
+    """Questions from a JSONL file (objects with a ``question`` field, or bare strings)."""
+    if not path:
+        return list(TEST_QUESTIONS)
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            questions.append(item["question"] if isinstance(item, dict) else str(item))
+    return questions
+
+def config_hash(rag: RAGPipeline, k: int) -> str:
+    """Fingerprint of everything that changes an answer, so a new config doesn't reuse old results."""
+    config = {
+        "chroma_dir": rag.chroma_dir,
+        "model_name": rag.model_name,
+        "search_mode": rag.search_mode,
+        "vector_backend": rag.vector_backend,
+        "analytics": rag.analytics,
+        "generator": rag.registry.generator_key(**rag.generator_config),
+        "rerank": rag.rerank_candidates if rag.reranker is not None else None,
+        "k": k
+    }
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+def item_key(question: str, config: str) -> str:
+    return hashlib.sha1(f"{config}:{question}".encode("utf-8")).hexdigest()[:16]
+
+def _json_default(value):
+    # numpy scalars in scores and metadata
+    return value.item() if hasattr(value, "item") else str(value)
+
+def load_checkpoint(path: str) -> Dict[str, Dict[str, Any]]:
+    """Finished results by key; a torn last line from a crash is ignored."""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done[record["key"]] = record["result"]
+    return done
+
+def is_failure(result: Dict[str, Any]) -> bool:
+    return str(result.get('answer', '')).startswith(("Error", "Fatal Error"))
 
 @retry_on_error(max_retries=2, delay=3)
-def evaluate_question(evaluator, question: str) -> Dict[str, Any]:
-    """Evaluate a single question with timeout and retry logic."""
+def answer_question(rag: RAGPipeline, question: str, retrieved: List[Dict[str, Any]], timeout: float) -> Dict[str, Any]:
+    return rag.answer(question, retrieved, timeout=timeout)
+
+def evaluate_question(rag: RAGPipeline, evaluator: RAGEvaluator, question: str,
+                      prepared: Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]], Dict[str, Any]],
+                      timeout: float) -> Dict[str, Any]:
+    """Generate (unless the analytics cube already answered it) and score one answer from ``rag.prepare_many``."""
     try:
         start_time = time.time()
-        result = evaluate_with_timeout(evaluator, question, timeout=30)
-        elapsed = time.time() - start_time
-        logger.info(f"Question processed in {elapsed:.1f}s: {question[:50]}...")
+        direct, retrieved, _ = prepared
+        response = direct if direct is not None else answer_question(rag, question, retrieved, timeout)
+        result = evaluator.evaluate_response(question, response)
+        if str(result.get('answer', '')).startswith("Error: Generation timed out"):
+            logger.warning(f"Question timed out after {timeout} seconds: {question[:50]}...")
+            result.update({
+                'sources': [],
+                'score': 0,
+                'analysis': "Generation took too long"
+            })
+        logger.info(f"Question processed in {time.time() - start_time:.1f}s: {question[:50]}...")
         return result
     except Exception as e:
         logger.error(f"Error evaluating question: {question[:50]}... - {str(e)}")
@@ -72,52 +134,67 @@ def evaluate_question(evaluator, question: str) -> Dict[str, Any]:
             'analysis': f"Error: {str(e)[:100]}..."
         }
 
-def main():
+def main(argv=None):
+    args = parse_args(argv)
     try:
         # Initialize the RAG pipeline
         logger.info("Initializing RAG pipeline...")
         rag = RAGPipeline()
+        rag.warm_up(background=False)
+        logger.info(f"Startup timings (s): {rag.registry.timings()}")
         evaluator = RAGEvaluator(rag)
-        
-        # Process questions one at a time
-        results = []
-        for i, question in enumerate(TEST_QUESTIONS):
-            logger.info(f"\nProcessing question {i+1}/{len(TEST_QUESTIONS)}: {question[:50]}...")
-            try:
-                result = evaluate_question(evaluator, question)
-                results.append(result)
-                
-                # Save after each question
-                results_df = pd.DataFrame(results)
-                RAGEvaluator.save_to_markdown(results_df, "evaluation_partial.md")
-                logger.info(f"Progress saved. Processed {i+1}/{len(TEST_QUESTIONS)} questions.")
-                
-            except Exception as e:
-                logger.error(f"Fatal error processing question: {str(e)}", exc_info=True)
-                results.append({
-                    'question': question,
-                    'answer': f"Fatal Error: {str(e)[:200]}",
-                    'sources': [],
-                    'score': 0,
-                    'analysis': "Fatal error during processing"
-                })
-        
-        # Save final results
-        output_path = "evaluation_results.md"
-        RAGEvaluator.save_to_markdown(pd.DataFrame(results), output_path)
-        logger.info(f"\nEvaluation complete! Results saved to {output_path}")
-        
+
+        questions = load_questions(args.questions)
+        config = config_hash(rag, args.k)
+        done = load_checkpoint(args.checkpoint)
+        results = {item_key(q, config): done[item_key(q, config)] for q in questions if item_key(q, config) in done}
+        pending = list(dict.fromkeys(q for q in questions if item_key(q, config) not in results))
+        logger.info(f"{len(questions)} questions: {len(questions) - len(pending)} already in {args.checkpoint}, "
+                    f"{len(pending)} to run (config {config})")
+
+        if pending:
+            # One batched retrieval for every pending question, through the same analytics and
+            # retrieval path the pipeline serves queries with
+            start_time = time.time()
+            prepared = rag.prepare_many(pending, k=args.k)
+            logger.info(f"Prepared sources for {len(pending)} questions in {time.time() - start_time:.1f}s")
+
+            # Concurrent requests are batched by the generation scheduler; each finished,
+            # successful result is appended to the checkpoint straight away
+            with open(args.checkpoint, "a", encoding="utf-8") as checkpoint, \
+                    ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as executor:
+                futures = {
+                    executor.submit(evaluate_question, rag, evaluator, question, item, args.timeout): question
+                    for question, item in zip(pending, prepared)
+                }
+                for i, future in enumerate(as_completed(futures), start=1):
+                    question = futures[future]
+                    result = future.result()
+                    key = item_key(question, config)
+                    results[key] = result
+                    if not is_failure(result):
+                        checkpoint.write(json.dumps({"key": key, "config": config, "result": result},
+                                                    default=_json_default) + "\n")
+                        checkpoint.flush()
+                    logger.info(f"Progress: {i}/{len(pending)} questions processed.")
+
+        # Render the report once, in question order
+        ordered = [results[item_key(q, config)] for q in dict.fromkeys(questions)]
+        RAGEvaluator.save_to_markdown(pd.DataFrame(ordered), args.output)
+        failures = sum(is_failure(r) for r in ordered)
+        logger.info(f"\nEvaluation complete! Results saved to {args.output} ({failures} failed, rerun to retry them)")
+
         # Print a sample of the results
         logger.info("\nSample of evaluation results:")
-        sample = pd.DataFrame(results)[['question', 'answer']].head()
+        sample = pd.DataFrame(ordered)[['question', 'answer']].head()
         logger.info("\n" + sample.to_string())
-        
+
         return 0
-        
+
     except Exception as e:
         logger.critical(f"Critical error in evaluation: {str(e)}", exc_info=True)
         return 1
 
 if __name__ == "__main__":
     exit_code = main()
-    exit(exit_code)
\ No newline at end of file
+    exit(exit_code)
@@ -0,0 +1,363 @@
+# rag/service.py
+import argparse
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Any, AsyncIterator, Dict, Iterator, Optional
+
+from .rag_pipeline import RAGPipeline
+from .telemetry import get_telemetry
+
+logger = logging.getLogger(__name__)
+
+DISCONNECT_POLL_SECONDS = 0.25
+
+
+class ServiceBusy(Exception):
+    """Raised when a request can't be admitted: 429 if the queue is full, 503 if it waited too long."""
+
+    def __init__(self, message: str, status_code: int = 429, retry_after: float = 1.0):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionControl:
+    """
+    At most ``max_in_flight`` requests run at once and at most ``max_waiting``
+    wait for a slot; beyond that requests are rejected straight away, and a
+    waiting request gives up after ``queue_timeout`` seconds.
+    """
+
+    def __init__(self, max_in_flight: int = 4, max_waiting: int = 16, queue_timeout: float = 10.0):
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+
+    @asynccontextmanager
+    async def slot(self):
+        # Counted synchronously on arrival: the semaphore isn't taken until a burst's first await
+        if self.in_flight + self.waiting >= self.max_in_flight + self.max_waiting:
+            self.rejected += 1
+            get_telemetry().count("rag_rejected_requests_total", reason="queue_full")
+            raise ServiceBusy(f"Too many requests ({self.in_flight} running, {self.waiting} queued)", 429)
+
+        enqueued = time.perf_counter()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            get_telemetry().count("rag_rejected_requests_total", reason="queue_timeout")
+            raise ServiceBusy(f"Timed out after {self.queue_timeout}s waiting for a free slot", 503)
+        finally:
+            self.waiting -= 1
+
+        get_telemetry().observe("rag_queue_wait_seconds", time.perf_counter() - enqueued, queue="admission")
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_in_flight": self.max_in_flight,
+            "max_waiting": self.max_waiting,
+            "rejected": self.rejected,
+            "queue_timeouts": self.timed_out
+        }
+
+
+class ServiceCore:
+    """
+    Async front of a RAGPipeline, shared by the HTTP API and the Gradio UI.
+
+    Blocking retrieval and generation run on bounded thread pools.
+    ``query`` generates through the pipeline's GenerationScheduler, so
+    concurrent complete-answer requests are batched together and a cancelled
+    one is dropped from the scheduler's queue. ``query_stream``
+    runs ``RAGPipeline.query_stream`` one event at a time on the generate pool.
+    Streamed requests are not batched (each streams on its own), but a
+    cancelled stream (client disconnect) stops generating at the next token
+    instead of finishing an answer nobody will read.
+    """
+
+    def __init__(self, rag: Optional[RAGPipeline] = None, retrieve_workers: int = 4, generate_workers: int = 2,
+                 max_in_flight: int = 4, max_waiting: int = 16, queue_timeout: float = 10.0):
+        self.rag = rag or RAGPipeline()
+        self.retrieve_executor = ThreadPoolExecutor(max_workers=retrieve_workers, thread_name_prefix="retrieve")
+        self.generate_executor = ThreadPoolExecutor(max_workers=generate_workers, thread_name_prefix="generate")
+        self.admission = AdmissionControl(max_in_flight, max_waiting, queue_timeout)
+        self.cancelled = 0
+
+    @property
+    def ready(self) -> bool:
+        return self.rag.ready
+
+    def warm_up(self) -> None:
+        self.rag.warm_up(background=True)
+
+    def status(self) -> Dict[str, Any]:
+        return {**self.rag.status(), "service": self.stats()}
+
+    def _check_ready(self, retrieval_only: bool = False) -> None:
+        ready = self.rag.retriever_ready if retrieval_only else self.ready
+        if not ready:
+            raise ServiceBusy("The models are still warming up", 503, retry_after=5.0)
+
+    async def retrieve(self, question: str, k: int = 3, where: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        # Needs only the retriever, so /retrieve works before the generator has loaded
+        self._check_ready(retrieval_only=True)
+        async with self.admission.slot():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.retrieve_executor, self.rag.retrieve, question, k, where)
+
+    async def query_stream(self, question: str, k: int = 3, use_cache: bool = True,
+                           where: Optional[Dict[str, Any]] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Async version of ``RAGPipeline.query_stream``; cancelling it stops generation."""
+        self._check_ready()
+        async with self.admission.slot():
+            events: Iterator[Dict[str, Any]] = self.rag.query_stream(question, k, use_cache=use_cache, where=where)
+            # The first event (sources) is retrieval work; everything after it is generation
+            executor = self.retrieve_executor
+            pending = None
+            try:
+                while True:
+                    pending = executor.submit(next, events, None)
+                    event = await asyncio.wrap_future(pending)
+                    if event is None:
+                        break
+                    yield event
+                    executor = self.generate_executor
+            except (asyncio.CancelledError, GeneratorExit):
+                self.cancelled += 1
+                get_telemetry().count("rag_cancelled_requests_total")
+                logger.info(f"Request cancelled: {question[:80]}")
+                raise
+            finally:
+                # Close once any running next() returns (a generator can't be closed mid-step);
+                # closing it stops the backend's generation
+                if pending is None:
+                    events.close()
+                else:
+                    pending.add_done_callback(lambda _: self.generate_executor.submit(events.close))
+
+    async def query(self, question: str, k: int = 3, use_cache: bool = True,
+                    where: Optional[Dict[str, Any]] = None, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Complete answer as returned by ``RAGPipeline.query``. Generation goes
+        through the batching scheduler; past ``timeout`` a request still queued
+        there fails (a batch already generating is not interrupted). Traced as
+        "query", like ``RAGPipeline.query``.
+        """
+        self._check_ready()
+        with get_telemetry().trace("query"):
+            start = time.perf_counter()
+            async with self.admission.slot():
+                loop = asyncio.get_running_loop()
+                direct, retrieved, timings = await loop.run_in_executor(
+                    self.retrieve_executor, _in_context(self.rag.prepare, question, k, where)
+                )
+                if direct is not None:
+                    response = direct
+                else:
+                    response = await self._answer(question, retrieved, use_cache, timeout)
+                    timings.update(response["timings"])
+                    response["timings"] = timings
+            response["timings"]["service_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            return response
+
+    async def _answer(self, question: str, retrieved, use_cache: bool, timeout: Optional[float]) -> Dict[str, Any]:
+        """
+        ``RAGPipeline.answer`` with no thread blocked on the scheduler: the
+        prompt's future is awaited here, so cancelling the request drops the
+        prompt from the queue. A prompt already in a running batch can't be
+        dropped; the caller's admission slot stays held until it is done.
+        """
+        submitted = self.retrieve_executor.submit(
+            _in_context(self.rag.submit_answer, question, retrieved, use_cache, timeout)
+        )
+        pending = None
+        try:
+            pending = await asyncio.wrap_future(submitted)
+            if pending["future"] is not None:
+                with get_telemetry().span("generate"):
+                    await asyncio.wait({asyncio.wrap_future(pending["future"])})
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            get_telemetry().count("rag_cancelled_requests_total")
+            logger.info(f"Request cancelled: {question[:80]}")
+            if pending is None:
+                # The cache lookup may still queue the prompt; drop it as soon as it does
+                submitted.add_done_callback(_cancel_generation)
+            elif not pending["future"].cancel():
+                await asyncio.wait({asyncio.wrap_future(pending["future"])})
+            raise
+        return self.rag.finish_answer(pending)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.admission.stats(), "cancelled": self.cancelled, "ready": self.ready}
+
+    def shutdown(self) -> None:
+        self.retrieve_executor.shutdown(wait=False, cancel_futures=True)
+        self.generate_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _in_context(fn, *args):
+    """``fn(*args)`` run in a copy of the caller's context, so work on a pool thread lands in its trace."""
+    return partial(contextvars.copy_context().run, fn, *args)
+
+
+def _cancel_generation(submitted) -> None:
+    """Done callback of an abandoned ``submit_answer`` call: cancel the prompt it queued."""
+    if not submitted.cancelled() and submitted.exception() is None and submitted.result()["future"] is not None:
+        submitted.result()["future"].cancel()
+
+
+async def run_until_disconnected(request, coro):
+    """Await ``coro``, cancelling it if the HTTP client goes away first."""
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                task.cancel()
+                raise asyncio.CancelledError("client disconnected")
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+def create_app(core: Optional[ServiceCore] = None, warm_up: bool = True):
+    """
+    FastAPI app exposing ``/query``, ``/retrieve``, ``/health`` and ``/metrics``
+    (Prometheus text format; empty unless telemetry is enabled). ``core`` is a
+    ServiceCore or anything with the same interface, e.g. ``rag.cluster.ClusterCore``.
+
+    Try it locally with ``fastapi.testclient.TestClient(create_app())``.
+    """
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+    from pydantic import BaseModel
+
+    class RetrieveRequest(BaseModel):
+        question: str
+        k: int = 3
+        where: Optional[Dict[str, str]] = None
+
+    class QueryRequest(RetrieveRequest):
+        use_cache: bool = True
+        timeout: Optional[float] = None
+        stream: bool = False
+
+    core = core or ServiceCore()
+    app = FastAPI(title="CFPB Complaint Analysis API")
+    app.state.core = core
+
+    @app.on_event("startup")
+    async def startup():
+        if warm_up:
+            core.warm_up()
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        core.shutdown()
+
+    @app.exception_handler(ServiceBusy)
+    async def busy(request: Request, exc: ServiceBusy):
+        return JSONResponse({"error": str(exc)}, status_code=exc.status_code,
+                            headers={"Retry-After": str(int(exc.retry_after))})
+
+    @app.get("/health")
+    async def health():
+        return core.status()
+
+    @app.get("/metrics")
+    async def metrics():
+        telemetry = get_telemetry()
+        telemetry.gauge("rag_in_flight_requests", core.admission.in_flight)
+        telemetry.gauge("rag_waiting_requests", core.admission.waiting)
+        return PlainTextResponse(telemetry.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+    @app.post("/retrieve")
+    async def retrieve(body: RetrieveRequest, request: Request):
+        if not body.question.strip():
+            return JSONResponse({"error": "Empty question"}, status_code=400)
+        return await run_until_disconnected(request, core.retrieve(body.question, body.k, body.where))
+
+    @app.post("/query")
+    async def query(body: QueryRequest, request: Request):
+        if not body.question.strip():
+            return JSONResponse({"error": "Empty question"}, status_code=400)
+
+        if body.stream:
+            events = core.query_stream(body.question, body.k, body.use_cache, body.where)
+            # Pull the first event here so a busy service still answers 429/503 instead of a broken stream
+            first = await events.__anext__()
+
+            async def ndjson():
+                # Starlette cancels this generator when the client disconnects
+                yield json.dumps(first) + "\n"
+                async for event in events:
+                    yield json.dumps(event) + "\n"
+
+            return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+        return await run_until_disconnected(
+            request, core.query(body.question, body.k, body.use_cache, body.where, body.timeout)
+        )
+
+    return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the RAG pipeline over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--chroma-dir", default="vector_store/chroma")
+    parser.add_argument("--max-in-flight", type=int, default=4, help="Requests processed concurrently")
+    parser.add_argument("--max-waiting", type=int, default=16, help="Requests queued before answering 429")
+    parser.add_argument("--queue-timeout", type=float, default=10.0, help="Seconds a request may wait before 503")
+    parser.add_argument("--retrieve-workers", type=int, default=4)
+    parser.add_argument("--generate-workers", type=int, default=2)
+    parser.add_argument("--telemetry", action="store_true", help="Record metrics for /metrics (or RAG_TELEMETRY=1)")
+    parser.add_argument("--trace-log", help="Also append one JSON line per request to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    import uvicorn
+
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.telemetry or args.trace_log:
+        get_telemetry().enable(json_log=args.trace_log)
+    core = ServiceCore(
+        RAGPipeline(chroma_dir=args.chroma_dir),
+        retrieve_workers=args.retrieve_workers,
+        generate_workers=args.generate_workers,
+        max_in_flight=args.max_in_flight,
+        max_waiting=args.max_waiting,
+        queue_timeout=args.queue_timeout
+    )
+    uvicorn.run(create_app(core), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
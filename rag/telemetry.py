@@ -0,0 +1,261 @@
+# rag/telemetry.py
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Histogram bucket upper bounds in seconds, from a cache hit to a slow CPU generation
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+WINDOW_SAMPLES = 1024  # Recent observations kept per series for rolling quantiles
+
+_NOOP = nullcontext()
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("rag_trace", default=None)
+trace_logger = logging.getLogger("rag.traces")
+
+
+class RollingHistogram:
+    """
+    Prometheus-style cumulative buckets plus a window of the most recent
+    observations, so both long-run rates and current p50/p95/p99 are available.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = SECONDS_BUCKETS, window: int = WINDOW_SAMPLES):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent: deque = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q: float) -> float:
+        if not self.recent:
+            return 0.0
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Trace:
+    """Per-request record: summed span durations plus free-form attributes."""
+
+    __slots__ = ("trace_id", "name", "started", "spans", "attributes")
+
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans: Dict[str, float] = {}
+        self.attributes: Dict[str, Any] = {}
+
+    def add_span(self, name: str, seconds: float) -> None:
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "timestamp": time.time(),
+            "duration_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            "spans_ms": {name: round(seconds * 1000, 2) for name, seconds in self.spans.items()},
+            **self.attributes
+        }
+
+
+class Telemetry:
+    """
+    In-process metrics: span timings, counters and queue waits, exported in
+    the Prometheus text format and optionally as one JSON line per request.
+
+    Disabled by default (``RAG_TELEMETRY=1`` or ``enable()`` turns it on).
+    While disabled, ``span`` returns a shared no-op context manager and the
+    other calls return immediately.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], RollingHistogram] = {}
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._gauges: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._json_handler: Optional[logging.Handler] = None
+
+    def enable(self, json_log: Optional[str] = None) -> None:
+        """Start recording; with ``json_log``, also append each finished trace to that file."""
+        self.enabled = True
+        if json_log and self._json_handler is None:
+            self._json_handler = logging.FileHandler(json_log)
+            self._json_handler.setFormatter(logging.Formatter("%(message)s"))
+            trace_logger.addHandler(self._json_handler)
+            trace_logger.setLevel(logging.INFO)
+            trace_logger.propagate = False
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    # Recording
+
+    def observe(self, metric: str, value: float, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = RollingHistogram()
+            histogram.observe(value)
+
+    def count(self, metric: str, value: float = 1, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def gauge(self, metric: str, value: float, **labels: str) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._gauges[(metric, tuple(sorted(labels.items())))] = value
+
+    def span(self, stage: str):
+        """Time a block as ``rag_stage_seconds{stage=...}`` and add it to the current trace."""
+        if not self.enabled:
+            return _NOOP
+        return self._span(stage)
+
+    @contextmanager
+    def _span(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe("rag_stage_seconds", seconds, stage=stage)
+            trace = _current_trace.get()
+            if trace is not None:
+                trace.add_span(stage, seconds)
+
+    def trace(self, name: str):
+        """Scope one request; spans and attributes recorded inside it are logged together at the end."""
+        if not self.enabled:
+            return _NOOP
+        return self._trace(name)
+
+    @contextmanager
+    def _trace(self, name: str) -> Iterator[Trace]:
+        trace = Trace(name)
+        token = _current_trace.set(trace)
+        try:
+            yield trace
+        except Exception as e:
+            trace.attributes["error"] = str(e)[:200]
+            raise
+        finally:
+            _current_trace.reset(token)
+            seconds = time.perf_counter() - trace.started
+            self.observe("rag_request_seconds", seconds, request=name)
+            self.count("rag_requests_total", request=name)
+            if self._json_handler is not None:
+                trace_logger.info(json.dumps(trace.to_dict(), default=str))
+
+    def annotate(self, trace: Optional[Trace] = None, **attributes: Any) -> None:
+        """Attach attributes (token counts, cache hits...) to ``trace`` or the current one."""
+        if not self.enabled:
+            return
+        trace = trace or _current_trace.get()
+        if trace is not None:
+            trace.attributes.update(attributes)
+
+    def current_trace(self) -> Optional[Trace]:
+        """The active trace, for handing to work done on another thread."""
+        return _current_trace.get() if self.enabled else None
+
+    # Export
+
+    @staticmethod
+    def _labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Dict[str, str]] = None) -> str:
+        pairs = list(labels) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+    def render_prometheus(self) -> str:
+        """All series in the Prometheus text exposition format."""
+        lines: List[str] = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+
+        for kind, series in (("counter", counters), ("gauge", gauges)):
+            previous = None
+            for (name, labels), value in series:
+                if name != previous:
+                    lines.append(f"# TYPE {name} {kind}")
+                    previous = name
+                lines.append(f"{name}{self._labels(labels)} {value:g}")
+
+        # Each family's lines must be contiguous: all histograms first, then their rolling quantiles
+        previous = None
+        for (name, labels), histogram in histograms:
+            if name != previous:
+                lines.append(f"# TYPE {name} histogram")
+                previous = name
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{name}_bucket{self._labels(labels, {'le': le})} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+
+        previous = None
+        for (name, labels), histogram in histograms:
+            if name != previous:
+                lines.append(f"# HELP {name}_window Quantiles over the last {WINDOW_SAMPLES} observations")
+                lines.append(f"# TYPE {name}_window gauge")
+                previous = name
+            for q in (0.5, 0.95, 0.99):
+                lines.append(f"{name}_window{self._labels(labels, {'quantile': str(q)})} {histogram.quantile(q):.6f}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Rolling p50/p95/p99 (ms) per timed series and current counter values."""
+        with self._lock:
+            return {
+                "timings_ms": {
+                    name + self._labels(labels): {
+                        f"p{int(q * 100)}": round(h.quantile(q) * 1000, 2) for q in (0.5, 0.95, 0.99)
+                    }
+                    for (name, labels), h in self._histograms.items()
+                },
+                "counters": {name + self._labels(labels): value for (name, labels), value in self._counters.items()},
+                "gauges": {name + self._labels(labels): value for (name, labels), value in self._gauges.items()}
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._gauges.clear()
+
+
+_telemetry = Telemetry()
+if os.environ.get("RAG_TELEMETRY", "0") == "1":
+    _telemetry.enable(json_log=os.environ.get("RAG_TRACE_LOG"))
+
+
+def get_telemetry() -> Telemetry:
+    """The telemetry shared by everything in this process (enabled by ``RAG_TELEMETRY=1``)."""
+    return _telemetry
@@ -0,0 +1,440 @@
+# rag/vector_backends.py
+import argparse
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .cache import STORE_VERSION_FILE, read_store_version, write_store_version
+from .facets import FacetIndex, to_chroma_where
+
+INDEX_DIR = "vector_store/matrix"
+MATRIX_FILE = "embeddings.npy"
+IDS_FILE = "ids.npy"
+FAISS_FILES = {"faiss-ivf": "faiss_ivf.index", "faiss-hnsw": "faiss_hnsw.index"}
+COMPACT_FILES = {"float16": "embeddings_f16.npy", "int8": "embeddings_int8.npy"}
+SCALES_FILE = "scales_int8.npy"  # Per-vector dequantization scale for the int8 matrix
+RESCORE_FACTOR = 4  # Compact-search candidates per result, rescored at full precision
+SCAN_ROWS = 262144  # Rows per matmul block over a float32 matrix (scanned in place)
+COMPACT_SCAN_ROWS = 16384  # Rows per block over float16/int8 codes, each block is upcast to float32 scratch
+
+
+def quantize_int8(vectors: np.ndarray):
+    """Symmetric per-vector int8 quantization: ``vectors ~= codes * scales[:, None]``."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class VectorBackend:
+    """
+    Nearest-neighbour search used by the Retriever.
+
+    ``query`` mirrors ``chromadb.Collection.query``: it takes a batch of query
+    embeddings and returns a dict of per-query ``ids``, ``distances`` (cosine
+    distance), ``documents`` and ``metadatas`` lists.
+    """
+
+    name = "base"
+
+    def query(self, query_embeddings, n_results: int, where: Optional[Dict[str, Any]] = None) -> Dict[str, list]:
+        raise NotImplementedError
+
+    def report(self) -> Dict[str, Any]:
+        return {"backend": self.name}
+
+
+class ChromaBackend(VectorBackend):
+    """The default: HNSW search inside the Chroma collection."""
+
+    name = "chroma"
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def query(self, query_embeddings, n_results: int, where: Optional[Dict[str, Any]] = None) -> Dict[str, list]:
+        return self.collection.query(
+            query_embeddings=np.asarray(query_embeddings, dtype=np.float32).tolist(),
+            n_results=n_results,
+            where=to_chroma_where(where)
+        )
+
+
+class MatrixBackend(VectorBackend):
+    """
+    Exact cosine top-k over a memory-mapped float32/float16 matrix.
+
+    Vectors are stored L2-normalized, so cosine similarity is a dot product.
+    The matrix is opened with ``mmap_mode="r"``: worker processes that open
+    the same file share the OS page cache instead of each holding a copy.
+    Documents and metadata are still read from the Chroma collection.
+    """
+
+    name = "matrix"
+
+    def __init__(self, collection, index_dir: str = INDEX_DIR, facets: Optional[FacetIndex] = None):
+        self.collection = collection
+        self.facets = facets
+        self.index_dir = Path(index_dir)
+        self.matrix = np.load(self.index_dir / MATRIX_FILE, mmap_mode="r")
+        self.ids = np.load(self.index_dir / IDS_FILE, mmap_mode="r")
+        self._row_of: Optional[Dict[str, int]] = None
+
+    def _rows_for(self, where: Dict[str, Any]) -> np.ndarray:
+        if self._row_of is None:
+            self._row_of = {id_.decode("utf-8"): row for row, id_ in enumerate(self.ids)}
+        rows = [self._row_of[id_] for id_ in self.facets.match(where) if id_ in self._row_of]
+        return np.asarray(sorted(rows), dtype=np.int64)
+
+    def exact_search(self, queries: np.ndarray, n_results: int, rows: Optional[np.ndarray] = None):
+        """Return (row indices, similarities), each (num_queries, n_results), best first."""
+        return self._scan(_normalize(queries), n_results, self.matrix, rows=rows)
+
+    @staticmethod
+    def _scan(queries: np.ndarray, n_results: int, matrix: np.ndarray, scales: Optional[np.ndarray] = None,
+              rows: Optional[np.ndarray] = None):
+        """Blocked top-k of ``queries @ matrix.T`` (times per-row ``scales`` for int8 codes)."""
+        total = len(rows) if rows is not None else matrix.shape[0]
+        k = min(n_results, total)
+        if k == 0:
+            return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+
+        # A compact block is copied to float32 before the matmul, so keep those blocks small
+        scan_rows = SCAN_ROWS if matrix.dtype == np.float32 else COMPACT_SCAN_ROWS
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        for start in range(0, total, scan_rows):
+            if rows is None:
+                block_rows = np.arange(start, min(start + scan_rows, total))
+                block = matrix[start:start + len(block_rows)]
+            else:
+                block_rows = rows[start:start + scan_rows]
+                block = matrix[block_rows]
+            scores = queries @ np.asarray(block, dtype=np.float32).T
+            if scales is not None:
+                scores *= scales[block_rows]
+            kk = min(k, scores.shape[1])
+            top = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+            best_rows = np.concatenate([best_rows, block_rows[top]], axis=1)
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            if best_rows.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def _search(self, queries: np.ndarray, n_results: int):
+        return self.exact_search(queries, n_results)
+
+    def query(self, query_embeddings, n_results: int, where: Optional[Dict[str, Any]] = None) -> Dict[str, list]:
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if where:
+            if self.facets is None or not self.facets.supports(where):
+                # Operator filters need Chroma's metadata engine
+                return ChromaBackend(self.collection).query(queries, n_results, where)
+            rows, scores = self.exact_search(queries, n_results, self._rows_for(where))
+        else:
+            rows, scores = self._search(queries, n_results)
+        return self._hydrate(rows, scores)
+
+    def _hydrate(self, rows: np.ndarray, scores: np.ndarray) -> Dict[str, list]:
+        """Fetch documents/metadata for the hits in one collection.get call."""
+        hits_per_query = [
+            [(self.ids[r].decode("utf-8"), float(1.0 - s)) for r, s in zip(query_rows, query_scores) if r >= 0]
+            for query_rows, query_scores in zip(rows, scores)
+        ]
+        unique_ids = list(dict.fromkeys(id_ for hits in hits_per_query for id_, _ in hits))
+        fetched = self.collection.get(ids=unique_ids, include=["documents", "metadatas"]) if unique_ids else {
+            "ids": [], "documents": [], "metadatas": []}
+        by_id = {id_: (doc, meta) for id_, doc, meta in zip(fetched["ids"], fetched["documents"], fetched["metadatas"])}
+
+        results = {"ids": [], "distances": [], "documents": [], "metadatas": []}
+        for hits in hits_per_query:
+            hits = [(id_, distance) for id_, distance in hits if id_ in by_id]
+            results["ids"].append([id_ for id_, _ in hits])
+            results["distances"].append([d for _, d in hits])
+            results["documents"].append([by_id[id_][0] for id_, _ in hits])
+            results["metadatas"].append([by_id[id_][1] for id_, _ in hits])
+        return results
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "vectors": int(self.matrix.shape[0]),
+            "dim": int(self.matrix.shape[1]),
+            "dtype": str(self.matrix.dtype),
+            "matrix_mb": round(self.matrix.nbytes / (1024 * 1024), 1)
+        }
+
+
+class CompactMatrixBackend(MatrixBackend):
+    """
+    Exact search over a compact copy of the matrix (float16, or int8 codes
+    with per-vector scales), then exact rescoring of the best
+    ``rescore * n_results`` candidates against the full-precision matrix.
+
+    Only the compact array is scanned, so it is the part that stays resident
+    (2x smaller for float16, ~4x for int8); the full matrix is mmap'd and only
+    the candidate rows are read from it.
+    """
+
+    def __init__(self, collection, precision: str = "int8", index_dir: str = INDEX_DIR,
+                 facets: Optional[FacetIndex] = None, rescore: int = RESCORE_FACTOR):
+        super().__init__(collection, index_dir, facets)
+        self.name = f"matrix-{precision}"
+        self.precision = precision
+        self.rescore = max(1, rescore)
+        self.compact = np.load(self.index_dir / COMPACT_FILES[precision], mmap_mode="r")
+        self.scales = np.load(self.index_dir / SCALES_FILE) if precision == "int8" else None
+
+    def _search(self, queries: np.ndarray, n_results: int):
+        queries = _normalize(queries)
+        candidates, _ = self._scan(queries, n_results * self.rescore, self.compact, self.scales)
+        if candidates.shape[1] == 0:
+            return candidates, np.zeros(candidates.shape, dtype=np.float32)
+
+        # Rescore with full-precision vectors; rows are read in sorted order for locality
+        unique_rows, inverse = np.unique(candidates, return_inverse=True)
+        vectors = np.asarray(self.matrix[unique_rows], dtype=np.float32)
+        exact = np.einsum("qd,qcd->qc", queries, vectors[inverse.reshape(candidates.shape)])
+        k = min(n_results, candidates.shape[1])
+        order = np.argsort(-exact, axis=1)[:, :k]
+        return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(exact, order, axis=1)
+
+    def report(self) -> Dict[str, Any]:
+        compact_bytes = self.compact.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+        float32_bytes = self.matrix.shape[0] * self.matrix.shape[1] * 4
+        return {
+            **super().report(),
+            "backend": self.name,
+            "scan_dtype": str(self.compact.dtype),
+            "scan_mb": round(compact_bytes / (1024 * 1024), 1),
+            "float32_mb": round(float32_bytes / (1024 * 1024), 1),
+            "compression": round(float32_bytes / compact_bytes, 2),
+            "rescore": self.rescore
+        }
+
+
+class FaissBackend(MatrixBackend):
+    """
+    FAISS IVF or HNSW index built from the same matrix.
+
+    ``nprobe`` (IVF) and ``ef_search`` (HNSW) trade recall for speed. IVF
+    indexes are opened with ``IO_FLAG_MMAP`` so processes share them; HNSW
+    graphs are read into each process. Filtered queries use exact search on
+    the matching subset of the mmap'd matrix.
+    """
+
+    def __init__(self, collection, kind: str = "faiss-hnsw", index_dir: str = INDEX_DIR,
+                 facets: Optional[FacetIndex] = None, nprobe: int = 16, ef_search: int = 64):
+        super().__init__(collection, index_dir, facets)
+        import faiss
+
+        self.name = kind
+        path = str(self.index_dir / FAISS_FILES[kind])
+        flags = faiss.IO_FLAG_MMAP if kind == "faiss-ivf" else 0
+        self.index = faiss.read_index(path, flags)
+        if kind == "faiss-ivf":
+            self.index.nprobe = nprobe
+        else:
+            self.index.hnsw.efSearch = ef_search
+
+    def _search(self, queries: np.ndarray, n_results: int):
+        similarities, rows = self.index.search(_normalize(queries), n_results)
+        return rows, similarities
+
+
+def create_vector_backend(name: str, collection, index_dir: str = INDEX_DIR,
+                          facets: Optional[FacetIndex] = None, **options) -> VectorBackend:
+    if name == "chroma":
+        return ChromaBackend(collection)
+    if name == "matrix":
+        return MatrixBackend(collection, index_dir, facets)
+    if name.startswith("matrix-") and name[len("matrix-"):] in COMPACT_FILES:
+        return CompactMatrixBackend(collection, name[len("matrix-"):], index_dir, facets, **options)
+    if name in FAISS_FILES:
+        return FaissBackend(collection, name, index_dir, facets, **options)
+    available = ["chroma", "matrix"] + [f"matrix-{p}" for p in COMPACT_FILES] + list(FAISS_FILES)
+    raise ValueError(f"Unknown vector backend '{name}'. Available: {', '.join(available)}")
+
+
+def index_is_current(index_dir: str, chroma_dir: str) -> bool:
+    """True if the index in ``index_dir`` was built from the store's current version."""
+    return read_store_version(index_dir) == read_store_version(chroma_dir)
+
+
+def recall_at_k(backend: MatrixBackend, queries: np.ndarray, k: int = 10) -> Dict[str, float]:
+    """Recall@k of ``backend`` against exact search on its own matrix, plus mean latency."""
+    exact_rows, _ = backend.exact_search(queries, k)
+    start = time.perf_counter()
+    approx_rows, _ = backend._search(queries, k)
+    seconds = time.perf_counter() - start
+    hits = [len(set(a[a >= 0]) & set(e)) / k for a, e in zip(approx_rows, exact_rows)]
+    return {"recall_at_k": float(np.mean(hits)), "k": k, "mean_ms": seconds * 1000 / len(queries)}
+
+
+def write_compact(index_dir: str, precision: str) -> Dict[str, float]:
+    """Write the float16 or int8 (+ scales) copy of the matrix used by CompactMatrixBackend."""
+    out = Path(index_dir)
+    matrix = np.load(out / MATRIX_FILE, mmap_mode="r")
+    dtype = np.float16 if precision == "float16" else np.int8
+    compact = np.lib.format.open_memmap(out / (COMPACT_FILES[precision] + ".tmp"), mode="w+", dtype=dtype,
+                                        shape=matrix.shape)
+    scales = np.empty(matrix.shape[0], dtype=np.float32)
+    for start in range(0, matrix.shape[0], COMPACT_SCAN_ROWS):
+        block = np.asarray(matrix[start:start + COMPACT_SCAN_ROWS], dtype=np.float32)
+        if precision == "int8":
+            compact[start:start + len(block)], scales[start:start + len(block)] = quantize_int8(block)
+        else:
+            compact[start:start + len(block)] = block.astype(np.float16)
+    compact.flush()
+    del compact
+    Path(out / (COMPACT_FILES[precision] + ".tmp")).replace(out / COMPACT_FILES[precision])
+    if precision == "int8":
+        np.save(out / SCALES_FILE, scales)
+
+    compact_mb = (matrix.shape[0] * matrix.shape[1] * np.dtype(dtype).itemsize
+                  + (scales.nbytes if precision == "int8" else 0)) / (1024 * 1024)
+    float32_mb = matrix.shape[0] * matrix.shape[1] * 4 / (1024 * 1024)
+    print(f"Wrote {precision} copy: {compact_mb:.1f} MB vs {float32_mb:.1f} MB float32 "
+          f"({float32_mb / compact_mb:.1f}x smaller)")
+    return {"compact_mb": compact_mb, "float32_mb": float32_mb}
+
+
+def build_index(parquet_path: str, index_dir: str = INDEX_DIR, dtype: str = "float32",
+                faiss_kinds: Optional[List[str]] = None, batch_size: int = 10000,
+                compact: Optional[List[str]] = None, store_version: Optional[str] = None) -> None:
+    """
+    Write the normalized embedding matrix, its ids, compact copies and
+    optional FAISS indexes, stamped with the ``store_version`` of the Chroma
+    store they mirror so retrievers can tell when the index is stale.
+    """
+    import pyarrow.parquet as pq
+    from .build_chroma_store import iter_parquet_batches, prepare_batch
+
+    out = Path(index_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    # Unstamped while the files are rewritten; stamped again once all of them are in place
+    (out / STORE_VERSION_FILE).unlink(missing_ok=True)
+    parquet_file = pq.ParquetFile(parquet_path)
+    num_rows = parquet_file.metadata.num_rows
+
+    matrix = None
+    ids: List[str] = []
+    seen = set()
+    for offset, batch in iter_parquet_batches(parquet_file, batch_size):
+        prepared = prepare_batch(offset, batch, keep=lambda id_: id_ not in seen)
+        seen.update(prepared["ids"])
+        vectors = _normalize(prepared["embeddings"])
+        if matrix is None:
+            matrix = np.lib.format.open_memmap(out / (MATRIX_FILE + ".tmp"), mode="w+", dtype=dtype,
+                                               shape=(num_rows, vectors.shape[1]))
+        matrix[len(ids):len(ids) + len(vectors)] = vectors
+        ids.extend(prepared["ids"])
+    if matrix is None:
+        raise ValueError(f"No rows found in {parquet_path}")
+
+    # Drop the rows reserved for duplicates that were skipped
+    final = np.lib.format.open_memmap(out / MATRIX_FILE, mode="w+", dtype=dtype, shape=(len(ids), matrix.shape[1]))
+    for start in range(0, len(ids), SCAN_ROWS):
+        final[start:start + SCAN_ROWS] = matrix[start:start + SCAN_ROWS]
+    final.flush()
+    del matrix
+    (out / (MATRIX_FILE + ".tmp")).unlink()
+    width = max(len(i) for i in ids)
+    np.save(out / IDS_FILE, np.asarray(ids, dtype=f"S{width}"))
+    print(f"Wrote {len(ids)} x {final.shape[1]} {dtype} vectors to {out}")
+
+    for precision in compact or []:
+        write_compact(index_dir, precision)
+
+    for kind in faiss_kinds or []:
+        import faiss
+
+        vectors = np.asarray(final, dtype=np.float32)
+        dim = vectors.shape[1]
+        if kind == "faiss-ivf":
+            nlist = max(1, int(4 * np.sqrt(len(vectors))))
+            index = faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            sample = vectors[np.random.default_rng(0).choice(len(vectors), min(len(vectors), 50 * nlist), replace=False)]
+            index.train(sample)
+        else:
+            index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+        index.add(vectors)
+        faiss.write_index(index, str(out / FAISS_FILES[kind]))
+        print(f"Wrote {kind} index")
+    write_store_version(index_dir, store_version)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build and evaluate mmap/FAISS vector backends.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build = sub.add_parser("build", help="Write the embedding matrix (and FAISS indexes) from Parquet")
+    build.add_argument("--parquet", default="data/raw/complaint_embeddings.parquet")
+    build.add_argument("--index-dir", default=INDEX_DIR)
+    build.add_argument("--chroma-dir", default="vector_store/chroma",
+                       help="Store the index mirrors; its version is stamped on the index")
+    build.add_argument("--dtype", choices=["float32", "float16"], default="float32")
+    build.add_argument("--faiss", nargs="*", choices=list(FAISS_FILES), default=[])
+    build.add_argument("--compact", nargs="*", choices=list(COMPACT_FILES), default=[],
+                       help="Also write float16 and/or int8 copies for the matrix-<precision> backends")
+
+    recall = sub.add_parser("recall", help="Report recall@k of each backend against exact search")
+    recall.add_argument("--index-dir", default=INDEX_DIR)
+    recall.add_argument("--queries", type=int, default=200)
+    recall.add_argument("--k", type=int, default=10)
+    recall.add_argument("--nprobe", type=int, default=16)
+    recall.add_argument("--ef-search", type=int, default=64)
+    recall.add_argument("--rescore", type=int, default=RESCORE_FACTOR)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.command == "build":
+        build_index(args.parquet, args.index_dir, args.dtype, args.faiss, compact=args.compact,
+                    store_version=read_store_version(args.chroma_dir))
+        return 0
+
+    exact = MatrixBackend(collection=None, index_dir=args.index_dir)
+    # Queries: stored vectors with a little noise, so the exact neighbour isn't trivially itself
+    rng = np.random.default_rng(0)
+    rows = rng.choice(exact.matrix.shape[0], min(args.queries, exact.matrix.shape[0]), replace=False)
+    queries = _normalize(np.asarray(exact.matrix[np.sort(rows)], dtype=np.float32)
+                         + rng.normal(0, 0.05, (len(rows), exact.matrix.shape[1])).astype(np.float32))
+
+    report = {"matrix": {**exact.report(), **recall_at_k(exact, queries, args.k)}}
+    for precision, filename in COMPACT_FILES.items():
+        if (Path(args.index_dir) / filename).exists():
+            for rescore in (args.rescore, 1):
+                backend = CompactMatrixBackend(None, precision, args.index_dir, rescore=rescore)
+                name = backend.name if rescore > 1 else f"{backend.name}-no-rescore"
+                report[name] = {**backend.report(), **recall_at_k(backend, queries, args.k)}
+    for kind, filename in FAISS_FILES.items():
+        if (Path(args.index_dir) / filename).exists():
+            backend = FaissBackend(None, kind, args.index_dir, nprobe=args.nprobe, ef_search=args.ef_search)
+            report[kind] = {**backend.report(), **recall_at_k(backend, queries, args.k)}
+    logging.info(report)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
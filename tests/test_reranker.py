@@ -0,0 +1,46 @@
+# tests/test_reranker.py
+import time
+
+from rag.reranker import Reranker
+
+
+class SlowCrossEncoder:
+    """Fake cross-encoder taking ``seconds_per_pair`` per scored pair."""
+
+    def __init__(self, seconds_per_pair: float):
+        self.seconds_per_pair = seconds_per_pair
+
+    def predict(self, pairs, batch_size=16):
+        time.sleep(self.seconds_per_pair * len(pairs))
+        return [float(len(text)) for _, text in pairs]
+
+
+class FakeReranker(Reranker):
+    def __init__(self, seconds_per_pair: float, **kwargs):
+        super().__init__(**kwargs)
+        self.fake_model = SlowCrossEncoder(seconds_per_pair)
+
+    @property
+    def model(self):
+        return self.fake_model
+
+
+def candidates(n):
+    return [{"id": str(i), "text": "complaint " * (i + 1), "metadata": {}} for i in range(n)]
+
+
+def test_rerank_stays_within_the_budget():
+    reranker = FakeReranker(0.01, batch_size=16, budget_ms=100.0)
+    start = time.perf_counter()
+    selected, info = reranker.rerank("fees", candidates(50), top_k=3)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    assert not info["reranked"]
+    assert [c["id"] for c in selected][0] == "0"  # Vector order
+    assert elapsed_ms < 100.0 + 20.0
+
+
+def test_rerank_scores_everything_within_a_generous_budget():
+    reranker = FakeReranker(0.001, batch_size=16, budget_ms=2000.0)
+    selected, info = reranker.rerank("fees", candidates(20), top_k=3)
+    assert info["reranked"]
+    assert selected[0]["id"] == "19"  # Longest text scores highest
@@ -0,0 +1,135 @@
+# tests/test_service.py
+import asyncio
+import time
+
+from rag.generator import GenerationScheduler, Generator
+from rag.generator_backends import StubBackend
+from rag.rag_pipeline import RAGPipeline
+from rag.service import AdmissionControl, ServiceBusy, ServiceCore
+from rag.telemetry import get_telemetry
+
+
+class SlowStubBackend(StubBackend):
+    """Stub backend whose batches take ``seconds``, recording each batch size."""
+
+    def __init__(self, seconds: float = 0.3):
+        super().__init__()
+        self.seconds = seconds
+        self.batches = []
+
+    def generate_batch(self, prompts, max_new_tokens=100):
+        self.batches.append(len(prompts))
+        time.sleep(self.seconds)
+        return [self.generate(prompt, max_new_tokens) for prompt in prompts]
+
+
+class StubPipeline(RAGPipeline):
+    """Pipeline with a fixed source per question and a slow stub generator."""
+
+    ready = True
+
+    def __init__(self):
+        super().__init__()
+        self.backend = SlowStubBackend()
+        self._generator = Generator(preset="stub")
+        self._generator.backend = self.backend
+        self._generator.scheduler = GenerationScheduler(self.backend, max_batch_size=4, max_wait_ms=20)
+
+    @property
+    def generator(self) -> Generator:
+        return self._generator
+
+    def prepare(self, question, k=3, where=None):
+        return None, [{"id": question, "text": f"Complaint about {question}", "metadata": {}}], {}
+
+
+def test_admission_rejects_a_burst_beyond_the_queue():
+    async def burst():
+        admission = AdmissionControl(max_in_flight=2, max_waiting=1, queue_timeout=5.0)
+
+        async def request():
+            async with admission.slot():
+                await asyncio.sleep(0.05)
+
+        results = await asyncio.gather(*[request() for _ in range(8)], return_exceptions=True)
+        return admission, results
+
+    admission, results = asyncio.run(burst())
+    rejected = [r for r in results if isinstance(r, ServiceBusy)]
+    assert len(rejected) == 5
+    assert all(r.status_code == 429 for r in rejected)
+    assert admission.rejected == 5
+    assert admission.in_flight == 0 and admission.waiting == 0
+
+
+def test_cancelled_queries_are_not_generated():
+    rag = StubPipeline()
+    service = ServiceCore(rag=rag, max_in_flight=4)
+
+    async def scenario():
+        running = asyncio.ensure_future(service.query("fees", use_cache=False))
+        await asyncio.sleep(0.1)  # Its batch is generating
+        queued = [asyncio.ensure_future(service.query(f"question {i}", use_cache=False)) for i in range(3)]
+        await asyncio.sleep(0.1)  # Queued behind the running batch
+        for task in queued:
+            task.cancel()
+        await asyncio.gather(*queued, return_exceptions=True)
+        in_flight_after_cancel = service.admission.in_flight
+
+        # A prompt already in a running batch keeps its slot until the batch is done
+        running.cancel()
+        await asyncio.sleep(0.05)
+        in_flight_while_generating = service.admission.in_flight
+        await asyncio.gather(running, return_exceptions=True)
+        await asyncio.sleep(0.1)
+        return in_flight_after_cancel, in_flight_while_generating
+
+    try:
+        in_flight_after_cancel, in_flight_while_generating = asyncio.run(scenario())
+    finally:
+        service.shutdown()
+    assert rag.backend.batches == [1]
+    assert in_flight_after_cancel == 1
+    assert in_flight_while_generating == 1
+    assert service.admission.in_flight == 0
+    assert service.cancelled == 4
+
+
+def test_query_is_traced():
+    rag = StubPipeline()
+    rag.backend.seconds = 0.0
+    service = ServiceCore(rag=rag)
+    telemetry = get_telemetry()
+    telemetry.reset()
+    telemetry.enable()
+    try:
+        response = asyncio.run(service.query("fees", use_cache=False))
+        snapshot = telemetry.snapshot()
+    finally:
+        telemetry.disable()
+        telemetry.reset()
+        service.shutdown()
+    assert response["answer"].startswith("Based on the complaints")
+    assert snapshot["counters"]['rag_requests_total{request="query"}'] == 1
+    assert 'rag_stage_seconds{stage="generate"}' in snapshot["timings_ms"]
+
+
+def test_retrieve_does_not_wait_for_the_generator():
+    class WarmingPipeline(StubPipeline):
+        ready = False
+        retriever_ready = True
+
+        def retrieve(self, question, k=3, where=None):
+            return {"question": question, "sources": [], "timings": {}}
+
+    service = ServiceCore(rag=WarmingPipeline())
+    try:
+        assert asyncio.run(service.retrieve("fees"))["question"] == "fees"
+        try:
+            asyncio.run(service.query("fees"))
+        except ServiceBusy as e:
+            assert e.status_code == 503
+        else:
+            raise AssertionError("query should wait for the generator")
+    finally:
+        service.shutdown()